@@ -0,0 +1,361 @@
+"""
+端到端吞吐压测
+
+不依赖生产的 MySQL 和 ES：生成 100 张 stat_article_subject_N 表和 article_operation 的合成数据，
+存到一个 SQLite 文件里，用 SQLiteConnection（接口同 pymysql 的 DictCursor 连接）代替 MySQL，
+另起一个进程跑 fake_es 代替 ES，然后按正式的路径（拆分任务、多进程同步、检查点）同步一次，
+报告吞吐（条/s）、任务耗时 p50/p99 和峰值 RSS
+
+数据按表倾斜：第 N 张表的行数正比于 1 / (N + 1) ** skew，skew 为 0 时均匀分布
+
+--replicas N 时配置 N 个从库，都是同一个 SQLite 文件的替身；--db-capacity、--db-latency 让每个替身
+同时只能执行有限个查询、每个查询有固定的耗时，模拟数据库的容量，用来对比从库数量和读取吞吐；
+--dead-replicas 让前几个从库拒绝连接，检查切换
+
+每次做性能相关的修改，先在修改前跑一次保存基线，修改后再对比：
+    python bench_e2e.py --rows 200000 --output before.json
+    python bench_e2e.py --rows 200000 --baseline before.json
+
+用法：python bench_e2e.py [--rows 记录数] [--hours 小时数] [--skew 倾斜度] [--engine process|pipeline]
+                          [--set 设置=值 ...]，其他参数见 --help
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import tempfile
+import time
+import urllib.request
+
+import pymysql
+import yaml
+
+import es_sync_data
+from fake_es import FakeES
+from sync_metrics import merge, quantile
+
+# SQLite 中按 DATETIME 声明的字段读出来转成 datetime，和 pymysql 一致
+sqlite3.register_converter('DATETIME', lambda value: datetime.datetime.fromisoformat(value.decode()))
+sqlite3.register_adapter(datetime.datetime, lambda value: value.strftime(es_sync_data.date_fmt))
+
+# 合成数据的起始时间
+base_time = datetime.datetime(2019, 11, 28)
+date_columns = ('article_extracted_time', 'article_pubtime', 'created_time', 'user_last_process_time')
+
+
+class SQLiteCursor:
+    """SQLite 游标，接口同 pymysql 的 DictCursor / SSDictCursor 或者 Cursor / SSCursor，只实现同步用到的部分"""
+
+    def __init__(self, cursor, as_dict=True, gate=None, latency=0.0):
+        self._cursor = cursor
+        self._as_dict = as_dict
+        self._names = []
+        self._gate = gate
+        self._latency = latency
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def execute(self, sql, args=None):
+        if sql.strip().startswith('SET SESSION'):
+            # 替身没有会话变量
+            self._names = []
+            return
+        if sql.strip().startswith('SHOW REPLICA STATUS'):
+            # 替身都当作没有延迟的从库
+            sql = 'SELECT 0 AS Seconds_Behind_Source'
+        if self._gate is not None:
+            with self._gate:
+                time.sleep(self._latency)
+                self._cursor.execute(sql.replace('%s', '?'), args or ())
+        else:
+            self._cursor.execute(sql.replace('%s', '?'), args or ())
+        self._names = [d[0] for d in self._cursor.description or ()]
+
+    def _convert(self, rows):
+        if not self._as_dict:
+            return rows
+        names = self._names
+        return [dict(zip(names, row)) for row in rows]
+
+    def fetchmany(self, size):
+        return self._convert(self._cursor.fetchmany(size))
+
+    def fetchone(self):
+        rows = self._convert(self._cursor.fetchmany(1))
+        return rows[0] if rows else None
+
+    def fetchall(self):
+        return self._convert(self._cursor.fetchall())
+
+    def close(self):
+        self._cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SQLiteConnection:
+    """
+    SQLite 连接，接口同 pymysql 的连接，cursor() 不传游标类型时和 DictCursor 一样返回 dict
+    :param gate: 多进程共享的信号量，限制这个替身数据库同时执行的查询数，None 表示不限制
+    :param latency: 每个查询占用 gate 的模拟耗时（秒）
+    """
+
+    def __init__(self, path, gate=None, latency=0.0):
+        self._conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        self._gate = gate
+        self._latency = latency
+
+    def cursor(self, cursor_class=None):
+        as_dict = cursor_class is None or issubclass(cursor_class, pymysql.cursors.DictCursorMixin)
+        return SQLiteCursor(self._conn.cursor(), as_dict, self._gate, self._latency)
+
+    def ping(self, reconnect=False):
+        self._conn.execute('SELECT 1')
+
+    def close(self):
+        self._conn.close()
+
+
+def generate(path, rows, hours, skew, op_ratio, seed):
+    """
+    生成合成数据
+    :param rows: 100 张表的总行数
+    :param hours: 数据覆盖的小时数，从 base_time 开始
+    :param skew: 表之间的倾斜度
+    :param op_ratio: 有操作记录的文章比例
+    :return: 去重后的文档数（client_id-subject_id-article_detail_id）
+    """
+    rnd = random.Random(seed)
+    sas_fields = [f.split('.')[1] for f in es_sync_data.get_fields() if f.startswith('sas.')]
+    op_fields = list(es_sync_data.operation_fields)
+
+    def column(name):
+        return name + ' DATETIME' if name in date_columns else name
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    for tbl_idx in range(0, 100):
+        conn.execute('CREATE TABLE stat_article_subject_%s (%s)' % (tbl_idx, ','.join(map(column, sas_fields))))
+        conn.execute('CREATE INDEX idx_created_time_%s ON stat_article_subject_%s (created_time)' % (tbl_idx, tbl_idx))
+    conn.execute('CREATE TABLE article_operation (article_detail_id INTEGER PRIMARY KEY, %s)'
+                 % ','.join(map(column, op_fields)))
+
+    weights = [1 / (i + 1) ** skew for i in range(0, 100)]
+    counts = [0] * 100
+    for tbl_idx in rnd.choices(range(0, 100), weights, k=rows):
+        counts[tbl_idx] += 1
+
+    # 同一篇文章会出现在多个专题、多张表里
+    articles = max(1, rows // 3)
+    ids = set()
+    for tbl_idx, count in enumerate(counts):
+        batch = []
+        for _ in range(count):
+            detail_id = rnd.randrange(articles)
+            created = base_time + datetime.timedelta(seconds=rnd.randrange(hours * 3600))
+            row = {f: rnd.randrange(100) for f in sas_fields}
+            row.update({
+                'article_content_fingerprint': '%032x' % rnd.getrandbits(128),
+                'article_record_md5_id': '%032x' % rnd.getrandbits(128),
+                'article_title_fingerprint': '%032x' % rnd.getrandbits(128),
+                'article_detail_id': detail_id,
+                'article_extracted_time': created,
+                'article_pubtime': created - datetime.timedelta(minutes=rnd.randrange(600)),
+                'created_time': created,
+                'client_id': rnd.randrange(20),
+                'subject_id': rnd.randrange(500),
+                'domain_code': rnd.choice(('weibo.com', 'qq.com', 'sina.com.cn')),
+                'media_type_code': rnd.choice('WBNF'),
+                'source_type': rnd.choice(('news', 'weibo', 'bbs')),
+                'website_no': 'S%06d' % rnd.randrange(1000),
+            })
+            ids.add((row['client_id'], row['subject_id'], detail_id))
+            batch.append([row[f] for f in sas_fields])
+        conn.executemany('INSERT INTO stat_article_subject_%s VALUES (%s)'
+                         % (tbl_idx, ','.join('?' * len(sas_fields))), batch)
+
+    conn.executemany('INSERT INTO article_operation VALUES (?, ?, ?, ?, ?)', [
+        (detail_id, rnd.randrange(3), rnd.randrange(1000),
+         base_time + datetime.timedelta(seconds=rnd.randrange(hours * 3600)), rnd.choice(('done', 'todo')))
+        for detail_id in range(articles) if rnd.random() < op_ratio])
+    conn.commit()
+    conn.close()
+    return len(ids)
+
+
+def serve_es(conn, reject_ratio, latency):
+    """在子进程里运行 fake_es，不和同步进程抢主进程的 CPU"""
+    server = FakeES(reject_ratio=reject_ratio, latency=latency, keep_source=False)
+    conn.send(server.url)
+    server.serve_forever()
+
+
+def es_count(url):
+    with urllib.request.urlopen(url + '/kwm-list-*/_count') as resp:
+        return json.loads(resp.read())['count']
+
+
+def run(args, workdir):
+    data = args.data or os.path.join(workdir, 'bench.db')
+    if not os.path.exists(data):
+        _start = time.time()
+        expected = generate(data, args.rows, args.hours, args.skew, args.op_ratio, args.seed)
+        with open(data + '.json', 'w') as w:
+            json.dump({'expected_docs': expected}, w)
+        print('生成 %s 条记录（%s 个文档），耗时 %.2fs' % (args.rows, expected, time.time() - _start))
+    with open(data + '.json') as r:
+        expected = json.load(r)['expected_docs']
+
+    parent_conn, child_conn = multiprocessing.Pipe()
+    es_process = multiprocessing.Process(target=serve_es, args=(child_conn, args.reject_ratio, args.es_latency),
+                                         daemon=True)
+    es_process.start()
+    es_url = parent_conn.recv()
+
+    # 换成本地的数据库、ES 和工作目录，其余按正式的配置和路径执行
+    overrides = {k: yaml.safe_load(v) for k, v in (item.split('=', 1) for item in args.set)}
+    es_sync_data.cur_dir = workdir
+    es_sync_data.es_hosts = [es_url]
+    hosts = ['primary'] + ['replica-%s' % i for i in range(args.replicas)]
+    dead = set(hosts[1:1 + args.dead_replicas])
+    # 在 fork 之前创建，子进程共用
+    gates = {host: multiprocessing.BoundedSemaphore(args.db_capacity) if args.db_capacity else None for host in hosts}
+
+    def connect_db(db_config):
+        if db_config['host'] in dead:
+            raise pymysql.err.OperationalError(2003, "Can't connect to MySQL server on '%s'" % db_config['host'])
+        return SQLiteConnection(data, gates[db_config['host']], args.db_latency)
+
+    es_sync_data.connect_db = connect_db
+    es_sync_data.get_config = lambda: {'DB': {'host': 'primary'}, 'SYNC': overrides,
+                                       'REPLICAS': [{'host': host} for host in hosts[1:]]}
+    settings = es_sync_data.get_settings()
+
+    _start = time.time()
+    start_date = base_time
+    end_date = base_time + datetime.timedelta(hours=args.hours)
+    tasks = es_sync_data.plan_tasks(start_date, end_date, 3600)
+    checkpoint = es_sync_data.get_checkpoint()
+    checkpoint.plan(tasks, end_date.strftime(es_sync_data.date_fmt))
+    tasks = es_sync_data.order_tasks(checkpoint.pending(), count_tables(data))
+    es_sync_data.index_cache.prepare(es_sync_data.get_es())
+    es_sync_data.get_pool().close()
+    es_sync_data.get_pool.cache_clear()
+
+    reports = es_sync_data.run_processes(tasks, settings, args.processes, args.threads,
+                                         pipeline=args.engine == 'pipeline')
+    elapsed = time.time() - _start
+    snapshot = merge([r.pop('metrics') for r in reports if 'metrics' in r])
+    task_hist = merge_hist(snapshot, 'sync_task_seconds')
+    docs = sum(r['docs'] for r in reports)
+    checkouts = {}
+    for (name, labels), value in snapshot['counters'].items():
+        if name == 'sync_replica_checkouts_total':
+            replica = dict(labels)['replica']
+            checkouts[replica] = checkouts.get(replica, 0) + value
+    result = {
+        'rows': args.rows,
+        'skew': args.skew,
+        'engine': args.engine,
+        'processes': args.processes,
+        'threads': args.threads,
+        'settings': overrides,
+        'replicas': args.replicas,
+        'replica_checkouts': dict(sorted(checkouts.items())),
+        'tasks': len(tasks),
+        'elapsed': round(elapsed, 3),
+        'docs': docs,
+        'failed': sum(r['failed'] for r in reports),
+        'docs_per_sec': round(docs / elapsed, 1),
+        'task_p50': quantile(0.5, snapshot['buckets'], task_hist) if task_hist else None,
+        'task_p99': quantile(0.99, snapshot['buckets'], task_hist) if task_hist else None,
+        # 子进程中最大的一个，Linux 下 ru_maxrss 的单位是 KB
+        'peak_rss_worker_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        'peak_rss_main_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'expected_docs': expected,
+        'docs_in_es': es_count(es_url),
+    }
+    es_process.terminate()
+    return result
+
+
+def count_tables(path):
+    """各表的行数，用于按大小排序任务（代替 information_schema 的估算）"""
+    conn = sqlite3.connect(path)
+    try:
+        return {'stat_article_subject_%s' % i: conn.execute('SELECT COUNT(*) FROM stat_article_subject_%s' % i)
+                .fetchone()[0] for i in range(0, 100)}
+    finally:
+        conn.close()
+
+
+def merge_hist(snapshot, name):
+    """把一个直方图的所有标签合并"""
+    total = None
+    for (metric, _), hist in snapshot['histograms'].items():
+        if metric == name:
+            total = hist if total is None else [a + b for a, b in zip(total, hist)]
+    return total
+
+
+def compare(result, baseline):
+    """和基线对比主要指标"""
+    for key, better in (('docs_per_sec', 1), ('task_p50', -1), ('task_p99', -1), ('peak_rss_worker_mb', -1)):
+        old, new = baseline.get(key), result.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        print('%-20s %10.3f -> %10.3f  %+6.1f%%%s' % (key, old, new, change, '' if change * better >= 0 else '  ↓'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='端到端吞吐压测')
+    parser.add_argument('--rows', type=int, default=200000, help='100 张表的总行数')
+    parser.add_argument('--hours', type=int, default=6, help='数据覆盖的小时数')
+    parser.add_argument('--skew', type=float, default=1.0, help='表之间的倾斜度，0 为均匀分布')
+    parser.add_argument('--op-ratio', type=float, default=0.3, help='有操作记录的文章比例')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子，相同的参数生成相同的数据')
+    parser.add_argument('--data', help='合成数据的 SQLite 文件，已经存在就直接使用，不存在就生成并保留')
+    parser.add_argument('--engine', choices=('process', 'pipeline'), default='process')
+    parser.add_argument('--processes', type=int, default=2, help='同步进程数')
+    parser.add_argument('--threads', type=int, default=5, help='每个进程的线程数')
+    parser.add_argument('--es-latency', type=float, default=0.0, help='fake_es 每次 bulk 的模拟延迟（秒）')
+    parser.add_argument('--replicas', type=int, default=0, help='从库（替身）的个数，0 表示只读主库')
+    parser.add_argument('--dead-replicas', type=int, default=0, help='前几个从库拒绝连接')
+    parser.add_argument('--db-capacity', type=int, default=0,
+                        help='每个替身数据库同时执行的查询数，0 表示不限制')
+    parser.add_argument('--db-latency', type=float, default=0.0,
+                        help='--db-capacity 时每个查询的模拟耗时（秒）')
+    parser.add_argument('--reject-ratio', type=float, default=0.0, help='fake_es 按比例返回 429 拒绝')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='覆盖同步设置（同 config.yml 的 SYNC 节点），可以多次使用')
+    parser.add_argument('--output', help='结果写入 JSON 文件，可以作为之后对比的基线')
+    parser.add_argument('--baseline', help='对比的基线 JSON 文件')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_e2e_')
+    try:
+        result = run(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if result['docs_in_es'] != result['expected_docs']:
+        print('ES 中的文档数 %s 和预期的 %s 不一致' % (result['docs_in_es'], result['expected_docs']))
+    if args.output:
+        with open(args.output, 'w') as w:
+            json.dump(result, w, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline) as r:
+            compare(result, json.load(r))
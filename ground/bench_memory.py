@@ -0,0 +1,135 @@
+"""
+对比一次性 fetchall 与服务端游标流式读取两种同步路径的内存占用，以及 dict 和 tuple（按列存放）两种记录格式
+
+用法：python bench_memory.py [记录数]
+
+不依赖真实的 MySQL 和 ES，用一张按需生成记录的合成大表模拟游标，
+ES 的 bulk 只做序列化，用 tracemalloc 统计峰值内存
+"""
+import datetime
+import sys
+import time
+import tracemalloc
+
+from elasticsearch.serializer import JSONSerializer
+
+from es_sync_data import default_settings, get_fields, iter_row_batches, iter_rows, iter_actions, to_batch, \
+    transform_rows
+from sync_bulk import submit_bulk
+
+
+def make_row(i):
+    """生成一条合成记录，字段与 get_fields() 一致"""
+    t = datetime.datetime(2019, 11, 28) + datetime.timedelta(seconds=i % 86400)
+    row = {f.split('.')[1]: i for f in get_fields()}
+    row.update({
+        'article_content_fingerprint': '%032x' % i,
+        'article_record_md5_id': '%032x' % (i * 7),
+        'article_title_fingerprint': '%032x' % (i * 13),
+        'article_extracted_time': t,
+        'article_pubtime': t,
+        'created_time': t,
+        'user_last_process_time': t if i % 3 == 0 else None,
+        'domain_code': 'weibo.com',
+        'media_type_code': 'W',
+        'source_type': 'news',
+        'user_process_status': 'done',
+        'website_no': 'S%06d' % (i % 1000),
+        'subject_id': i % 50,
+    })
+    return row
+
+
+class SyntheticCursor:
+    """
+    模拟游标：fetchall 一次性物化全部记录，fetchmany 按需生成
+    :param as_tuple: 和 pymysql 的 Cursor 一样返回 tuple，否则和 DictCursor 一样返回 dict
+    """
+
+    def __init__(self, total, as_tuple=False):
+        names = [f.split('.')[1] for f in get_fields()]
+        self.description = [(name,) for name in names]
+        self._rows = (make_row(i) for i in range(total))
+        if as_tuple:
+            self._rows = (tuple(r[name] for name in names) for r in self._rows)
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def fetchmany(self, size):
+        return [r for _, r in zip(range(size), self._rows)]
+
+
+class SerializingES:
+    """只做序列化的假 ES 客户端"""
+
+    class transport:
+        serializer = JSONSerializer()
+
+    def bulk(self, body, **kwargs):
+        n = body.count('\n') // 2
+        return {'took': 1, 'errors': False, 'items': [{'index': {'status': 201}} for _ in range(n)]}
+
+
+def buffered_path(total, settings):
+    """原来的路径：fetchall 后一次 bulk 全部提交"""
+    cursor = SyntheticCursor(total)
+    rst = cursor.fetchall()
+    actions = list(iter_actions(rst))
+    submit_bulk(SerializingES(), actions, {**settings, 'bulk_size': total + 1,
+                                           'bulk_max_bytes': 1 << 40, 'bulk_in_flight': 1})
+
+
+def stream_path(total, settings):
+    cursor = SyntheticCursor(total)
+    rows = iter_rows(cursor, settings['fetch_size'])
+    submit_bulk(SerializingES(), iter_actions(rows), settings)
+
+
+def buffered_tuple_path(total, settings):
+    """fetchall 之后按列存放，action 在提交时才逐个生成"""
+    cursor = SyntheticCursor(total, as_tuple=True)
+    rst = to_batch(cursor, cursor.fetchall())
+    submit_bulk(SerializingES(), transform_rows(rst), {**settings, 'bulk_size': total + 1,
+                                                       'bulk_max_bytes': 1 << 40, 'bulk_in_flight': 1})
+
+
+def stream_tuple_path(total, settings):
+    cursor = SyntheticCursor(total, as_tuple=True)
+    batches = iter_row_batches(cursor, settings['fetch_size'])
+    submit_bulk(SerializingES(), (action for rows in batches for action in transform_rows(rows)), settings)
+
+
+def fetched_size(total, as_tuple):
+    """只 fetchall（再按列存放）占用的内存，即每种格式持有一个时间段的记录的开销"""
+    tracemalloc.start()
+    cursor = SyntheticCursor(total, as_tuple)
+    rst = to_batch(cursor, cursor.fetchall())
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del rst
+    return current
+
+
+def measure(func, total, settings):
+    tracemalloc.start()
+    _start = time.time()
+    func(total, settings)
+    elapsed = time.time() - _start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, elapsed
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    settings = dict(default_settings)
+    for name, as_tuple in (('dict', False), ('tuple', True)):
+        size = fetched_size(total, as_tuple)
+        print('%-14s 持有 %s 条记录 %.1f MB，每 10 万条 %.1f MB' % (
+            name, total, size / 1024 / 1024, size / 1024 / 1024 * 100000 / total))
+    for name, func in (('buffered', buffered_path), ('buffered_tuple', buffered_tuple_path),
+                       ('stream', stream_path), ('stream_tuple', stream_tuple_path)):
+        peak, elapsed = measure(func, total, settings)
+        print('%-14s %s 条记录，峰值内存 %.1f MB，每 10 万条 %.1f MB，耗时 %.2fs' % (
+            name, total, peak / 1024 / 1024, peak / 1024 / 1024 * 100000 / total, elapsed))
@@ -0,0 +1,49 @@
+"""
+对比逐行转换和批量转换（缓存日期格式化）生成 ES action 的耗时
+
+用法：python bench_transform.py [记录数] [重复次数]
+"""
+import datetime
+import sys
+import time
+
+from bench_memory import make_row
+from es_sync_data import format_datetime, transform_batch
+
+
+def legacy_transform(rows):
+    """原来 sync_thread 中逐行处理的写法"""
+    actions = []
+    for r in rows:
+        idx_name = f"kwm-list-{r['article_extracted_time'].strftime('%Y-%m-%d')}"
+        _id = f"{r['client_id']}-{r['subject_id']}-{r['article_detail_id']}"
+        for date_field in ('article_extracted_time', 'article_pubtime',
+                           'created_time', 'user_last_process_time'):
+            if isinstance(r[date_field], datetime.datetime):
+                r[date_field] = r[date_field].strftime('%Y-%m-%d %H:%M:%S')
+        actions.append({"_index": idx_name, "_id": _id, "_source": r})
+    return actions
+
+
+def measure(func, total, repeat):
+    best = None
+    for _ in range(repeat):
+        # 一个小时内的数据，时间精确到秒
+        rows = [make_row(i % 3600 + i // 3600 * 86400) for i in range(total)]
+        # 每次都从空的缓存开始
+        format_datetime.cache_clear()
+        _start = time.perf_counter()
+        func(rows)
+        elapsed = time.perf_counter() - _start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    # 两种写法的结果必须一致
+    assert legacy_transform([make_row(i) for i in range(100)]) == transform_batch([make_row(i) for i in range(100)])
+    for name, func in (('legacy', legacy_transform), ('batch', transform_batch)):
+        elapsed = measure(func, total, repeat)
+        print('%-6s %s 条记录，耗时 %.3fs，%.0f 条/s' % (name, total, elapsed, total / elapsed))
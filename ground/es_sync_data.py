@@ -1,20 +1,171 @@
+import argparse
+import asyncio
+import collections
+import elasticsearch
 import pymysql
 import yaml
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, TransportError
 from threading import Thread, Lock, current_thread
 import datetime
+import fcntl
 import time
 import math
 import logging
 import coloredlogs
+import contextlib
+import functools
+import importlib.util
+import itertools
 import multiprocessing
+import multiprocessing.pool
 import os
+import queue
+import signal
+import threading
+
+from sync_adaptive import BulkController
+from sync_backfill import IndexTuner
+from sync_bulk import submit_bulk
+from sync_checkpoint import CheckpointStore
+from sync_digest import DigestStore
+from sync_governor import LoadGovernor
+from sync_lookup import OperationLookup
+from sync_metrics import merge, metrics, summarize, write_json, write_prometheus
+from sync_pipeline import Pipeline
+from sync_pool import ConnectionPool, per_process
+from sync_replicas import ReplicaPool, ReplicaRouter
+from sync_rows import LazyActions, RowBatch
+from sync_spool import DeadLetterSpool, read_segment
 
 logger = logging.getLogger('SyncData2ES')
 coloredlogs.install(level='INFO', logger=logger,
                     fmt='[%(asctime)s] %(processName)s.%(threadName)s.%(levelname)s %(message)s')
 date_fmt = '%Y-%m-%d %H:%M:%S'
 cur_dir = os.path.dirname(__file__)
+# 需要转成字符串的日期字段
+date_fields = ('article_extracted_time', 'article_pubtime', 'created_time', 'user_last_process_time')
+# ES 节点
+es_hosts = ['192.168.1.217', '192.168.1.218']
+# article_operation 中操作相关的字段，局部更新时只更新这些字段
+operation_fields = ('user_confirm_emotion_type', 'user_id', 'user_last_process_time', 'user_process_status')
+# kwm-list-* 索引模板的名称
+template_name = 'kwm-list'
+# 同步设置的默认值，可以在 config.yml 的 SYNC 节点中覆盖
+default_settings = {
+    # 时间段的拆分方式：fixed 固定按小时，adaptive 按估算的行数拆分、合并
+    'plan_mode': 'fixed',
+    # adaptive 模式每个任务的目标行数
+    'target_rows': 50000,
+    # 抽取模式：window 按时间段拆分任务，keyset 按表的高水位分页增量抽取
+    'extract_mode': 'window',
+    # keyset 模式每页的记录数
+    'page_size': 5000,
+    # 变化检测：本地保存文档哈希，跳过内容没有变化的文档
+    'change_detection': False,
+    # 文档哈希超过这个天数没有更新就清理掉
+    'digest_max_age_days': 7,
+    # 操作字段的获取方式：join 每张表 LEFT JOIN article_operation，batch 按 article_detail_id 批量查询并缓存
+    'operation_lookup': 'join',
+    # batch 模式每个任务缓存的 article_detail_id 数，缓存不跨任务，见 sync_lookup
+    'operation_cache_size': 100000,
+    # 流水线引擎（--engine pipeline）每个进程的读取、转换、写入线程数
+    'pipeline_readers': 3,
+    'pipeline_transformers': 1,
+    'pipeline_writers': 4,
+    # 流水线阶段之间队列的容量（批）
+    'pipeline_queue_size': 8,
+    # 流水线打印各阶段状态的间隔（秒）
+    'pipeline_log_interval': 10,
+    # asyncio 引擎同时执行的任务数
+    'async_task_concurrency': 200,
+    # asyncio 引擎同时执行的数据库查询数
+    'db_concurrency': 20,
+    # asyncio 引擎同时在途的 bulk 请求数
+    'bulk_concurrency': 8,
+    # 读取模式：stream 使用服务端游标（SSDictCursor）流式读取，buffered 一次性 fetchall
+    'read_mode': 'stream',
+    # 每个连接的 net_write_timeout（秒），0 表示用服务端的默认值（60）。流式读取时游标在 bulk 提交期间一直开着，
+    # 服务端发送结果被阻塞超过这个时间就会中断查询，要大于一次提交最长的等待：
+    # bulk_timeout × (bulk_max_retries + 1) 再加上退避时间
+    'db_net_write_timeout': 900,
+    # 单个任务超过这么多行时按 article_detail_id 拆分成 range_split_parts 段，用各自的连接并发读取，0 表示不拆分
+    # （keyset 模式不拆分；并发读取受 db_pool_size 限制）
+    'range_split_rows': 0,
+    'range_split_parts': 4,
+    # 记录格式：dict 使用 DictCursor，tuple 使用普通游标，一批记录按列存放（见 sync_rows），内存占用更小
+    'row_format': 'dict',
+    # 流式读取时每次从服务端拉取的记录数
+    'fetch_size': 2000,
+    # bulk 请求体的序列化方式：client 由 ES 客户端逐条序列化，ndjson 直接编码成 NDJSON 字节（优先用 orjson）
+    'bulk_serializer': 'client',
+    # 每次 bulk 提交的最大文档数
+    'bulk_size': 2000,
+    # 每次 bulk 提交的最大字节数（序列化后）
+    'bulk_max_bytes': 10 * 1024 * 1024,
+    # 每个任务同时在途的 bulk 请求数
+    'bulk_in_flight': 2,
+    # 单个 bulk 请求的超时时间（秒）
+    'bulk_timeout': 120,
+    # bulk 自适应：按 429 拒绝和请求耗时调整每个进程的在途请求数和批大小（AIMD），被拒绝的文档退避后重试
+    'bulk_adaptive': False,
+    # 自适应时在途请求数、批大小的范围（初始值为 bulk_in_flight、bulk_size），批大小每次增加的步长
+    'bulk_min_in_flight': 1,
+    'bulk_max_in_flight': 8,
+    'bulk_min_size': 200,
+    'bulk_max_size': 5000,
+    'bulk_size_step': 500,
+    # 自适应时单个请求耗时的目标值（秒），超过就减小并发
+    'bulk_target_latency': 5,
+    # 自适应时被拒绝的文档最多重试的次数，退避的基数和上限（秒）
+    'bulk_max_retries': 5,
+    'bulk_backoff': 0.5,
+    'bulk_max_backoff': 30,
+    # 每个进程的数据库连接池大小
+    'db_pool_size': 5,
+    # 连接空闲超过这个秒数，使用前先 ping 检查
+    'db_ping_interval': 30,
+    # 从库（config.yml 的 REPLICAS）：复制延迟超过 replica_max_lag 秒的从库不使用，
+    # 同步也只同步到 replica_max_lag 秒之前，之后的数据留到下一轮
+    'replica_max_lag': 30,
+    # 每个从库健康检查（连接、复制延迟）的间隔（秒），0 表示不检查，只在连接失败时切换
+    'replica_check_interval': 10,
+    # 从库连接失败或者检查不通过之后，过这么多秒再重新尝试
+    'replica_retry_interval': 30,
+    # 没有可用的从库时改读主库，否则任务失败，下一轮重新同步
+    'replica_fallback': True,
+    # 数据库限流（所有进程共享）：每秒开始的查询数、每秒读取的行数、同时执行的语句数，0 表示不限制；
+    # 都在语句开始前等待，读取的行数超出预算时推迟下一条语句
+    'governor_queries_per_sec': 0,
+    'governor_rows_per_sec': 0,
+    'governor_max_statements': 0,
+    # 限流生效的时间段，比如 8-20 表示 8:00 到 20:00，22-6 跨零点，空字符串表示全天；其余时间全速同步
+    'governor_hours': '',
+    # 负载检查：none 不检查，threads_running 检查 Threads_running，replica_lag 检查从库延迟（DB 指向从库时）
+    'governor_check': 'none',
+    # 超过这些阈值时暂停开始新的查询，每 governor_check_interval 秒检查一次
+    'governor_max_threads_running': 32,
+    'governor_max_replica_lag': 30,
+    'governor_check_interval': 10,
+    # 守护模式（--daemon）两轮同步开始的间隔（秒）
+    'daemon_interval': 60,
+    # 回补（--backfill）期间目标索引的 refresh_interval 和副本数，结束后恢复原来的设置
+    'backfill_refresh_interval': '-1',
+    'backfill_replicas': 0,
+    # 回补时往前多调整几天的索引（索引按 article_extracted_time 划分，任务按 created_time 查询）
+    'backfill_margin_days': 1,
+    # 回补 --forcemerge 时每个分片合并到的段数
+    'backfill_max_segments': 1,
+    # 死信目录：bulk 最终失败的文档写到本地（相对本目录的路径），之后用 --replay 重新提交，
+    # 失败的文档都写入死信目录的任务算作完成，不再整段重新同步
+    'dead_letter': False,
+    'dead_letter_path': 'dead_letter',
+    # 死信段文件（压缩后）的大小上限（MB）
+    'dead_letter_segment_mb': 64,
+    # --replay 同时在途的 bulk 请求数
+    'dead_letter_replay_in_flight': 8,
+    # 监控指标文件的路径（相对本目录，不含扩展名），每次同步结束写 .prom 和 .json，空字符串表示不写
+    'metrics_path': 'sync_metrics',
+}
 mappings = {
     "mappings": {
         "properties": {
@@ -99,16 +250,180 @@ mappings = {
 }
 
 
+@per_process
 def get_es():
-    return Elasticsearch(['192.168.1.217', '192.168.1.218'])
+    # ES client 是线程安全的，一个进程内的所有线程共用一个实例
+    # 但不是进程安全的，每个进程各自创建
+    return Elasticsearch(es_hosts)
+
+
+@functools.lru_cache(maxsize=None)
+def get_config():
+    """读取 config.yml 配置，只读取一次"""
+    return yaml.load(open(cur_dir + '/config.yml', 'r'), Loader=yaml.FullLoader)
+
+
+def get_settings():
+    """
+    获取同步相关的设置，config.yml 中 SYNC 节点的配置会覆盖默认值
+    :return: dict
+    """
+    return {**default_settings, **(get_config().get('SYNC') or {})}
+
+
+def connect_db(db_config):
+    """
+    连接数据库
+    连接会放回连接池给之后的任务复用，必须是 autocommit：否则 InnoDB（REPEATABLE READ）下第一条 SELECT 开始的事务一直不结束，
+    之后的任务都读这个快照，读不到之后提交的记录，任务却照样标记完成
+    :param db_config: 连接配置，同 config.yml 的 DB 节点
+    """
+    conn = pymysql.connect(**{**db_config, 'autocommit': True}, cursorclass=pymysql.cursors.DictCursor)
+    net_write_timeout = get_settings()['db_net_write_timeout']
+    if net_write_timeout:
+        # 见 sync_task() 流式读取的说明
+        with conn.cursor() as cursor:
+            cursor.execute('SET SESSION net_write_timeout = %s', [net_write_timeout])
+    return conn
 
 
 def get_conn():
-    # 读取数据库配置
-    config = yaml.load(open(cur_dir + '/config.yml', 'r'), Loader=yaml.FullLoader)
-    # 连接数据库
-    db = pymysql.connect(**config['DB'], cursorclass=pymysql.cursors.DictCursor)
-    return db
+    """连接 config.yml 中 DB 配置的数据库（主库）"""
+    return connect_db(get_config()['DB'])
+
+
+def get_replica_configs():
+    """
+    config.yml 中 REPLICAS 配置的从库，每个从库没有配置的连接参数沿用 DB 的配置
+    :return: [(名称, 连接配置, 权重), ...]，没有配置从库时为空 list
+    """
+    config = get_config()
+    replicas = []
+    for entry in config.get('REPLICAS') or []:
+        entry = dict(entry)
+        weight = entry.pop('weight', 1)
+        db_config = {**config['DB'], **entry}
+        replicas.append(('%s:%s' % (db_config.get('host'), db_config.get('port', 3306)), db_config, weight))
+    return replicas
+
+
+def get_replica_lag(cursor):
+    """
+    查询复制延迟
+    :return: 延迟秒数，复制没有运行时为 None，不是从库时为 0
+    """
+    try:
+        cursor.execute('SHOW REPLICA STATUS')
+    except pymysql.err.ProgrammingError:
+        # MySQL 8.0.22 之前只有 SHOW SLAVE STATUS
+        cursor.execute('SHOW SLAVE STATUS')
+    r = cursor.fetchone()
+    if r is None:
+        return 0
+    return r.get('Seconds_Behind_Source', r.get('Seconds_Behind_Master'))
+
+
+def replica_check(db_configs, settings):
+    """
+    从库的健康检查函数，见 ReplicaRouter：能连上，复制在运行，延迟不超过 replica_max_lag 秒
+    :param db_configs: 各个从库的连接配置
+    """
+
+    def check(i):
+        try:
+            with contextlib.closing(connect_db(db_configs[i])) as db, db.cursor() as cursor:
+                lag = get_replica_lag(cursor)
+        except pymysql.MySQLError as e:
+            return False, str(e)
+        if lag is None:
+            return False, '复制没有运行'
+        return lag <= settings['replica_max_lag'], '复制延迟 %ss' % lag
+
+    return check
+
+
+@functools.lru_cache(maxsize=None)
+def get_router():
+    """从库路由，状态在共享内存里，要在启动子进程之前创建，所有进程共用；没有配置从库时返回 None"""
+    replicas = get_replica_configs()
+    if not replicas:
+        return None
+    settings = get_settings()
+    return ReplicaRouter(
+        [name for name, _, _ in replicas], [weight for _, _, weight in replicas],
+        check=replica_check([db_config for _, db_config, _ in replicas], settings)
+        if settings['replica_check_interval'] else None,
+        check_interval=settings['replica_check_interval'],
+        retry_interval=settings['replica_retry_interval'],
+    )
+
+
+def new_pool(governor=None):
+    """
+    新建一个数据库连接池，配置了从库时查询分到各个从库上，见 ReplicaPool
+    :param governor: 数据库限流，见 LoadGovernor
+    """
+    settings = get_settings()
+    router = get_router()
+    if router is None:
+        return ConnectionPool(get_conn, max_size=settings['db_pool_size'],
+                              ping_interval=settings['db_ping_interval'], governor=governor)
+    connects = [functools.partial(connect_db, db_config) for _, db_config, _ in get_replica_configs()]
+    return ReplicaPool(router, connects, fallback=get_conn if settings['replica_fallback'] else None,
+                       max_size=settings['db_pool_size'], ping_interval=settings['db_ping_interval'],
+                       governor=governor)
+
+
+@per_process
+def get_pool():
+    """当前进程的数据库连接池，借出的连接受数据库限流控制"""
+    return new_pool(get_governor())
+
+
+def db_load_check(settings):
+    """
+    数据库负载检查函数，见 LoadGovernor
+    :return: 函数，返回 (是否过载, 说明)；governor_check 为 none 时返回 None
+    """
+    mode = settings['governor_check']
+    if mode == 'none':
+        return None
+    if mode not in ('threads_running', 'replica_lag'):
+        raise ValueError('governor_check 只能是 none、threads_running 或 replica_lag：%s' % mode)
+
+    def check():
+        try:
+            with contextlib.closing(get_conn()) as db, db.cursor() as cursor:
+                if mode == 'threads_running':
+                    cursor.execute("SHOW GLOBAL STATUS LIKE 'Threads_running'")
+                    value = int(cursor.fetchone()['Value'])
+                    return value > settings['governor_max_threads_running'], 'Threads_running=%s' % value
+                lag = get_replica_lag(cursor)
+        except pymysql.MySQLError as e:
+            # 检查失败时不阻塞同步
+            logger.warning('检查数据库负载失败：%s' % e)
+            return False, str(e)
+        if lag is None:
+            logger.warning('从库的复制没有运行，不按延迟暂停读取')
+            return False, 'Seconds_Behind_Master=NULL'
+        return lag > settings['governor_max_replica_lag'], 'Seconds_Behind_Master=%s' % lag
+
+    return check
+
+
+@functools.lru_cache(maxsize=None)
+def get_governor():
+    """数据库限流，状态在共享内存里，要在启动子进程之前创建，所有进程共用"""
+    settings = get_settings()
+    return LoadGovernor(
+        queries_per_sec=settings['governor_queries_per_sec'],
+        rows_per_sec=settings['governor_rows_per_sec'],
+        max_statements=settings['governor_max_statements'],
+        slot_dir=os.path.join(cur_dir, 'db_slots'),
+        hours=settings['governor_hours'],
+        check=db_load_check(settings),
+        check_interval=settings['governor_check_interval'],
+    )
 
 
 def get_fields():
@@ -143,60 +458,782 @@ def get_fields():
     ]
 
 
-def list_chunk(lst, n):
+def estimate_table_rows():
+    """
+    从 information_schema 中估算各个 stat_article_subject_N 表的行数，只是统计信息，查询开销很小
+    :return: dict，表名 => 估算行数，查询失败时返回空 dict
+    """
+    try:
+        with contextlib.closing(get_conn()) as db, db.cursor() as cursor:
+            cursor.execute("""
+                SELECT TABLE_NAME, TABLE_ROWS FROM information_schema.TABLES
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME LIKE 'stat\\_article\\_subject\\_%'
+                """)
+            return {r['TABLE_NAME']: r['TABLE_ROWS'] or 0 for r in cursor.fetchall()}
+    except pymysql.MySQLError as e:
+        logger.warning('估算表行数失败，任务将不按大小排序：%s' % e)
+        return {}
+
+
+def order_tasks(tasks, table_rows):
+    """
+    按估算的行数从大到小排序任务，大任务先执行，避免最后剩下一个大任务拖慢整体
+    :param tasks: 任务 list
+    :param table_rows: 表名 => 估算行数，见 estimate_table_rows()，已经带有 estimate 的任务不再估算
+    :return: 排序后的任务 list，每个任务带上 estimate 估算行数
+    """
+    for task in tasks:
+        if 'estimate' in task:
+            continue
+        seconds = (datetime.datetime.strptime(task['end'], date_fmt) -
+                   datetime.datetime.strptime(task['start'], date_fmt)).total_seconds() + 1
+        # 没有按时间段的统计，按表的总行数乘以时间段长度估算相对大小
+        task['estimate'] = table_rows.get('stat_article_subject_' + task['tbl_index'], 0) * seconds
+    return sorted(tasks, key=lambda t: t['estimate'], reverse=True)
+
+
+def get_select(tbl_name, join=True):
+    """
+    组装查询的字段和表
+    :param join: 是否 LEFT JOIN article_operation，否则只查 sas.* 字段，操作字段由 OperationLookup 补全
+    """
+    if not join:
+        return f"""{','.join(f for f in get_fields() if f.startswith('sas.'))}
+        FROM
+            {tbl_name} sas"""
+    return f"""{','.join(get_fields())}
+        FROM 
+            {tbl_name} sas
+            LEFT JOIN article_operation ao ON sas.article_detail_id = ao.article_detail_id"""
+
+
+def get_sql(tbl_name, join=True, id_range=None):
+    """
+    组装同步查询的 SQL
+    :param tbl_name: stat_article_subject_N 表名
+    :param join: 是否 LEFT JOIN article_operation，见 get_select()
+    :param id_range: 只查 article_detail_id 在 [下界, 上界) 的记录，None 表示不限，见 split_task()
+    :return: SQL，参数为开始、结束时间，以及不为 None 的下界、上界，见 get_sql_args()
     """
-    将一个 List 分成 N 份
-    :param lst: 要拆分的 list
-    :param n: 拆分的份数
+    lower, upper = id_range or (None, None)
+    return f"""
+        /* Sync data 2 ES */
+        SELECT 
+            {get_select(tbl_name, join)}
+        WHERE
+            sas.created_time BETWEEN %s AND %s
+            {'AND sas.article_detail_id >= %s' if lower is not None else ''}
+            {'AND sas.article_detail_id < %s' if upper is not None else ''}
+        """
+
+
+def get_sql_args(task):
+    """get_sql() 的参数"""
+    return [task['start'], task['end']] + [v for v in task.get('id_range') or () if v is not None]
+
+
+def split_task(task, settings):
+    """
+    行数超过 range_split_rows 的任务按 article_detail_id 拆分成 range_split_parts 段，各段可以用不同的连接并发读取。
+    按 MIN、MAX 等宽拆分，第一段没有下界、最后一段没有上界，各段合起来和原任务是完全相同的记录
+    :return: 子任务 list，子任务带 id_range，不需要拆分时返回 None
+    """
+    threshold = settings['range_split_rows']
+    if not threshold or settings['range_split_parts'] < 2 or task.get('id_range'):
+        return None
+    # adaptive 拆分的任务带有按行数分布统计的 planned_rows，明显不够大的不用再查；
+    # estimate 只是排序用的相对大小（fixed 模式下是表行数乘以秒数），不能用来判断，其余任务都要 COUNT
+    if task.get('planned_rows', threshold) < threshold:
+        return None
+    tbl_name = 'stat_article_subject_' + task['tbl_index']
+    with get_pool().connection() as db, db.cursor() as cursor, \
+            metrics.timer('sync_stage_seconds', stage='range_split'):
+        cursor.execute(f"""
+            /* Sync data 2 ES (range split) */
+            SELECT COUNT(*) AS total, MIN(article_detail_id) AS lower, MAX(article_detail_id) AS upper
+            FROM {tbl_name}
+            WHERE created_time BETWEEN %s AND %s
+            """, [task['start'], task['end']])
+        r = cursor.fetchone()
+    parts = min(settings['range_split_parts'], (r['upper'] or 0) - (r['lower'] or 0) + 1)
+    if r['total'] < threshold or parts < 2:
+        return None
+
+    step = (r['upper'] - r['lower'] + 1) / parts
+    bounds = [None] + [r['lower'] + round(step * i) for i in range(1, parts)] + [None]
+    logger.debug('任务 %s 有 %s 条记录，按 article_detail_id 拆分为 %s 段：%s' % (task, r['total'], parts, bounds[1:-1]))
+    return [{**task, 'id_range': (bounds[i], bounds[i + 1])} for i in range(0, parts)]
+
+
+def merge_results(results):
+    """合并多个 bulk 提交结果，见 submit_bulk()"""
+    merged = {'success': 0, 'failed': 0, 'spooled': 0, 'errors': []}
+    for result in results:
+        for key in merged:
+            merged[key] += result.get(key, 0 if key != 'errors' else [])
+    return merged
+
+
+def get_keyset_sql(tbl_name, join=True):
+    """
+    组装 keyset 分页查询的 SQL，按 (created_time, subject_id, article_detail_id) 排序，
+    同一个 article_detail_id 会出现在多个专题下，只用 (created_time, article_detail_id) 不能唯一定位一条记录。
+    表上需要 (created_time, subject_id, article_detail_id) 的联合索引，每页才能沿着索引从高水位往后读 LIMIT 条；
+    没有的话每一页都要把高水位之后的记录全部排序一遍，读完一个时间段的开销是页数的平方，见 check_keyset_indexes()
+    :param tbl_name: stat_article_subject_N 表名
+    :param join: 是否 LEFT JOIN article_operation，见 get_select()
+    :return: SQL，参数见 get_keyset_args()
+    """
+    return f"""
+        /* Sync data 2 ES (keyset) */
+        SELECT 
+            {get_select(tbl_name, join)}
+        WHERE
+            sas.created_time >= %s AND sas.created_time < %s
+            AND (sas.created_time > %s OR (sas.created_time = %s AND (
+                sas.subject_id > %s OR (sas.subject_id = %s AND sas.article_detail_id > %s))))
+        ORDER BY sas.created_time, sas.subject_id, sas.article_detail_id
+        LIMIT %s
+        """
+
+
+def get_keyset_args(key, end, page_size):
+    """
+    get_keyset_sql() 的参数
+    :param key: 高水位 (created_time, subject_id, article_detail_id)，只读这之后的记录
+    :param end: 上界时间（不含）
+    :param page_size: 每页条数
+    """
+    created_time, subject_id, detail_id = key
+    return [created_time, end, created_time, created_time, subject_id, subject_id, detail_id, page_size]
+
+
+@functools.lru_cache(maxsize=None)
+def check_keyset_indexes():
+    """
+    检查 stat_article_subject_N 表是否都有 keyset 分页需要的 (created_time, subject_id, article_detail_id) 联合索引，
+    缺少时打印警告，见 get_keyset_sql()；守护模式下只检查一次
+    """
+    try:
+        with contextlib.closing(get_conn()) as db, db.cursor() as cursor:
+            cursor.execute("""
+                SELECT TABLE_NAME, INDEX_NAME, GROUP_CONCAT(COLUMN_NAME ORDER BY SEQ_IN_INDEX) AS index_columns
+                FROM information_schema.STATISTICS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME LIKE 'stat\\_article\\_subject\\_%'
+                GROUP BY TABLE_NAME, INDEX_NAME
+                """)
+            rows = cursor.fetchall()
+    except pymysql.MySQLError as e:
+        logger.warning('检查 keyset 分页的索引失败：%s' % e)
+        return
+    indexed = {r['TABLE_NAME'] for r in rows
+               if r['index_columns'].lower().startswith('created_time,subject_id,article_detail_id')}
+    missing = ['stat_article_subject_%s' % i for i in range(0, 100) if 'stat_article_subject_%s' % i not in indexed]
+    if missing:
+        logger.warning('%s 张表没有 (created_time, subject_id, article_detail_id) 联合索引，keyset 分页每页都要重新排序，'
+                       '时间段越长越慢：%s' % (len(missing), ', '.join(missing[:10]) + (' ...' if len(missing) > 10 else '')))
+
+
+def row_cursor(settings, stream=False):
+    """
+    读取记录用的游标类型
+    :param stream: 是否使用服务端游标
+    """
+    if settings['row_format'] == 'tuple':
+        return pymysql.cursors.SSCursor if stream else pymysql.cursors.Cursor
+    return pymysql.cursors.SSDictCursor if stream else pymysql.cursors.DictCursor
+
+
+def to_batch(cursor, rows):
+    """tuple 游标读出的记录按列存放到 RowBatch，dict 记录和空结果原样返回"""
+    if rows and isinstance(rows[0], tuple):
+        return RowBatch.from_rows([d[0] for d in cursor.description], rows)
+    return rows
+
+
+def iter_row_batches(cursor, fetch_size, on_batch=None):
+    """
+    从（服务端）游标中分批拉取记录
+    :param cursor: 已经 execute 的游标
+    :param fetch_size: 每次 fetchmany 的条数
+    :param on_batch: 每批记录返回之前的处理函数，比如补全操作字段
+    :return: 生成器，每次返回一批记录，dict 游标为 list，tuple 游标为 RowBatch
+    """
+    while True:
+        with metrics.timer('sync_stage_seconds', stage='db_fetch'):
+            rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            break
+        metrics.inc('sync_rows_read_total', len(rows))
+        # 只记账不等待：服务端游标还开着，停在这里语句会一直占着数据库线程，见 sync_governor
+        get_governor().rows(len(rows))
+        rows = to_batch(cursor, rows)
+        if on_batch is not None:
+            rows = on_batch(rows)
+        yield rows
+
+
+def iter_rows(cursor, fetch_size, on_batch=None):
+    """
+    从（服务端）游标中分批拉取记录，逐条返回，参数同 iter_row_batches()
     :return: 生成器
     """
-    list_len = len(lst)
-    chunk_size = math.ceil(list_len / n)
-    for i in range(0, list_len, chunk_size):
-        yield lst[i:i + chunk_size]
+    for rows in iter_row_batches(cursor, fetch_size, on_batch):
+        yield from rows
 
 
-def get_last_sync_time():
-    filename = cur_dir + '/last_sync_time.txt'
-    now = datetime.datetime.now()
+@functools.lru_cache(maxsize=65536)
+def format_datetime(value):
+    """日期转字符串，同一批数据里的时间大量重复（精确到秒），缓存格式化的结果"""
+    return value.strftime(date_fmt)
+
+
+def transform_batch(rows):
+    """
+    将一批数据库记录转换为 ES bulk 的 action（helpers 格式），按列处理日期字段，
+    索引名直接从格式化后的 article_extracted_time 截取，不再重复 strftime
+    :param rows: 数据库记录（dict）的 list 或 tuple，会被原地修改
+    :return: action 的 list
+    """
+    fmt = format_datetime
+    dt_type = datetime.datetime
+    with metrics.timer('sync_stage_seconds', stage='transform'):
+        # 日期转字符串
+        for date_field in date_fields:
+            for r in rows:
+                value = r[date_field]
+                if value.__class__ is dt_type:
+                    r[date_field] = fmt(value)
+
+        # 组成 Action & Meta 信息，合成 ID
+        return [{
+            "_index": 'kwm-list-' + r['article_extracted_time'][:10],
+            "_id": f"{r['client_id']}-{r['subject_id']}-{r['article_detail_id']}",
+            "_source": r,
+        } for r in rows]
+
+
+def transform_row_batch(batch):
+    """
+    转换按列存放的一批记录，日期按列格式化，action 在迭代时才生成
+    :param batch: RowBatch，会被原地修改
+    :return: LazyActions
+    """
+    fmt = format_datetime
+    dt_type = datetime.datetime
+    with metrics.timer('sync_stage_seconds', stage='transform'):
+        for date_field in date_fields:
+            column = batch.column(date_field)
+            column[:] = [fmt(value) if value.__class__ is dt_type else value for value in column]
+    return LazyActions(batch, iter_batch_actions)
+
+
+def iter_batch_actions(batch):
+    """逐个生成 RowBatch 的 action，_source 在这里才组装成 dict"""
+    names = batch.names
+    extracted = names.index('article_extracted_time')
+    client, subject, detail = names.index('client_id'), names.index('subject_id'), names.index('article_detail_id')
+    for row in batch.rows():
+        yield {
+            "_index": 'kwm-list-' + row[extracted][:10],
+            "_id": f"{row[client]}-{row[subject]}-{row[detail]}",
+            "_source": dict(zip(names, row)),
+        }
+
+
+def transform_rows(rows):
+    """按记录的格式转换一批记录，见 transform_batch()、transform_row_batch()"""
+    if isinstance(rows, RowBatch):
+        return transform_row_batch(rows)
+    return transform_batch(rows)
+
+
+def iter_actions(rows, batch_size=1000):
+    """
+    将数据库记录转换为 ES bulk 的 action（helpers 格式）
+    :param rows: 数据库记录（dict）的可迭代对象
+    :param batch_size: 每次批量转换的记录数
+    :return: 生成器
+    """
+    if isinstance(rows, (list, tuple)):
+        yield from transform_batch(rows)
+        return
 
-    end = now.strftime(date_fmt)
+    batch = []
+    for r in rows:
+        batch.append(r)
+        if len(batch) >= batch_size:
+            yield from transform_batch(batch)
+            batch = []
+    if batch:
+        yield from transform_batch(batch)
+
+
+@per_process
+def get_digests():
+    """当前进程的文档哈希存储"""
+    return DigestStore(cur_dir + '/sync_digest.db')
+
+
+@contextlib.contextmanager
+def change_filter(settings):
+    """
+    一次 bulk 提交的变化检测，见 DigestStore.submission()
+    :return: 上下文管理器，得到 (去掉内容没有变化的文档的函数, 文档写入成功后保存哈希的回调)；
+             没有开启变化检测时 actions 原样返回，回调为 None
+    """
+    if not settings['change_detection']:
+        yield (lambda actions: actions), None
+        return
+    with get_digests().submission() as (changed, on_item):
+        yield changed, on_item
+
+
+@per_process
+def get_bulk_controller():
+    """当前进程的 bulk 自适应控制，所有线程共享"""
+    settings = get_settings()
+    return BulkController(
+        in_flight=settings['bulk_in_flight'],
+        batch_size=settings['bulk_size'],
+        min_in_flight=settings['bulk_min_in_flight'],
+        max_in_flight=settings['bulk_max_in_flight'],
+        min_batch_size=settings['bulk_min_size'],
+        max_batch_size=settings['bulk_max_size'],
+        batch_step=settings['bulk_size_step'],
+        target_latency=settings['bulk_target_latency'],
+        backoff=settings['bulk_backoff'],
+        max_backoff=settings['bulk_max_backoff'],
+    )
+
+
+def bulk_controller(settings):
+    """开启了 bulk 自适应时返回当前进程的控制器"""
+    return get_bulk_controller() if settings['bulk_adaptive'] else None
+
+
+@per_process
+def get_spool():
+    """当前进程的死信目录"""
+    settings = get_settings()
+    return DeadLetterSpool(os.path.join(cur_dir, settings['dead_letter_path']),
+                           settings['dead_letter_segment_mb'] * 1024 * 1024)
+
+
+def dead_letter_spool(settings):
+    """开启了死信目录时返回当前进程的死信目录"""
+    return get_spool() if settings['dead_letter'] else None
+
+
+@per_process
+def get_lookup():
+    """
+    当前进程的 article_operation 批量查询，所有线程共用，查询结果只在一个任务内缓存
+    查询用单独的连接池：流式读取时游标一直占着连接，和读取共用一个池子会互相等待；
+    同样的原因这个池子不受数据库限流控制，补全查询跟着读取一批一次，由读取的限流带着放慢
+    """
+    settings = get_settings()
+    return OperationLookup(new_pool(), operation_fields, settings['operation_cache_size'])
+
+
+def operation_resolver(settings):
+    """
+    batch 模式下补全一批记录的操作字段的函数，每个任务调用一次，缓存只在这个任务内有效；
+    join 模式下 SQL 已经带上了操作字段，返回 None
+    """
+    return get_lookup().resolver() if settings['operation_lookup'] == 'batch' else None
+
+
+def ensure_indices(es, indices):
+    """检查索引，不存在就创建"""
+    for idx_name in indices:
+        exists = es.indices.exists(idx_name)
+        if not exists:
+            # 创建
+            es.indices.create(idx_name, mappings, ignore=400)
+
+
+class IndexCache:
+    """
+    已知存在的索引，进程内所有线程共享，每个索引一次运行最多检查一次
+
+    安装了 kwm-list-* 索引模板之后，按天的索引由 ES 在写入时按模板自动创建，不需要再检查
+    """
+
+    def __init__(self, index_mappings):
+        self.mappings = index_mappings
+        self.names = set()
+        self.template = False
+        self._lock = Lock()
+
+    def prepare(self, es):
+        """安装索引模板，并一次性取回已有的 kwm-list-* 索引，在启动子进程前调用"""
+        try:
+            es.indices.put_template(name=template_name, body={'index_patterns': ['kwm-list-*'], **self.mappings})
+            self.template = True
+        except TransportError as e:
+            logger.warning('安装索引模板 %s 失败，将逐个检查索引：%s' % (template_name, e))
+        try:
+            self.names.update(es.indices.get_alias(index='kwm-list-*').keys())
+        except TransportError as e:
+            logger.warning('获取已有索引失败：%s' % e)
+        logger.info('索引模板%s安装，已有 %s 个 kwm-list-* 索引' % ('已' if self.template else '未', len(self.names)))
+
+    def ensure(self, es, idx_name):
+        if idx_name in self.names:
+            return
+        with self._lock:
+            if idx_name in self.names:
+                return
+            if not self.template:
+                with metrics.timer('sync_stage_seconds', stage='index_check'):
+                    ensure_indices(es, [idx_name])
+            self.names.add(idx_name)
+
+
+index_cache = IndexCache(mappings)
+
+
+def sync_task(task, settings):
+    """
+    同步一个（表, 时间段）任务
+    :param task: 任务，包含 tbl_index、start、end
+    :param settings: 同步设置，见 get_settings()
+    :return: bulk 提交结果，见 submit_bulk()
+    """
+    subtasks = split_task(task, settings)
+    if subtasks:
+        # 各段在自己的线程里用各自的连接读取、提交，带上当前线程的指标标签
+        labels = metrics.current_labels()
+
+        def sync_range(subtask):
+            with metrics.labels(**labels):
+                return sync_task(subtask, settings)
+
+        with multiprocessing.pool.ThreadPool(len(subtasks)) as pool:
+            return merge_results(pool.map(sync_range, subtasks))
+
+    tbl_name = 'stat_article_subject_' + task['tbl_index']
+    resolve = operation_resolver(settings)
+    sql = get_sql(tbl_name, join=resolve is None, id_range=task.get('id_range'))
+    args = get_sql_args(task)
+
+    es = get_es()
+
+    def on_new_index(idx_name):
+        index_cache.ensure(es, idx_name)
+
+    if settings['read_mode'] == 'stream':
+        # 流式读取：服务端游标 + 分块 bulk，内存占用与时间段内的数据量无关
+        # 注意游标未读完之前，这个连接上不能执行其他查询。
+        # 读取跟着 bulk 提交走：ES 慢（背压、重试退避、bulk_timeout）时游标停着不读，服务端发送结果被阻塞，
+        # 超过 net_write_timeout 会中断查询，所以连接上设置了足够大的 db_net_write_timeout，见 connect_db()。
+        # 中途出错退出时，关闭游标要把这个时间段剩下的结果读完（MySQL 协议没法中途停止发送），大任务可以用 range_split_rows 拆小
+        _start = time.time()
+        with get_pool().connection() as db, db.cursor(row_cursor(settings, stream=True)) as cursor, \
+                change_filter(settings) as (changed, on_item):
+            with metrics.timer('sync_stage_seconds', stage='db_query'):
+                cursor.execute(sql, args)
+            batches = iter_row_batches(cursor, settings['fetch_size'], resolve)
+            actions = (action for rows in batches for action in transform_rows(rows))
+            result = submit_bulk(es, changed(actions), settings, on_new_index, on_item, bulk_controller(settings),
+                                 dead_letter_spool(settings))
+        logger.debug("从 %s 表流式同步 %s 条记录，失败 %s 条，耗时 %.2fs" % (
+            tbl_name, result['success'] + result['failed'], result['failed'], time.time() - _start))
+        return result
+
+    # 获取查询数据
+    with get_pool().connection() as db, db.cursor(row_cursor(settings)) as cursor:
+        _db_start = time.time()
+        with metrics.timer('sync_stage_seconds', stage='db_fetch'):
+            cursor.execute(sql, args)
+            rst = to_batch(cursor, cursor.fetchall())
+        metrics.inc('sync_rows_read_total', len(rst))
+        get_governor().rows(len(rst))
+        logger.debug("从数据库获 %s 表取得 %s 条记录，耗时 %.2fs" % (tbl_name, len(rst), time.time() - _db_start))
+    if resolve is not None:
+        rst = resolve(rst)
+
+    # 处理数据
+    _ps_start = time.time()
+    actions = transform_rows(rst)
+    logger.debug("处理数据库取出数据 %s 条记录，耗时 %.2fs" % (len(rst), time.time() - _ps_start))
+
+    _es_start = time.time()
+    with change_filter(settings) as (changed, on_item):
+        result = submit_bulk(es, changed(actions), settings, on_new_index, on_item, bulk_controller(settings),
+                             dead_letter_spool(settings))
+    logger.debug("提交 ES 索引 %s 条记录，失败 %s 条，耗时 %.2fs" % (len(rst), result['failed'], time.time() - _es_start))
+    return result
+
+
+def read_task_batches(task, settings):
+    """
+    流式读取一个（表, 时间段）任务的记录
+    :return: 生成器，每次返回 fetch_size 条记录，见 iter_row_batches()
+    """
+    subtasks = split_task(task, settings)
+    if subtasks:
+        yield from read_ranges(subtasks, settings)
+        return
+
+    tbl_name = 'stat_article_subject_' + task['tbl_index']
+    resolve = operation_resolver(settings)
+    with get_pool().connection() as db, db.cursor(row_cursor(settings, stream=True)) as cursor:
+        with metrics.timer('sync_stage_seconds', stage='db_query'):
+            cursor.execute(get_sql(tbl_name, join=resolve is None, id_range=task.get('id_range')), get_sql_args(task))
+        yield from iter_row_batches(cursor, settings['fetch_size'], resolve)
+
+
+def read_ranges(subtasks, settings):
+    """
+    每段一个线程并发读取，合并成一个生成器，读取线程的异常在这里重新抛出
+    :param subtasks: split_task() 拆分出来的子任务
+    :return: 生成器，同 read_task_batches()
+    """
+    batches = queue.Queue(len(subtasks) * 2)
+    stop = threading.Event()
+    finished = object()
+    labels = metrics.current_labels()
+
+    def put(item):
+        # 消费方提前退出时不再阻塞，读取线程结束后归还连接
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def read(subtask):
+        try:
+            with metrics.labels(**labels):
+                for rows in read_task_batches(subtask, settings):
+                    put(rows)
+                    if stop.is_set():
+                        break
+        except Exception as e:
+            put(e)
+        finally:
+            put(finished)
+
+    threads = [Thread(target=read, args=(subtask,), name=f'{current_thread().name}-range-{i}')
+               for i, subtask in enumerate(subtasks)]
+    for t in threads:
+        t.start()
     try:
-        r = open(filename, mode='r')
-        start = r.readline()
-        datetime.datetime.strptime(start, date_fmt)
-    except:
-        start = now.strftime('%Y-%m-%d 00:00:00')
+        remaining = len(threads)
+        while remaining:
+            item = batches.get()
+            if item is finished:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
     finally:
-        w = open(filename, 'w')
-        w.write(end)
-        w.flush()
+        stop.set()
+        for t in threads:
+            t.join()
 
-    return {
-        'start': start,
-        'end': end
-    }
 
+def sync_keyset_task(task, settings):
+    """
+    按表的高水位分页增量同步一张表，每页写入成功后推进高水位
+    :param task: 任务，包含 tbl_index、start（没有高水位时的起点）、end（上界，不含）
+    :param settings: 同步设置，见 get_settings()
+    :return: bulk 提交结果，见 submit_bulk()
+    """
+    tbl_name = 'stat_article_subject_' + task['tbl_index']
+    resolve = operation_resolver(settings)
+    sql = get_keyset_sql(tbl_name, join=resolve is None)
+    page_size = settings['page_size']
+    checkpoint = get_checkpoint()
+    es = get_es()
+
+    def on_new_index(idx_name):
+        index_cache.ensure(es, idx_name)
 
-def main():
-    _task_start_time = time.time()
-    # 时间分段间隔
-    part_offset = 3600 * 1
-    # 启动的线程数量
-    thread_count = 5
-    # CPU 核数
-    cpu_count = math.ceil(multiprocessing.cpu_count() / 2)
-    tasks = list()
+    key = checkpoint.get_hwm(task['tbl_index']) or (task['start'], -1, -1)
+    total = {'success': 0, 'failed': 0, 'spooled': 0, 'errors': []}
+    while True:
+        _db_start = time.time()
+        with get_pool().connection() as db, db.cursor(row_cursor(settings)) as cursor, \
+                metrics.timer('sync_stage_seconds', stage='db_fetch'):
+            cursor.execute(sql, get_keyset_args(key, task['end'], page_size))
+            rows = to_batch(cursor, cursor.fetchall())
+        metrics.inc('sync_rows_read_total', len(rows))
+        get_governor().rows(len(rows))
+        logger.debug("从 %s 表 %s 之后取得 %s 条记录，耗时 %.2fs" % (tbl_name, key, len(rows), time.time() - _db_start))
+        if not rows:
+            break
+        if resolve is not None:
+            rows = resolve(rows)
 
-    date_range = get_last_sync_time()
-    start = date_range['start']
-    end = date_range['end']
+        # 转换会把日期转成字符串，先记下最后一条的排序键
+        last = rows[-1]
+        next_key = (last['created_time'].strftime(date_fmt), last['subject_id'], last['article_detail_id'])
+
+        with change_filter(settings) as (changed, on_item):
+            result = submit_bulk(es, changed(transform_rows(rows)), settings, on_new_index, on_item,
+                                 bulk_controller(settings), dead_letter_spool(settings))
+        total['success'] += result['success']
+        total['failed'] += result['failed']
+        total['spooled'] += result['spooled']
+        total['errors'] += result['errors']
+        if result['failed'] > result['spooled']:
+            # 有没写入死信目录的失败就不推进高水位，下次从这一页重新开始
+            break
+
+        checkpoint.set_hwm(task['tbl_index'], next_key)
+        key = next_key
+        if len(rows) < page_size:
+            break
+    return total
+
+
+def get_operation_sql(tbl_name):
+    """
+    组装 article_operation 变更的查询 SQL，从 article_operation 按 user_last_process_time 范围驱动
+    :param tbl_name: stat_article_subject_N 表名
+    :return: SQL，参数为开始时间（含）、结束时间（不含）
+    """
+    return f"""
+        /* Sync article_operation 2 ES */
+        SELECT 
+            sas.client_id, sas.subject_id, sas.article_detail_id, sas.article_extracted_time,
+            {','.join('ao.' + f for f in operation_fields)}
+        FROM 
+            article_operation ao
+            JOIN {tbl_name} sas ON sas.article_detail_id = ao.article_detail_id
+        WHERE
+            ao.user_last_process_time >= %s AND ao.user_last_process_time < %s
+        """
+
+
+def iter_operation_actions(rows):
+    """
+    将 article_operation 的变更转换为只带操作字段的 update action
+    :param rows: 数据库记录（dict）的可迭代对象
+    :return: 生成器
+    """
+    for r in rows:
+        doc = {f: r[f] for f in operation_fields}
+        if doc['user_last_process_time'].__class__ is datetime.datetime:
+            doc['user_last_process_time'] = format_datetime(doc['user_last_process_time'])
+        yield {
+            '_op_type': 'update',
+            '_index': 'kwm-list-' + format_datetime(r['article_extracted_time'])[:10],
+            '_id': f"{r['client_id']}-{r['subject_id']}-{r['article_detail_id']}",
+            'doc': doc,
+        }
+
+
+def sync_operation_table(tbl_idx, start, end, settings):
+    """
+    把一张表在 [start, end) 之间有操作变更的文档局部更新到 ES
+    文档还没同步到 ES 时返回 404，这些文档之后全量同步时会带上最新的操作字段，不算失败
+    :return: bulk 提交结果，见 submit_bulk()，另外 missing 为不存在的文档数
+    """
+    tbl_name = f'stat_article_subject_{tbl_idx}'
+    with get_pool().connection() as db, db.cursor(pymysql.cursors.SSDictCursor) as cursor:
+        cursor.execute(get_operation_sql(tbl_name), [start, end])
+        rows = iter_rows(cursor, settings['fetch_size'])
+        # 只更新已有的文档，不需要检查、创建索引
+        result = submit_bulk(get_es(), iter_operation_actions(rows), settings, None, None,
+                             bulk_controller(settings), expected_status=(404,))
+    result['missing'] = result.pop('expected')
+    return result
+
+
+def operations(thread_count=5):
+    """
+    article_operation 变更同步的入口，由 cron 每分钟调用，上一次还没结束时跳过，避免同时推进 operation_watermark
+    """
+    with run_lock('operations') as locked:
+        if not locked:
+            logger.warning('上一次操作变更同步还没有结束，跳过本次')
+            return
+        sync_operations(thread_count)
+
+
+def sync_operations(thread_count=5):
+    """
+    article_operation 的变更同步：按 user_last_process_time 找出有操作变更的文档，
+    只局部更新操作相关的字段，不需要重新读取、索引整个文档
+    """
+    _start = time.time()
+    settings = get_settings()
+    checkpoint = get_checkpoint()
+    start = checkpoint.get('operation_watermark') or get_last_sync_time()
+    end = sync_end_time(settings)
+    if end <= start:
+        return
+
+    def sync_table(tbl_idx):
+        try:
+            return sync_operation_table(tbl_idx, start, end, settings)
+        except Exception as e:
+            logger.exception('同步 stat_article_subject_%s 的操作变更失败：%s' % (tbl_idx, e))
+            return None
+
+    with multiprocessing.pool.ThreadPool(thread_count) as pool:
+        results = pool.map(sync_table, range(0, 100))
+
+    ok = all(r is not None and r['failed'] == 0 for r in results)
+    results = [r for r in results if r is not None]
+    logger.info('同步操作变更【%s, %s)，更新 %s 条，文档不存在 %s 条，失败 %s 条，耗时 %.2fs' % (
+        start, end, sum(r['success'] for r in results), sum(r['missing'] for r in results),
+        sum(r['failed'] for r in results), time.time() - _start))
+    # 全部成功才推进，否则下次从同一个时间重新同步（局部更新是幂等的）
+    if ok:
+        checkpoint.set('operation_watermark', end)
+
+
+def sync_end_time(settings):
+    """
+    本次同步到的时间：当前时间，从从库读取时往前退 replica_max_lag 秒，
+    使用中的从库最多落后这么多，更新的数据可能还没复制过来，留到下一轮，不能被水位跳过
+    """
+    end = datetime.datetime.now()
+    if get_router() is not None:
+        end -= datetime.timedelta(seconds=settings['replica_max_lag'])
+    return end.strftime(date_fmt)
+
+
+def get_last_sync_time():
+    """
+    读取上次同步到的时间，只读不写，进度由检查点在任务完成后推进
+    :return: 时间字符串，读取失败时返回当天零点
+    """
+    filename = cur_dir + '/last_sync_time.txt'
+    try:
+        with open(filename, mode='r') as r:
+            start = r.readline().strip()
+        datetime.datetime.strptime(start, date_fmt)
+    except (OSError, ValueError):
+        start = datetime.datetime.now().strftime('%Y-%m-%d 00:00:00')
+    return start
+
+
+def save_last_sync_time(value):
+    """原子地写入 last_sync_time.txt，保留这个文件方便人工查看进度"""
+    filename = cur_dir + '/last_sync_time.txt'
+    with open(filename + '.tmp', 'w') as w:
+        w.write(value)
+        w.flush()
+        os.fsync(w.fileno())
+    os.replace(filename + '.tmp', filename)
 
-    # todo 现在没有容错机制，如果失败了，进度还是往前走的
-    start_date = datetime.datetime.strptime(start, date_fmt)
-    end_date = datetime.datetime.strptime(end, date_fmt)
 
-    logger.info('开始同步，本次同步时间区间：【%s, %s】，任务拆分间隔 %ss, 启动 %s 个进程，%s 个线程' % (start, end, part_offset, cpu_count, thread_count))
+def plan_tasks(start_date, end_date, part_offset):
+    """
+    把时间区间 [start_date, end_date) 按 part_offset 秒拆分，再乘以 100 张表得到任务
+    :return: 任务 list，任务的 end 是包含在内的（BETWEEN）
+    """
+    tasks = list()
+    if end_date <= start_date:
+        return tasks
 
     second_offset = (end_date - start_date).total_seconds()
     times = 1
@@ -218,107 +1255,833 @@ def main():
 
         for tbl_idx in range(0, 100):
             tasks.append({"tbl_index": f'{tbl_idx}', **task})
+    return tasks
 
-    logger.info('本次同步拆分为 %s 个任务' % len(tasks))
 
-    def sync_process(task_chunk):
+def count_rows(tbl_name, start_date, end_date, bucket):
+    """
+    按时间桶统计一张表在 [start_date, end_date) 之间的行数，只走 created_time 索引，不回表
+    :param bucket: 桶的秒数，桶从 start_date 开始对齐
+    :return: dict，桶序号 => 行数，没有数据的桶不返回
+    """
+    sql = f"""
+        /* Sync data 2 ES (plan) */
+        SELECT TIMESTAMPDIFF(SECOND, %s, sas.created_time) DIV %s AS bucket, COUNT(*) AS cnt
+        FROM {tbl_name} sas
+        WHERE sas.created_time >= %s AND sas.created_time < %s
+        GROUP BY bucket
+        """
+    start, end = start_date.strftime(date_fmt), end_date.strftime(date_fmt)
+    with get_pool().connection() as db, db.cursor() as cursor:
+        cursor.execute(sql, [start, bucket, start, end])
+        return {r['bucket']: r['cnt'] for r in cursor.fetchall()}
+
+
+def plan_windows(tbl_name, start_date, end_date, target_rows, buckets=(3600, 60)):
+    """
+    按估算的行数把 [start_date, end_date) 拆成若干个时间段：
+    超过目标行数的桶用更小的桶递归拆分，相邻的少量或空的桶合并到一起
+    :param buckets: 逐级使用的桶的秒数
+    :return: [(开始, 结束（不含）, 估算行数), ...]，首尾相接覆盖整个区间
+    """
+    bucket = buckets[0]
+    counts = count_rows(tbl_name, start_date, end_date, bucket)
+    windows = []
+    cur_start, cur_rows = start_date, 0
+    b_start = start_date
+    i = 0
+    while b_start < end_date:
+        b_end = min(b_start + datetime.timedelta(seconds=bucket), end_date)
+        n = counts.get(i, 0)
+        if n > target_rows and len(buckets) > 1:
+            # 重的桶单独再拆
+            if cur_start < b_start:
+                windows.append((cur_start, b_start, cur_rows))
+            windows += plan_windows(tbl_name, b_start, b_end, target_rows, buckets[1:])
+            cur_start, cur_rows = b_end, 0
+        elif cur_rows + n > target_rows and cur_start < b_start:
+            windows.append((cur_start, b_start, cur_rows))
+            cur_start, cur_rows = b_start, n
+        else:
+            cur_rows += n
+        b_start = b_end
+        i += 1
+    if cur_start < end_date:
+        windows.append((cur_start, end_date, cur_rows))
+    return windows
+
+
+def plan_adaptive_tasks(start_date, end_date, target_rows, thread_count):
+    """
+    按每张表的行数分布拆分任务，每个任务大约 target_rows 行
+    :return: 任务 list，带有统计出来的行数 planned_rows，以及同样数值的 estimate 用于排序
+    """
+    if end_date <= start_date:
+        return []
+
+    def plan_table(tbl_idx):
+        tbl_name = f'stat_article_subject_{tbl_idx}'
+        return [{
+            'tbl_index': f'{tbl_idx}',
+            'start': w_start.strftime(date_fmt),
+            'end': (w_end - datetime.timedelta(seconds=1)).strftime(date_fmt),
+            'planned_rows': rows,
+            'estimate': rows,
+        } for w_start, w_end, rows in plan_windows(tbl_name, start_date, end_date, target_rows)]
+
+    _start = time.time()
+    with multiprocessing.pool.ThreadPool(thread_count) as pool:
+        tasks = [t for table_tasks in pool.map(plan_table, range(0, 100)) for t in table_tasks]
+
+    rows = [t['estimate'] for t in tasks]
+    logger.info('按行数拆分任务耗时 %.2fs：%s 个任务，共约 %s 行，单个任务最多 %s 行，平均 %.0f 行' % (
+        time.time() - _start, len(tasks), sum(rows), max(rows), sum(rows) / len(tasks)))
+    for t in tasks:
+        logger.debug('任务计划：%s' % t)
+    return tasks
+
+
+@functools.lru_cache(maxsize=None)
+def get_checkpoint():
+    """检查点存储，子进程中使用时会自动重新打开连接"""
+    return CheckpointStore(cur_dir + '/sync_checkpoint.db')
+
+
+class WorkerPool:
+    """
+    常驻的同步进程：每个进程启动后一直保留数据库连接池、ES 客户端和各种缓存，一轮一轮地执行任务，
+    守护模式下每一轮不用重新 fork 进程、建立连接
+    :param settings: 同步设置，见 get_settings()
+    :param cpu_count: 进程数
+    :param thread_count: 每个进程的线程数
+    :param pipeline: 每个进程内用 读取 -> 转换 -> 写入 的流水线代替每个线程串行执行任务
+    :param stop: threading.Event，设置之后不再开始新的任务，等已经开始的任务写完就返回
+    """
+
+    def __init__(self, settings, cpu_count, thread_count, pipeline=False, stop=None):
+        self.settings = settings
+        self.cpu_count = cpu_count
+        self.thread_count = thread_count
+        self.pipeline = pipeline
+        self.stop = stop or threading.Event()
+        # 所有进程共享一个任务队列，哪个线程空闲就取下一个任务，不再按进程静态分片；
+        # 队列里是 (序号, 任务)，序号在各轮之间不重复，上一轮遗留的事件不会算到这一轮
+        self._task_queue = multiprocessing.Queue()
+        self._seq = itertools.count()
+        # 任务开始、结束的事件：(start / done, 进程 ID, 任务序号)
+        self._event_queue = multiprocessing.Queue()
+        # 每一轮结束时各个进程上报的统计
+        self._report_queue = multiprocessing.Queue()
+        self._processes = {}
+
+    def start(self):
+        # 数据库限流、从库路由的共享状态在 fork 之前创建
+        get_governor()
+        get_router()
+        for _ in range(0, self.cpu_count):
+            self._spawn()
+        return self
+
+    def _spawn(self):
+        control_queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=self._sync_process, args=(control_queue, os.getpid()))
+        p.start()
+        self._processes[p.pid] = (p, control_queue)
+
+    def _replace_dead(self):
+        for pid, (p, _) in list(self._processes.items()):
+            if not p.is_alive():
+                logger.error('同步进程 %s 意外退出（exitcode=%s），重新启动一个' % (pid, p.exitcode))
+                del self._processes[pid]
+                self._spawn()
+
+    def _sync_process(self, control_queue, parent_pid):
+        settings = self.settings
+        keyset = settings['extract_mode'] == 'keyset'
+        checkpoint = get_checkpoint()
+        task_queue, event_queue = self._task_queue, self._event_queue
+        pid = os.getpid()
+        # 信号只由主进程处理，主进程会等正在执行的任务写完再让子进程退出
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        report = {'docs': 0, 'failed': 0, 'spooled': 0}
+        report_lock = Lock()
+        # fork 时带过来的是父进程的指标，子进程只上报自己的
+        metrics.reset()
+        get_governor().stats.update(dict.fromkeys(get_governor().stats, 0))
+
+        def finish_task(_task, seq, result, error, seconds):
+            spooled = result.get('spooled', 0)
+            ok = error is None and result['failed'] == spooled
+            with report_lock:
+                report['docs'] += result['success']
+                report['failed'] += result['failed']
+                report['spooled'] += spooled
+            # 全部写入成功（失败的都写入了死信目录）才算完成，否则下次运行重做
+            if ok and not keyset:
+                checkpoint.mark_done(_task, result['success'])
+            metrics.observe('sync_task_seconds', seconds)
+            metrics.inc('sync_tasks_total', status='ok' if ok else 'failed')
+            event_queue.put(('done', pid, seq))
 
         def sync_thread():
             while True:
                 # 获取任务
-                if len(task_chunk) == 0:
+                item = task_queue.get()
+                if item is None:
                     break
 
-                _task = task_chunk.pop()
-                logger.info('还剩 %s 个任务，当前任务%s' % (len(task_chunk), _task))
-                tbl_name = 'stat_article_subject_' + _task['tbl_index']
-                start_time = _task['start']
-                end_time = _task['end']
-
-                sql = f"""
-                    /* Sync data 2 ES */
-                    SELECT 
-                        {','.join(get_fields())}
-                    FROM 
-                        {tbl_name} sas
-                        LEFT JOIN article_operation ao ON sas.article_detail_id = ao.article_detail_id
-                    WHERE
-                        sas.created_time BETWEEN %s AND %s
-                    """
-
-                # 获取数据库链接
-                db = get_conn()
-                # 获取查询数据
-                with db.cursor() as cursor:
-                    _db_start = time.time()
-                    cursor.execute(sql, [start_time, end_time])
-                    rst = cursor.fetchall()
-                    logger.debug("从数据库获 %s 表取得 %s 条记录，耗时 %.2fs" % (tbl_name, len(rst), time.time() - _db_start))
-
-                # 处理数据
-                _ps_start = time.time()
-                indices = set()
-                index_data = []
-                for r in rst:
-                    # 获取索引名称
-                    idx_name = f"kwm-list-{r['article_extracted_time'].strftime('%Y-%m-%d')}"
-                    indices.add(idx_name)
-
-                    # 合成 ID
-                    _id = f"{r['client_id']}-{r['subject_id']}-{r['article_detail_id']}"
-                    # 组成 Action & Meta 信息
-                    index_data.append({'index': {"_index": idx_name, "_id": _id}})
-
-                    # 日期转字符串
-                    for date_field in ('article_extracted_time', 'article_pubtime',
-                                       'created_time', 'user_last_process_time'):
-                        if isinstance(r[date_field], datetime.datetime):
-                            r[date_field] = r[date_field].strftime('%Y-%m-%d %H:%M:%S')
-
-                    index_data.append(r)
-                logger.debug("处理数据库取出数据 %s 条记录，耗时 %.2fs" % (len(rst), time.time() - _ps_start))
-
-                # 获取 ES 客户端
-                # ES client 是线程安全的，可以为多个线程设置一个全局的实例
-                # 但不是进程安全的，多个进程要设置多个实例
-                _es_start = time.time()
-                es = get_es()
-
-                # 检查索引，不存在就创建
-                for idx_name in indices:
-                    exists = es.indices.exists(idx_name)
-                    if not exists:
-                        # 创建
-                        es.indices.create(idx_name, mappings, ignore=400)
-
-                # print(json.dumps(index_data, indent=True))
-                if len(index_data) > 0:
-                    resp = es.bulk(body=index_data, request_timeout=300)
-                logger.debug("提交 ES 索引 %s 条记录，耗时 %.2fs" % (len(rst), time.time() - _es_start))
-
-        # 启动线程
-        threads = []
-        for j in range(0, thread_count):
-            # t = SyncTask(task_chunk=task_chunk, name=f'Thread-{j}')
-            t = Thread(target=sync_thread, name=f'Thread-{j}')
-            t.start()
-            threads.append(t)
+                seq, _task = item
+                event_queue.put(('start', pid, seq))
+                logger.info('当前任务%s' % _task)
+                _start = time.time()
+                result, error = {'success': 0, 'failed': 0}, None
+                try:
+                    with metrics.labels(table='stat_article_subject_' + _task['tbl_index']):
+                        if keyset:
+                            result = sync_keyset_task(_task, settings)
+                        else:
+                            result = sync_task(_task, settings)
+                except Exception as e:
+                    logger.exception('任务 %s 同步失败：%s' % (_task, e))
+                    error = e
+                finish_task(_task, seq, result, error, time.time() - _start)
 
-        for t in threads:
-            t.join()
+        # 流水线模式下任务的序号和开始时间
+        started = {}
 
-    # 开启进程处理
-    processes = []
-    for t_chunk in list(list_chunk(tasks, cpu_count)):
-        p = multiprocessing.Process(target=sync_process, args=(t_chunk, ))
-        p.start()
-        processes.append(p)
+        def next_task():
+            item = task_queue.get()
+            if item is None:
+                return None
+            seq, _task = item
+            event_queue.put(('start', pid, seq))
+            started[id(_task)] = (seq, time.time())
+            return _task
+
+        def on_task_done(_task, result, error):
+            seq, _start = started.pop(id(_task))
+            finish_task(_task, seq, result, error, time.time() - _start)
+
+        def write_batch(actions):
+            es = get_es()
+            # 写入线程本身就是并发的，每批只用一个请求
+            with change_filter(settings) as (changed, on_item):
+                return submit_bulk(es, changed(actions), {**settings, 'bulk_in_flight': 1},
+                                   lambda idx_name: index_cache.ensure(es, idx_name), on_item,
+                                   bulk_controller(settings), dead_letter_spool(settings))
+
+        def take_report():
+            """取出这一轮的统计，并清零，下一轮重新统计"""
+            with report_lock:
+                taken = {**report, 'es_clients': 1}
+                report.update(docs=0, failed=0, spooled=0)
+            stats = [('', get_pool().stats)]
+            if settings['dead_letter']:
+                # 这一轮写的死信可以重放了
+                get_spool().seal()
+            if settings['change_detection']:
+                get_digests().flush()
+                stats.append(('', get_digests().stats))
+            if settings['bulk_adaptive']:
+                stats.append(('bulk_', get_bulk_controller().stats))
+            if get_governor().enabled:
+                stats.append(('governor_', get_governor().stats))
+            if settings['operation_lookup'] == 'batch':
+                stats.append(('operation_', get_lookup().stats))
+            for prefix, values in stats:
+                for k in values:
+                    taken[prefix + k] = values[k]
+                    values[k] = 0
+            taken['metrics'] = metrics.snapshot()
+            metrics.reset()
+            return taken
+
+        def control():
+            while True:
+                try:
+                    command = control_queue.get(timeout=5)
+                except queue.Empty:
+                    # 主进程被强制杀掉时不再等待新的任务
+                    if os.getppid() != parent_pid:
+                        logger.error('主进程已经退出，同步进程 %s 退出' % pid)
+                        os._exit(1)
+                    continue
+                if command is None:
+                    break
+                self._report_queue.put(take_report())
+
+        control_thread = Thread(target=control, name='Control', daemon=True)
+        control_thread.start()
+        if self.pipeline:
+            Pipeline(
+                read=lambda _task: read_task_batches(_task, settings),
+                transform=transform_rows,
+                write=write_batch,
+                on_task_done=on_task_done,
+                readers=settings['pipeline_readers'],
+                transformers=settings['pipeline_transformers'],
+                writers=settings['pipeline_writers'],
+                queue_size=settings['pipeline_queue_size'],
+                log_interval=settings['pipeline_log_interval'],
+                context=lambda _task: metrics.labels(table='stat_article_subject_' + _task['tbl_index']),
+            ).run(next_task)
+        else:
+            # 启动线程
+            threads = []
+            for j in range(0, self.thread_count):
+                t = Thread(target=sync_thread, name=f'Thread-{j}')
+                t.start()
+                threads.append(t)
+
+            for t in threads:
+                t.join()
+        control_thread.join()
+
+        # 清理连接
+        get_pool().close()
+        get_es().transport.close()
+        if settings['change_detection']:
+            get_digests().flush()
+        if settings['operation_lookup'] == 'batch':
+            get_lookup().pool.close()
+        if settings['dead_letter']:
+            get_spool().seal()
+
+    def _drain(self):
+        """取出还没有开始的任务，返回取出的任务序号 list"""
+        drained = []
+        while True:
+            try:
+                item = self._task_queue.get(timeout=0.1)
+            except queue.Empty:
+                return drained
+            if item is not None:
+                drained.append(item[0])
+
+    def run(self, tasks):
+        """
+        执行一轮任务，等所有任务结束（或者 stop 之后已经开始的任务结束）再返回
+        :return: 每个进程上报的这一轮的统计 list
+        """
+        self._replace_dead()
+        # 还没有开始的任务，序号 => 任务
+        pending = {}
+        for _task in tasks:
+            seq = next(self._seq)
+            pending[seq] = _task
+            self._task_queue.put((seq, _task))
+
+        # 各个进程正在执行的任务，进程 ID => {序号: 任务}
+        running = collections.defaultdict(dict)
+        dead = set()
+        done = 0
+        stopped = False
+        while pending or any(running.values()):
+            if self.stop.is_set() and not stopped:
+                stopped = True
+                drained = self._drain()
+                for seq in drained:
+                    pending.pop(seq, None)
+                logger.warning('停止同步，跳过 %s 个还没开始的任务，等待 %s 个正在执行的任务完成' % (
+                    len(drained), len(pending) + sum(map(len, running.values()))))
+                continue
+            try:
+                kind, pid, seq = self._event_queue.get(timeout=1)
+            except queue.Empty:
+                self._reap(pending, running, dead)
+                if not any(p.is_alive() for p, _ in self._processes.values()):
+                    logger.error('所有同步进程都已经退出')
+                    break
+                continue
+            if kind == 'start':
+                if seq in pending:
+                    running[pid][seq] = pending.pop(seq)
+                continue
+            if running[pid].pop(seq, None) is None:
+                continue
+            done += 1
+            logger.info('已完成 %s/%s 个任务' % (done, len(tasks)))
+
+        # 先取上报再做别的：上报的指标比较大，子进程要等数据写进管道才能继续
+        alive = [(p, control_queue) for p, control_queue in self._processes.values() if p.is_alive()]
+        for _, control_queue in alive:
+            control_queue.put('report')
+        reports = []
+        while len(reports) < len(alive):
+            try:
+                reports.append(self._report_queue.get(timeout=1))
+            except queue.Empty:
+                if not any(p.is_alive() for p, _ in alive):
+                    break
+        return reports
+
+    def _reap(self, pending, running, dead):
+        """
+        进程意外退出时，它正在执行的任务不会再有结果，按失败处理（不标记完成，下一轮重做）
+        :param pending: 还没有开始的任务，见 run()
+        :param running: 各个进程正在执行的任务，见 run()
+        :param dead: 这一轮已经处理过的退出的进程 ID set
+        """
+        for pid, (p, _) in self._processes.items():
+            if p.is_alive() or pid in dead:
+                continue
+            dead.add(pid)
+            lost = running.pop(pid, {})
+            logger.error('同步进程 %s 意外退出（exitcode=%s），%s 个正在执行的任务按失败处理：%s' % (
+                pid, p.exitcode, len(lost), list(lost.values())))
+        # 进程可能在取出任务之后、上报开始之前退出，这样的任务既不在队列里也不在 running 里：
+        # 队列已经取空、其他进程都空闲（这次等待事件超时）时，剩下没有开始的任务就是这种
+        if dead and pending and not any(running.values()) and self._task_queue.qsize() == 0:
+            logger.error('%s 个任务被意外退出的同步进程取走，按失败处理：%s' % (len(pending), list(pending.values())))
+            pending.clear()
+
+    def close(self):
+        """让所有进程执行完手上的任务后退出"""
+        # 每个线程取到一个 None 就退出
+        for _ in range(0, len(self._processes) * max(self.thread_count, self.settings['pipeline_readers'])):
+            self._task_queue.put(None)
+        for _, control_queue in self._processes.values():
+            control_queue.put(None)
+        for p, _ in self._processes.values():
+            p.join()
+
+
+def run_processes(tasks, settings, cpu_count, thread_count, pipeline=False, stop=None):
+    """
+    多进程 × 多线程执行一轮任务
+    :param pipeline: 每个进程内用 读取 -> 转换 -> 写入 的流水线代替每个线程串行执行任务
+    :param stop: threading.Event，见 WorkerPool
+    :return: 每个进程上报的统计 list
+    """
+    workers = WorkerPool(settings, cpu_count, thread_count, pipeline, stop).start()
+    try:
+        return workers.run(tasks)
+    finally:
+        workers.close()
+
+
+def export_metrics(snapshot, settings, **extra):
+    """
+    打印各阶段的耗时分布，并写入 Prometheus textfile 和 JSON 报告
+    :param snapshot: 合并后的指标，见 sync_metrics.merge()
+    :param extra: 写入 JSON 报告的本次同步信息
+    """
+    stages = summarize(snapshot, 'sync_stage_seconds', 'stage')
+    if stages:
+        logger.info('各阶段耗时：' + '；'.join('%s %s 次共 %.2fs p50 %.3fs p99 %.3fs' % (
+            stage, s['count'], s['sum'], s['p50'] or 0, s['p99'] or 0) for stage, s in sorted(stages.items())))
+    if not settings['metrics_path']:
+        return
+    path = os.path.join(cur_dir, settings['metrics_path'])
+    try:
+        write_prometheus(path + '.prom', snapshot)
+        write_json(path + '.json', snapshot, **extra,
+                   docs_per_sec=extra['docs'] / extra['elapsed'] if extra.get('elapsed') else 0)
+    except OSError as e:
+        logger.warning('写入监控指标失败：%s' % e)
+
+
+def get_parallelism():
+    """
+    :return: (进程数, 每个进程的线程数)
+    """
+    # CPU 核数
+    cpu_count = math.ceil(multiprocessing.cpu_count() / 2)
+    # 启动的线程数量
+    thread_count = 5
+    return cpu_count, thread_count
+
+
+def resolve_engine(engine, settings):
+    """检查引擎和设置的组合，不支持的组合改用多进程引擎或者打印警告"""
+    if engine == 'asyncio':
+        missing = [name for name in ('aiomysql', 'aiohttp') if importlib.util.find_spec(name) is None]
+        if elasticsearch.VERSION < (7, 8):
+            missing.append('elasticsearch>=7.8')
+        if missing:
+            logger.warning('asyncio 引擎需要 aiomysql 和 elasticsearch[async]>=7.8（见 requirements-async.txt），'
+                           '缺少 %s，改用多进程引擎' % '、'.join(missing))
+            engine = 'process'
+    if engine in ('asyncio', 'pipeline') and settings['extract_mode'] == 'keyset':
+        logger.warning('%s 引擎只支持按时间段同步，keyset 模式改用多进程引擎' % engine)
+        engine = 'process'
+    if engine == 'asyncio' and settings['change_detection']:
+        logger.warning('asyncio 引擎不支持变化检测，本次同步不跳过未变化的文档')
+    if engine == 'asyncio' and settings['bulk_adaptive']:
+        logger.warning('asyncio 引擎不支持 bulk 自适应，按 bulk_concurrency 固定并发提交')
+    if engine == 'asyncio' and settings['dead_letter']:
+        logger.warning('asyncio 引擎不支持死信目录，失败的文档不保存，任务下次重新同步')
+    if engine == 'asyncio' and settings['range_split_rows']:
+        logger.warning('asyncio 引擎不支持按 article_detail_id 拆分任务，每个任务只用一个连接读取')
+    if engine == 'asyncio' and settings['row_format'] == 'tuple':
+        logger.warning('asyncio 引擎不支持 tuple 记录格式，本次同步使用 dict 记录')
+    if engine == 'asyncio' and get_router() is not None:
+        logger.warning('asyncio 引擎不支持从库路由，只读 DB 配置的数据库')
+    if engine == 'asyncio' and get_governor().enabled:
+        logger.warning('asyncio 引擎不支持数据库限流，只按 db_concurrency 限制同时执行的查询数')
+    if engine == 'asyncio' and settings['operation_lookup'] == 'batch':
+        logger.warning('asyncio 引擎不支持批量查询操作字段，本次同步仍然 JOIN article_operation')
+    return engine
+
+
+@contextlib.contextmanager
+def run_lock(name='sync'):
+    """
+    同一时间只允许一个同步在运行（cron 的上一次还没结束、守护进程已经在运行）
+    :param name: 锁的名称，回补和增量同步各用各的锁
+    :return: 上下文管理器，是否拿到了锁
+    """
+    with open(cur_dir + f'/{name}.lock', 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def stop_on_signal(message):
+    """
+    收到 SIGTERM / SIGINT 时不直接退出，只设置返回的 threading.Event，由调用方收尾
+    :param message: 收到信号时打印的日志，%s 为信号值
+    """
+    stop = threading.Event()
+
+    def on_signal(signum, frame):
+        logger.warning(message % signum)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    return stop
+
+
+def main(engine='process'):
+    """
+    同步入口，执行一次同步
+    :param engine: process 多进程 × 多线程，pipeline 多进程 × 流水线，asyncio 单进程协程
+    """
+    with run_lock() as locked:
+        if not locked:
+            logger.warning('上一次同步还没有结束，跳过本次')
+            return
+        # 同步进程忽略信号，由主进程停止分配任务，等正在执行的任务写完再退出
+        stop = stop_on_signal('收到信号 %s，等正在执行的任务完成后退出')
+        sync_once(engine, stop=stop)
+
+
+def daemon(engine='process', interval=None):
+    """
+    守护模式：常驻的同步进程保留连接和缓存，每隔 interval 秒同步一轮，上一轮结束之前不会开始下一轮
+    收到 SIGTERM / SIGINT 后不再开始新的任务，等正在执行的任务写完、保存进度后退出
+    :param interval: 两轮同步开始的间隔（秒），默认为 daemon_interval 设置
+    """
+    with run_lock() as locked:
+        if not locked:
+            logger.error('已经有同步在运行，守护进程不启动')
+            return
+        settings = get_settings()
+        interval = interval or settings['daemon_interval']
+        engine = resolve_engine(engine, settings)
+        stop = stop_on_signal('收到信号 %s，等正在执行的任务完成后退出')
+
+        workers = None
+        if engine != 'asyncio':
+            cpu_count, thread_count = get_parallelism()
+            # 子进程 fork 时会继承准备好的索引缓存，之后主进程的连接只有主进程自己用
+            index_cache.prepare(get_es())
+            workers = WorkerPool(settings, cpu_count, thread_count, engine == 'pipeline', stop).start()
+        logger.info('守护模式启动，每 %ss 同步一轮' % interval)
+        try:
+            while not stop.is_set():
+                _start = time.time()
+                try:
+                    sync_once(engine, workers, stop)
+                except Exception as e:
+                    logger.exception('本轮同步失败：%s' % e)
+                stop.wait(max(0, interval - (time.time() - _start)))
+        finally:
+            if workers is not None:
+                workers.close()
+            logger.info('守护模式退出')
+
+
+def parse_time(value):
+    """解析命令行的时间，可以只写日期"""
+    for fmt in (date_fmt, '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('时间格式应为 YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS：%s' % value)
+
+
+def backfill_indices(start_date, end_date, margin_days):
+    """
+    回补区间写入的按天索引：索引按 article_extracted_time 划分，任务按 created_time 查询，
+    往前多算 margin_days 天；当天及以后的索引还在被增量同步写入，不调整
+    :return: 索引名 list
+    """
+    today = datetime.date.today()
+    day = start_date.date() - datetime.timedelta(days=margin_days)
+    indices = []
+    while day <= end_date.date() and day < today:
+        indices.append('kwm-list-' + day.strftime('%Y-%m-%d'))
+        day += datetime.timedelta(days=1)
+    return indices
+
+
+def backfill(start, end, engine='process', forcemerge=False):
+    """
+    回补历史数据：调整目标索引的写入设置，用所有 CPU 同步 [start, end) 区间，最后恢复设置、refresh，
+    需要时 forcemerge。不读写增量同步的水位，可以和增量同步同时运行
+    :param start: 开始时间
+    :param end: 结束时间（不含）
+    :param forcemerge: 恢复设置后是否 forcemerge
+    """
+    with run_lock('backfill') as locked:
+        if not locked:
+            logger.error('已经有回补在运行')
+            return
+        _start = time.time()
+        start_date, end_date = parse_time(start), parse_time(end)
+        # 回补需要写入所有文档，本地的文档哈希可能和 ES 不一致（比如 ES 数据丢失），不做变化检测
+        settings = {**get_settings(), 'extract_mode': 'window', 'change_detection': False}
+        if engine == 'asyncio':
+            logger.warning('回补不支持 asyncio 引擎，改用多进程引擎')
+            engine = 'process'
+        stop = stop_on_signal('收到信号 %s，等正在执行的任务完成后恢复索引设置并退出')
+
+        _, thread_count = get_parallelism()
+        cpu_count = multiprocessing.cpu_count()
+        if settings['plan_mode'] == 'adaptive':
+            tasks = plan_adaptive_tasks(start_date, end_date, settings['target_rows'], thread_count)
+        else:
+            tasks = plan_tasks(start_date, end_date, 3600)
+        tasks = order_tasks(tasks, {} if settings['plan_mode'] == 'adaptive' else estimate_table_rows())
+        indices = backfill_indices(start_date, end_date, settings['backfill_margin_days'])
+        logger.info('开始回补【%s, %s)，%s 个任务，启动 %s 个进程，%s 个线程，调整 %s 个索引' % (
+            start_date, end_date, len(tasks), cpu_count, thread_count, len(indices)))
+
+        es = get_es()
+        tuner = IndexTuner(es, cur_dir + '/backfill_settings.json', settings['backfill_refresh_interval'],
+                           settings['backfill_replicas'])
+        reports = []
+        try:
+            index_cache.prepare(es)
+            tuner.apply(indices, mappings)
+            get_pool().close()
+            get_pool.cache_clear()
+            reports = run_processes(tasks, settings, cpu_count, thread_count, pipeline=engine == 'pipeline',
+                                    stop=stop)
+        finally:
+            # 回补失败、被中断也要恢复，恢复失败时设置留在文件里，下次回补时一起恢复
+            restored = tuner.restore()
+
+        # 回补的指标只打印，不覆盖增量同步的监控指标文件
+        export_metrics(merge([r.pop('metrics') for r in reports if 'metrics' in r]), {**settings, 'metrics_path': ''})
+        summary = {key: sum(r[key] for r in reports if key in r) for key in ('docs', 'failed', 'spooled')}
+        elapsed = time.time() - _start
+        logger.info('回补写入 %s 条，失败 %s 条，其中写入死信目录 %s 条，耗时 %.2fs，%.0f 条/s' % (
+            summary['docs'], summary['failed'], summary['spooled'], elapsed, summary['docs'] / elapsed if elapsed else 0))
+        if forcemerge and not stop.is_set():
+            tuner.forcemerge(restored, settings['backfill_max_segments'])
+
+
+def replay():
+    """
+    重新提交死信目录中的文档：同一个文档（_index, _id）只提交最后一次失败时的内容，
+    按 dead_letter_replay_in_flight 并发提交，再次失败的写入新的段文件，全部处理完后删除重放过的段文件
+    """
+    with run_lock('replay') as locked:
+        if not locked:
+            logger.error('已经有重放在运行')
+            return
+        _start = time.time()
+        settings = get_settings()
+        spool = get_spool()
+        paths = spool.segments()
+        if not paths:
+            logger.info('死信目录中没有需要重放的文档')
+            return
+
+        # 后写入的覆盖先写入的，段文件按写入时间排序
+        latest = {}
+        total = 0
+        for path in paths:
+            for record in read_segment(path):
+                total += 1
+                latest[(record['_index'], record['_id'])] = record
+        reasons = collections.Counter(
+            r['error'].get('type') if isinstance(r['error'], dict) else 'status %s' % r['status']
+            for r in latest.values())
+        logger.info('死信目录中有 %s 个段文件，%s 条记录，去重后 %s 个文档，失败原因：%s' % (
+            len(paths), total, len(latest), '，'.join('%s %s 条' % item for item in reasons.most_common())))
+
+        # 保存的是原始请求体，update 操作的请求体就是 {"doc": ...}，按 NDJSON 原样提交
+        actions = ({'_op_type': r['op'], '_index': r['_index'], '_id': r['_id'], '_source': r['source']}
+                   for r in latest.values())
+        es = get_es()
+        index_cache.prepare(es)
+        result = submit_bulk(es, actions, {**settings, 'bulk_serializer': 'ndjson',
+                                           'bulk_in_flight': settings['dead_letter_replay_in_flight']},
+                             lambda idx_name: index_cache.ensure(es, idx_name), spool=spool)
+        spool.seal()
+        if result['failed'] > result['spooled']:
+            logger.error('重放有 %s 条失败的文档没有写回死信目录，保留原来的段文件' % (result['failed'] - result['spooled']))
+            return
+        for path in paths:
+            os.remove(path)
+        logger.info('重放 %s 个文档，成功 %s 条，再次失败 %s 条（已写回死信目录），耗时 %.2fs' % (
+            len(latest), result['success'], result['failed'], time.time() - _start))
+
+
+def sync_once(engine='process', workers=None, stop=None):
+    """
+    同步一轮：拆分任务、执行、推进水位
+    :param engine: 见 main()
+    :param workers: 常驻的同步进程，见 WorkerPool，不传时临时启动
+    :param stop: threading.Event，设置之后不再开始新的任务
+    """
+    _task_start_time = time.time()
+    # 时间分段间隔
+    part_offset = 3600 * 1
+    cpu_count, thread_count = get_parallelism()
+
+    settings = get_settings()
+    # 从上次拆分到的时间继续，之前没有完成的任务会重新执行
+    checkpoint = get_checkpoint()
+    start = checkpoint.get('planned_until') or get_last_sync_time()
+    end = sync_end_time(settings)
+    start_date = datetime.datetime.strptime(start, date_fmt)
+    end_date = datetime.datetime.strptime(end, date_fmt)
+
+    if engine == 'asyncio':
+        logger.info('开始同步，本次同步时间区间：【%s, %s】，任务拆分间隔 %ss, 使用 asyncio 引擎' % (start, end, part_offset))
+    else:
+        logger.info('开始同步，本次同步时间区间：【%s, %s】，任务拆分间隔 %ss, 启动 %s 个进程，%s 个线程' % (start, end, part_offset, cpu_count, thread_count))
+
+    keyset = settings['extract_mode'] == 'keyset'
+    if keyset:
+        # 每张表一个任务，从表的高水位分页读到本次的结束时间
+        tasks = [{'tbl_index': f'{tbl_idx}', 'start': get_last_sync_time(), 'end': end} for tbl_idx in range(0, 100)]
+        logger.info('keyset 增量模式，%s 张表，每页 %s 条' % (len(tasks), settings['page_size']))
+        check_keyset_indexes()
+    elif settings['plan_mode'] == 'adaptive':
+        new_tasks = plan_adaptive_tasks(start_date, end_date, settings['target_rows'], thread_count)
+        checkpoint.plan(new_tasks, max(start, end))
+        # 之前未完成的任务没有行数统计，排序时按一个完整任务估算，不带 planned_rows（拆分前要 COUNT）
+        planned = {(t['tbl_index'], t['start'], t['end']): t['planned_rows'] for t in new_tasks}
+        tasks = []
+        for t in checkpoint.pending():
+            rows = planned.get((t['tbl_index'], t['start'], t['end']))
+            if rows is None:
+                tasks.append({**t, 'estimate': settings['target_rows']})
+            else:
+                tasks.append({**t, 'planned_rows': rows, 'estimate': rows})
+        logger.info('本次同步拆分为 %s 个任务，加上之前未完成的一共 %s 个任务' % (len(new_tasks), len(tasks)))
+    else:
+        new_tasks = plan_tasks(start_date, end_date, part_offset)
+        checkpoint.plan(new_tasks, max(start, end))
+        tasks = checkpoint.pending()
+        logger.info('本次同步拆分为 %s 个任务，加上之前未完成的一共 %s 个任务' % (len(new_tasks), len(tasks)))
+
+    tasks = order_tasks(tasks, {} if settings['plan_mode'] == 'adaptive' else estimate_table_rows())
+    if workers is None:
+        engine = resolve_engine(engine, settings)
+        # 子进程 fork 时会继承准备好的索引缓存
+        index_cache.prepare(get_es())
+        # 主进程的连接不带到子进程里，子进程各自建立连接池
+        get_pool().close()
+        get_pool.cache_clear()
+
+    if workers is not None:
+        reports = workers.run(tasks)
+    elif engine == 'asyncio':
+        from sync_async import AsyncEngine
+        async_engine = AsyncEngine(settings, get_config()['DB'], es_hosts, get_sql, iter_actions,
+                                   index_cache, checkpoint)
+        reports = [asyncio.run(async_engine.run(tasks, stop))]
+    else:
+        reports = run_processes(tasks, settings, cpu_count, thread_count, pipeline=engine == 'pipeline', stop=stop)
+
+    # asyncio 引擎在主进程里记录指标
+    snapshot = merge([metrics.snapshot()] + [r.pop('metrics') for r in reports if 'metrics' in r])
+    # 守护模式下每一轮只导出这一轮的指标
+    metrics.reset()
+    summary = {key: sum(r[key] for r in reports) for key in reports[0]} if reports else {}
+    elapsed = time.time() - _task_start_time
+    logger.info("本次同步一共耗时 %.2fs，写入 %s 条，失败 %s 条，其中写入死信目录 %s 条" % (
+        elapsed, summary.get('docs', 0), summary.get('failed', 0), summary.get('spooled', 0)))
+    logger.info("MySQL 新建连接 %s 次，耗时 %.2fs，复用连接 %s 次，丢弃 %s 次；ES 客户端 %s 个" % (
+        summary.get('connects', 0), summary.get('connect_time', 0), summary.get('reuses', 0),
+        summary.get('discards', 0), summary.get('es_clients', 0)))
+    if settings['change_detection']:
+        hits, misses = summary.get('digest_hits', 0), summary.get('digest_misses', 0)
+        evicted = get_digests().evict(settings['digest_max_age_days'] * 86400)
+        logger.info("变化检测跳过 %s 条未变化的文档，提交 %s 条，命中率 %.1f%%，清理过期哈希 %s 条" % (
+            hits, misses, 100 * hits / (hits + misses) if hits + misses else 0, evicted))
+
+    export_metrics(snapshot, settings, start=start, end=end, engine=engine, elapsed=elapsed,
+                   docs=summary.get('docs', 0), failed=summary.get('failed', 0))
+    if 'bulk_rejected' in summary:
+        logger.info("bulk 自适应：被拒绝 %s 条，重试 %s 次，增大并发 %s 次，减小并发 %s 次" % (
+            summary['bulk_rejected'], summary['bulk_retries'], summary['bulk_increases'], summary['bulk_decreases']))
+    replicas = collections.Counter()
+    for (name, labels), value in snapshot['counters'].items():
+        if name == 'sync_replica_checkouts_total':
+            replicas[dict(labels)['replica']] += value
+    if replicas:
+        logger.info("从库查询分布：" + '，'.join('%s %s 次' % item for item in sorted(replicas.items())))
+    if 'governor_waits' in summary:
+        logger.info("数据库限流：等待令牌、名额 %s 次共 %.2fs，负载过高暂停 %s 次共 %.2fs" % (
+            summary['governor_waits'], summary['governor_wait_time'], summary['governor_pauses'],
+            summary['governor_pause_time']))
+    if 'operation_queries' in summary:
+        hits, misses = summary['operation_hits'], summary['operation_misses']
+        logger.info("批量查询操作字段 %s 次，缓存命中 %s 次，未命中 %s 次，命中率 %.1f%%" % (
+            summary['operation_queries'], hits, misses, 100 * hits / (hits + misses) if hits + misses else 0))
+
+    if keyset:
+        # 高水位各表独立推进，这里不再推进时间段任务的水位
+        return
 
-    for p in processes:
-        p.join()
-    logger.info("本次同步一共耗时 %.2fs" % (time.time() - _task_start_time))
+    watermark = checkpoint.advance()
+    if watermark:
+        save_last_sync_time(watermark)
+    logger.info('同步水位推进到 %s，还有 %s 个任务未完成' % (watermark, len(checkpoint.pending())))
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='同步 MySQL 数据到 ES')
+    parser.add_argument('--engine', choices=('process', 'pipeline', 'asyncio'), default='process',
+                        help='process 多进程 × 多线程（默认），pipeline 多进程 × 流水线，asyncio 单进程协程')
+    parser.add_argument('--operations', action='store_true',
+                        help='只同步 article_operation 的变更，局部更新文档的操作字段')
+    parser.add_argument('--daemon', action='store_true',
+                        help='守护模式，常驻进程保留连接，每隔 --interval 秒同步一轮，代替每分钟的 cron')
+    parser.add_argument('--interval', type=int, help='守护模式两轮同步的间隔（秒），默认为 SYNC.daemon_interval')
+    parser.add_argument('--backfill', action='store_true',
+                        help='回补 --from 到 --to 的历史数据，期间关闭目标索引的 refresh 和副本，结束后恢复')
+    parser.add_argument('--from', dest='start', help='回补的开始时间，YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS')
+    parser.add_argument('--to', dest='end', help='回补的结束时间（不含）')
+    parser.add_argument('--forcemerge', action='store_true', help='回补结束后 forcemerge 目标索引')
+    parser.add_argument('--replay', action='store_true', help='重新提交死信目录中的文档')
+    args = parser.parse_args()
+    if args.replay:
+        replay()
+    elif args.backfill:
+        if not args.start or not args.end:
+            parser.error('--backfill 需要 --from 和 --to')
+        backfill(args.start, args.end, engine=args.engine, forcemerge=args.forcemerge)
+    elif args.operations:
+        operations()
+    elif args.daemon:
+        daemon(engine=args.engine, interval=args.interval)
+    else:
+        main(engine=args.engine)
     # get_fields()
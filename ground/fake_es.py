@@ -0,0 +1,191 @@
+"""
+本地假 ES 服务，只实现同步用到的几个接口，用于测试和压测
+
+- GET /                 集群信息
+- HEAD /{index}         索引是否存在
+- PUT /{index}          创建索引
+- PUT /_template/{name} 安装索引模板
+- GET /{pattern}/_alias 列出匹配的索引
+- GET /{pattern}/_count 匹配的索引中的文档数
+- GET /{indices}/_settings/{names}、PUT /{indices}/_settings 索引设置（flat_settings）
+- POST /{indices}/_refresh、POST /{indices}/_forcemerge 只记录调用次数
+- POST /_bulk           批量写入，可以按比例模拟 429 拒绝和 400 映射错误
+
+用法：python fake_es.py [端口]
+"""
+import fnmatch
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeESHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _path(self):
+        return self.path.split('?')[0].strip('/')
+
+    def do_GET(self):
+        if self._path() == '':
+            return self._send(200, {'version': {'number': '7.1.0', 'build_flavor': 'default'},
+                                    'tagline': 'You Know, for Search'})
+        if self._path().endswith('/_count'):
+            pattern = self._path()[:-len('/_count')]
+            with self.server.lock:
+                count = sum(len(docs) for name, docs in self.server.indices.items() if fnmatch.fnmatch(name, pattern))
+            return self._send(200, {'count': count})
+        if '/_settings' in self._path():
+            # /{indices}/_settings/{names}，只返回请求的设置项
+            names, _, keys = self._path().partition('/_settings')
+            keys = keys.strip('/').split(',') if keys.strip('/') else None
+            return self._send(200, {name: {'settings': {k: v for k, v in self.server.settings.get(name, {}).items()
+                                                        if keys is None or k in keys}}
+                                    for name in names.split(',') if name in self.server.indices})
+        if self._path().endswith('/_alias'):
+            pattern = self._path()[:-len('/_alias')]
+            return self._send(200, {name: {'aliases': {}} for name in list(self.server.indices)
+                                    if fnmatch.fnmatch(name, pattern)})
+        self._send(404, {'error': 'not found', 'status': 404})
+
+    def do_HEAD(self):
+        self.server.stats['head'] += 1
+        self._send(200 if self._path() in self.server.indices else 404)
+
+    def do_PUT(self):
+        body = self._read_body()
+        name = self._path()
+        if name.endswith('/_settings'):
+            values = json.loads(body or b'{}')
+            # 嵌套的 {"index": {...}} 展开成 flat_settings 的形式
+            flat = {'index.' + k: v for k, v in values.pop('index', {}).items()}
+            flat.update(values)
+            with self.server.lock:
+                for idx_name in name[:-len('/_settings')].split(','):
+                    settings = self.server.settings.setdefault(idx_name, {'index.number_of_replicas': '1'})
+                    for k, v in flat.items():
+                        if v is None:
+                            settings.pop(k, None)
+                        else:
+                            settings[k] = str(v)
+            return self._send(200, {'acknowledged': True})
+        if name.startswith('_template/'):
+            self.server.templates[name[len('_template/'):]] = json.loads(body or b'{}')
+            return self._send(200, {'acknowledged': True})
+        with self.server.lock:
+            self.server.stats['put'] += 1
+            if name in self.server.indices:
+                return self._send(400, {'error': {'type': 'resource_already_exists_exception'}, 'status': 400})
+            self.server.indices[name] = {}
+            self.server.settings.setdefault(name, {'index.number_of_replicas': '1'})
+        self._send(200, {'acknowledged': True, 'index': name})
+
+    def do_POST(self):
+        body = self._read_body()
+        if self._path().endswith(('/_refresh', '/_forcemerge')):
+            with self.server.lock:
+                self.server.stats[self._path().rsplit('_', 1)[1]] += 1
+            return self._send(200, {'_shards': {'total': 1, 'successful': 1, 'failed': 0}})
+        if not self._path().endswith('_bulk'):
+            return self._send(404, {'error': 'not found', 'status': 404})
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        lines = [line for line in body.split(b'\n') if line.strip()]
+        items = []
+        errors = False
+        with self.server.lock:
+            self.server.stats['bulk'] += 1
+            self.server.stats['bulk_bytes'] += len(body)
+            i = 0
+            while i < len(lines):
+                action = json.loads(lines[i])
+                op_type, meta = action.popitem()
+                source = json.loads(lines[i + 1]) if op_type != 'delete' else None
+                i += 1 if op_type == 'delete' else 2
+
+                item = {'_index': meta.get('_index'), '_id': meta.get('_id')}
+                if random.random() < self.server.reject_ratio:
+                    errors = True
+                    item.update(status=429, error={'type': 'es_rejected_execution_exception',
+                                                   'reason': 'rejected execution'})
+                elif random.random() < self.server.error_ratio:
+                    errors = True
+                    item.update(status=400, error={'type': 'mapper_parsing_exception',
+                                                   'reason': 'failed to parse'})
+                elif op_type == 'update' and meta.get('_id') not in self.server.indices.get(meta.get('_index'), {}):
+                    errors = True
+                    item.update(status=404, error={'type': 'document_missing_exception',
+                                                   'reason': 'document missing'})
+                else:
+                    docs = self.server.indices.setdefault(meta.get('_index'), {})
+                    if op_type == 'update':
+                        docs[meta.get('_id')].update(source.get('doc', {}))
+                    elif op_type == 'delete':
+                        docs.pop(meta.get('_id'), None)
+                    else:
+                        docs[meta.get('_id')] = source if self.server.keep_source else {}
+                    item['status'] = 201 if op_type in ('index', 'create') else 200
+                items.append({op_type: item})
+        self._send(200, {'took': 1, 'errors': errors, 'items': items})
+
+
+class FakeES(ThreadingHTTPServer):
+    """
+    假 ES 服务
+    :param port: 监听端口，0 表示随机端口
+    :param reject_ratio: 每个文档被 429 拒绝的概率
+    :param error_ratio: 每个文档返回 400 映射错误的概率
+    :param latency: 每次 bulk 的模拟延迟（秒）
+    :param keep_source: 是否保存文档内容，压测时不保存，只记录文档 ID
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, reject_ratio=0.0, latency=0.0, keep_source=True, error_ratio=0.0):
+        super().__init__(('127.0.0.1', port), FakeESHandler)
+        self.reject_ratio = reject_ratio
+        self.error_ratio = error_ratio
+        self.latency = latency
+        self.keep_source = keep_source
+        self.lock = threading.Lock()
+        self.indices = {}
+        self.templates = {}
+        # 索引名 => flat_settings
+        self.settings = {}
+        self.stats = {'head': 0, 'put': 0, 'bulk': 0, 'bulk_bytes': 0, 'refresh': 0, 'forcemerge': 0}
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address
+
+    def doc_count(self):
+        return sum(len(docs) for docs in self.indices.values())
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='FakeES', daemon=True).start()
+        return self
+
+
+if __name__ == '__main__':
+    server = FakeES(int(sys.argv[1]) if len(sys.argv) > 1 else 9200)
+    print('假 ES 服务监听 %s' % server.url)
+    server.serve_forever()
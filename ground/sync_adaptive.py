@@ -0,0 +1,120 @@
+"""
+bulk 自适应控制
+
+集群有合并压力时，固定的 进程 × 线程 × 在途请求数 会打出大量 429（es_rejected_execution_exception）
+和超时。这里按 AIMD（加性增、乘性减）调整一个进程内同时在途的 bulk 请求数和每个请求的文档数：
+
+- 有文档被 429 拒绝、请求失败或者耗时超过目标值：在途请求数和批大小减半（冷却时间内只减一次）
+- 连续成功一轮（当前在途请求数个请求）并且耗时正常：在途请求数加 1，批大小加一个步长
+
+被拒绝的文档按带随机抖动的指数退避重试，每次调整都会打印日志
+
+各个进程独立调整，和 TCP 的拥塞控制一样，多个独立的 AIMD 会收敛到共享的容量上
+"""
+import contextlib
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger('SyncData2ES')
+
+
+class BulkController:
+    """
+    一个进程内所有线程共享的 bulk 并发和批大小控制
+    :param in_flight: 初始的在途请求数
+    :param batch_size: 初始的批大小（文档数）
+    :param min_in_flight: 在途请求数的下限
+    :param max_in_flight: 在途请求数的上限
+    :param min_batch_size: 批大小的下限
+    :param max_batch_size: 批大小的上限
+    :param batch_step: 每次增加的批大小
+    :param target_latency: 单个请求耗时的目标值（秒），超过就算过载
+    :param backoff: 重试退避的基数（秒）
+    :param max_backoff: 重试退避的上限（秒）
+    """
+
+    def __init__(self, in_flight=2, batch_size=2000, min_in_flight=1, max_in_flight=8, min_batch_size=200,
+                 max_batch_size=5000, batch_step=500, target_latency=5.0, backoff=0.5, max_backoff=30.0):
+        self.min_in_flight = min_in_flight
+        self.max_in_flight = max_in_flight
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.batch_step = batch_step
+        self.target_latency = target_latency
+        self.backoff_base = backoff
+        self.max_backoff = max_backoff
+        self.in_flight = min(max(in_flight, min_in_flight), max_in_flight)
+        self.batch_size = min(max(batch_size, min_batch_size), max_batch_size)
+        self.stats = {'increases': 0, 'decreases': 0, 'rejected': 0, 'retries': 0}
+        self._active = 0
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """占用一个在途请求的名额，超过当前的在途请求数时等待"""
+        with self._cond:
+            while self._active >= self.in_flight:
+                self._cond.wait()
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify()
+
+    def record(self, latency, total, rejected, failed=False):
+        """
+        记录一个 bulk 请求的结果，按需调整
+        :param latency: 请求耗时（秒）
+        :param total: 请求中的文档数
+        :param rejected: 被 429 拒绝的文档数
+        :param failed: 整个请求是否失败（超时、连接错误等）
+        """
+        with self._cond:
+            self.stats['rejected'] += rejected
+            if failed or rejected or latency > self.target_latency:
+                self._successes = 0
+                now = time.time()
+                # 同一次拥塞的多个响应只减一次，已经减到下限时不再调整
+                if now - self._last_decrease < max(self.target_latency, latency) or (
+                        self.in_flight == self.min_in_flight and self.batch_size == self.min_batch_size):
+                    return
+                self._last_decrease = now
+                reason = ('请求失败' if failed else '%s/%s 个文档被拒绝' % (rejected, total) if rejected
+                          else '耗时 %.2fs 超过 %.2fs' % (latency, self.target_latency))
+                self._adjust(max(self.min_in_flight, self.in_flight // 2),
+                             max(self.min_batch_size, self.batch_size // 2), reason)
+                self.stats['decreases'] += 1
+                return
+
+            self._successes += 1
+            if self._successes < self.in_flight:
+                return
+            self._successes = 0
+            if self.in_flight < self.max_in_flight or self.batch_size < self.max_batch_size:
+                self._adjust(min(self.max_in_flight, self.in_flight + 1),
+                             min(self.max_batch_size, self.batch_size + self.batch_step),
+                             '连续 %s 个请求正常，耗时 %.2fs' % (self.in_flight, latency))
+                self.stats['increases'] += 1
+                # 名额变多了，唤醒等待的线程
+                self._cond.notify_all()
+
+    def _adjust(self, in_flight, batch_size, reason):
+        logger.info('bulk 自适应调整（%s）：在途请求 %s -> %s，批大小 %s -> %s' % (
+            reason, self.in_flight, in_flight, self.batch_size, batch_size))
+        self.in_flight = in_flight
+        self.batch_size = batch_size
+
+    def backoff(self, attempt):
+        """
+        第 attempt 次重试前等待的秒数，指数退避加完全随机抖动，避免所有线程同时重试
+        :param attempt: 从 1 开始
+        """
+        with self._cond:
+            self.stats['retries'] += 1
+        return random.uniform(0, min(self.max_backoff, self.backoff_base * 2 ** (attempt - 1)))
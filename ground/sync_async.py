@@ -0,0 +1,163 @@
+"""
+asyncio 同步引擎
+
+同步的时间几乎都花在等待 MySQL 和 ES 的 I/O 上，用一个进程里的协程代替 进程 × 线程，
+可以同时有几百个（表, 时间段）任务在途，数据库查询和 bulk 请求的并发分别限制
+
+依赖 aiomysql 和 elasticsearch[async]>=7.8（AsyncElasticsearch），见 requirements-async.txt
+"""
+import asyncio
+import logging
+import time
+
+import aiomysql
+from elasticsearch import AsyncElasticsearch, TransportError
+
+from sync_bulk import iter_ndjson_chunks, new_result, parse_bulk_items, record_item
+from sync_metrics import metrics
+
+logger = logging.getLogger('SyncData2ES')
+
+
+class AsyncEngine:
+    """
+    asyncio 同步引擎
+    :param settings: 同步设置，使用 async_task_concurrency、db_concurrency、bulk_concurrency 等
+    :param db_config: config.yml 中的 DB 配置
+    :param es_hosts: ES 节点
+    :param get_sql: 表名 => SQL 的函数
+    :param iter_actions: 记录 => action 的转换函数
+    :param index_cache: 已知索引的缓存，见 es_sync_data.IndexCache
+    :param checkpoint: 检查点，见 sync_checkpoint.CheckpointStore
+    """
+
+    def __init__(self, settings, db_config, es_hosts, get_sql, iter_actions, index_cache, checkpoint):
+        self.settings = settings
+        self.db_config = db_config
+        self.es_hosts = es_hosts
+        self.get_sql = get_sql
+        self.iter_actions = iter_actions
+        self.index_cache = index_cache
+        self.checkpoint = checkpoint
+        self.report = {'docs': 0, 'failed': 0, 'es_clients': 1}
+
+    async def run(self, tasks, stop=None):
+        """
+        执行所有任务
+        :param stop: threading.Event，设置之后不再开始新的任务，等已经开始的任务写完就返回
+        :return: 统计，格式同多进程引擎每个进程上报的统计
+        """
+        settings = self.settings
+        self._db_slots = asyncio.Semaphore(settings['db_concurrency'])
+        self._bulk_slots = asyncio.Semaphore(settings['bulk_concurrency'])
+
+        # 连接复用，必须 autocommit，否则一直读第一次查询时的快照；
+        # 游标在等待 bulk 提交时一直开着，net_write_timeout 要足够大，都见 es_sync_data.connect_db()
+        db_config = {**self.db_config, 'autocommit': True}
+        if settings['db_net_write_timeout']:
+            db_config['init_command'] = 'SET SESSION net_write_timeout = %d' % settings['db_net_write_timeout']
+        pool = await aiomysql.create_pool(minsize=0, maxsize=settings['db_concurrency'],
+                                          cursorclass=aiomysql.DictCursor, **db_config)
+        es = AsyncElasticsearch(self.es_hosts)
+
+        self._done = 0
+        queue = asyncio.Queue()
+        for task in tasks:
+            queue.put_nowait(task)
+        try:
+            workers = [self._worker(queue, pool, es, len(tasks), stop)
+                       for _ in range(min(settings['async_task_concurrency'], len(tasks)))]
+            await asyncio.gather(*workers)
+        finally:
+            pool.close()
+            await pool.wait_closed()
+            await es.close()
+        return self.report
+
+    async def _worker(self, queue, pool, es, total, stop):
+        while stop is None or not stop.is_set():
+            try:
+                task = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            logger.info('当前任务%s' % task)
+            _start = time.time()
+            try:
+                result = await self.sync_task(task, pool, es)
+            except Exception as e:
+                logger.exception('任务 %s 同步失败：%s' % (task, e))
+                metrics.observe('sync_task_seconds', time.time() - _start)
+                metrics.inc('sync_tasks_total', status='failed')
+                continue
+            self.report['docs'] += result['success']
+            self.report['failed'] += result['failed']
+            metrics.observe('sync_task_seconds', time.time() - _start)
+            metrics.inc('sync_tasks_total', status='ok' if result['failed'] == 0 else 'failed')
+            # 全部写入成功才算完成，否则下次运行重做
+            if result['failed'] == 0:
+                self.checkpoint.mark_done(task, result['success'])
+            self._done += 1
+            logger.info('已完成 %s/%s 个任务' % (self._done, total))
+
+    async def sync_task(self, task, pool, es):
+        """
+        同步一个（表, 时间段）任务：服务端游标分批读取，每个任务最多 2 个 bulk 请求在途
+        :return: bulk 提交结果，见 sync_bulk.submit_bulk()
+        """
+        settings = self.settings
+        tbl_name = 'stat_article_subject_' + task['tbl_index']
+        result = new_result()
+        pending = set()
+        _start = time.time()
+
+        # 游标读完之前一直占用一个数据库并发名额
+        async with self._db_slots, pool.acquire() as conn, conn.cursor(aiomysql.SSDictCursor) as cursor:
+            await cursor.execute(self.get_sql(tbl_name), [task['start'], task['end']])
+            while True:
+                # 协程之间不能用线程的标签，表名直接传
+                _fetch_start = time.time()
+                rows = await cursor.fetchmany(settings['fetch_size'])
+                metrics.observe('sync_stage_seconds', time.time() - _fetch_start, stage='db_fetch', table=tbl_name)
+                if not rows:
+                    break
+                metrics.inc('sync_rows_read_total', len(rows), table=tbl_name)
+                actions = list(self.iter_actions(rows))
+                await self._ensure_indices(es, {a['_index'] for a in actions})
+                for body, metas in iter_ndjson_chunks(actions, settings['bulk_size'], settings['bulk_max_bytes']):
+                    if len(pending) >= 2:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for f in done:
+                            f.result()
+                    pending.add(asyncio.ensure_future(self._bulk(es, body, metas, result, tbl_name)))
+
+        if pending:
+            for f in (await asyncio.wait(pending))[0]:
+                f.result()
+        logger.debug("从 %s 表同步 %s 条记录，失败 %s 条，耗时 %.2fs" % (
+            tbl_name, result['success'] + result['failed'], result['failed'], time.time() - _start))
+        return result
+
+    async def _bulk(self, es, body, metas, result, tbl_name):
+        async with self._bulk_slots:
+            _start = time.time()
+            try:
+                resp = await es.transport.perform_request(
+                    'POST', '/_bulk', headers={'content-type': 'application/x-ndjson'},
+                    params={'request_timeout': self.settings['bulk_timeout']}, body=body)
+                items = parse_bulk_items(resp, metas)
+            except TransportError as e:
+                items = [(False, {**meta, 'status': e.status_code, 'error': str(e)}) for meta in metas]
+            metrics.observe('sync_stage_seconds', time.time() - _start, stage='bulk', table=tbl_name)
+            metrics.inc('sync_bulk_bytes_total', len(body), table=tbl_name)
+        for ok, info in items:
+            record_item(result, ok, info)
+        metrics.inc('sync_docs_indexed_total', sum(1 for ok, _ in items if ok), table=tbl_name)
+        metrics.inc('sync_docs_failed_total', sum(1 for ok, _ in items if not ok), table=tbl_name)
+
+    async def _ensure_indices(self, es, indices):
+        """装了索引模板就不需要检查，否则每个索引检查一次，不存在就创建"""
+        for idx_name in indices - self.index_cache.names:
+            if not self.index_cache.template and not await es.indices.exists(index=idx_name):
+                await es.indices.create(index=idx_name, body=self.index_cache.mappings, ignore=400)
+            self.index_cache.names.add(idx_name)
@@ -0,0 +1,415 @@
+"""
+ES bulk 提交
+
+按文档数和序列化后的字节数切分 bulk 请求，同时保持多个 bulk 请求并发，
+逐条统计失败的文档
+
+两种序列化方式：
+- client：交给 elasticsearch.helpers，由客户端逐条序列化
+- ndjson：直接把 action 写成 NDJSON 字节（有 orjson 就用 orjson），预先编码好的请求体直接发给 _bulk
+
+开启自适应（bulk_adaptive）时按 ndjson 的方式提交，在途请求数和批大小由 sync_adaptive.BulkController 调整，
+被拒绝的文档退避后重试
+
+传入死信目录（sync_spool.DeadLetterSpool）时，最终失败的文档连同原始请求体写入死信目录，之后可以重放
+"""
+import collections
+import datetime
+import decimal
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import helpers, TransportError
+
+from sync_metrics import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger('SyncData2ES')
+
+# 最多记录的失败详情条数，避免大面积失败时撑爆内存
+max_error_samples = 20
+
+
+def json_default(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError('Type is not JSON serializable: %s' % type(value).__name__)
+
+
+if orjson is not None:
+    def dumps(obj):
+        """序列化为 JSON 字节"""
+        return orjson.dumps(obj, default=json_default)
+else:
+    def dumps(obj):
+        """序列化为 JSON 字节"""
+        return json.dumps(obj, default=json_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def new_result():
+    """空的提交结果"""
+    return {'success': 0, 'failed': 0, 'spooled': 0, 'errors': []}
+
+
+def record_item(result, ok, info):
+    """记录一个文档的提交结果"""
+    if ok:
+        result['success'] += 1
+        return
+    result['failed'] += 1
+    if len(result['errors']) < max_error_samples:
+        result['errors'].append({
+            '_index': info.get('_index'),
+            '_id': info.get('_id'),
+            'status': info.get('status'),
+            'error': info.get('error'),
+        })
+
+
+def _split_lines(body):
+    """把 NDJSON 请求体拆回每个文档的两行"""
+    parts = body.split(b'\n')
+    return [parts[i] + b'\n' + parts[i + 1] for i in range(0, len(parts) - 1, 2)]
+
+
+def spool_failed(spool, items, lines):
+    """
+    把失败的文档写入死信目录，写入出错时只打印日志，这些文档按失败处理
+    :param items: [(是否成功, 详情), ...]
+    :param lines: 和 items 一一对应的 NDJSON 两行（bytes），或者返回它的函数（只在有失败时调用）
+    :return: 写入的条数
+    """
+    if all(ok for ok, _ in items):
+        return 0
+    if callable(lines):
+        lines = lines()
+    records = []
+    for (ok, info), line in zip(items, lines):
+        if not ok:
+            action, source = line.rstrip(b'\n').split(b'\n', 1)
+            records.append((info, next(iter(json.loads(action))), source))
+    try:
+        written = spool.write(records)
+    except OSError as e:
+        logger.error('写入死信目录失败，%s 条失败的文档没有保存：%s' % (len(records), e))
+        return 0
+    metrics.inc('sync_docs_spooled_total', written)
+    return written
+
+
+def _remember(actions, sent):
+    """按顺序记下交给 helpers 的 action，helpers 按同样的顺序返回结果"""
+    for action in actions:
+        sent.append(action)
+        yield action
+
+
+def _watch_indices(actions, on_new_index):
+    """第一次遇到某个索引时调用 on_new_index，在包含它的 bulk 请求发出之前"""
+    seen = set()
+    for action in actions:
+        if on_new_index is not None and action['_index'] not in seen:
+            seen.add(action['_index'])
+            on_new_index(action['_index'])
+        yield action
+
+
+def _labelled(actions, labels):
+    """
+    parallel_bulk 在自己线程池的线程里消费 action，读取、转换也跟着在那个线程里执行，
+    给那个线程带上调用线程的指标标签
+    """
+    with metrics.labels(**labels):
+        yield from actions
+
+
+def _encode(action):
+    """
+    把一个 action 编码成 NDJSON 的两行
+    :param action: helpers 格式的 action，index 操作带 _source，update 操作（_op_type）带 doc
+    :return: (Action & Meta, 编码后的 bytes)
+    """
+    meta = {'_index': action['_index'], '_id': action['_id']}
+    source = action['_source'] if '_source' in action else {'doc': action['doc']}
+    return meta, dumps({action.get('_op_type', 'index'): meta}) + b'\n' + dumps(source) + b'\n'
+
+
+def iter_ndjson_chunks(actions, chunk_size, max_chunk_bytes):
+    """
+    把 action 直接编码成 NDJSON 请求体，按文档数和字节数切分。
+    一个块的各行先放在 list 里，凑够之后一次 join 成请求体，只拷贝一遍；
+    ES 客户端的请求体只接受 bytes / str，块交出去之后还在发送线程里用着，所以每个块是各自的 bytes，不复用缓冲区
+    :param actions: helpers 格式的 action，index 操作带 _source，update 操作（_op_type）带 doc
+    :return: 生成器，每次返回 (请求体 bytes, 每个文档的 Action & Meta list)
+    """
+    lines = []
+    size = 0
+    metas = []
+    for action in actions:
+        meta, line = _encode(action)
+        if metas and (len(metas) >= chunk_size or size + len(line) > max_chunk_bytes):
+            yield b''.join(lines), metas
+            lines, size, metas = [], 0, []
+        lines.append(line)
+        size += len(line)
+        metas.append(meta)
+    if metas:
+        yield b''.join(lines), metas
+
+
+def _reap(futures):
+    """
+    取出已经完成的 future 的结果（发送出错时在这里抛出），只保留还没完成的，
+    一个任务提交的块再多，手上的 future 也不超过在途、排队的块数
+    :return: 还没完成的 future list
+    """
+    pending = []
+    for f in futures:
+        if f.done():
+            f.result()
+        else:
+            pending.append(f)
+    return pending
+
+
+def send_ndjson(es, body, metas, timeout):
+    """
+    发送一个预先编码好的 bulk 请求体
+    :return: [(是否成功, 详情), ...]，和 metas 一一对应
+    """
+    metrics.inc('sync_bulk_bytes_total', len(body))
+    try:
+        with metrics.timer('sync_stage_seconds', stage='bulk'):
+            resp = es.transport.perform_request('POST', '/_bulk', headers={'content-type': 'application/x-ndjson'},
+                                                params={'request_timeout': timeout}, body=body)
+    except TransportError as e:
+        return [(False, {**meta, 'status': e.status_code, 'error': str(e)}) for meta in metas]
+
+    return parse_bulk_items(resp, metas)
+
+
+def parse_bulk_items(resp, metas):
+    """
+    解析 _bulk 响应中每个文档的结果
+    :return: [(是否成功, 详情), ...]，和 metas 一一对应
+    """
+    items = []
+    for meta, item in zip(metas, resp['items']):
+        info = next(iter(item.values()))
+        items.append((200 <= info.get('status', 500) < 300, {**meta, **info}))
+    return items
+
+
+def submit_ndjson(es, actions, settings, on_item=None, spool=None):
+    """预先编码 NDJSON，最多 bulk_in_flight 个请求在途，参数和返回值同 submit_bulk"""
+    result = new_result()
+    in_flight = max(1, settings['bulk_in_flight'])
+    # 在途 + 排队的块都有上限，ES 变慢时读取也会跟着慢下来
+    slots = threading.BoundedSemaphore(in_flight * 2)
+    lock = threading.Lock()
+    # 发送线程里带上调用线程的指标标签（表名）
+    labels = metrics.current_labels()
+
+    def send(body, metas):
+        try:
+            with metrics.labels(**labels):
+                items = send_ndjson(es, body, metas, settings['bulk_timeout'])
+                spooled = spool_failed(spool, items, lambda: _split_lines(body)) if spool is not None else 0
+            with lock:
+                for ok, info in items:
+                    record_item(result, ok, info)
+                result['spooled'] += spooled
+            if on_item is not None:
+                for ok, info in items:
+                    on_item(ok, info)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(in_flight) as executor:
+        futures = []
+        for body, metas in iter_ndjson_chunks(actions, settings['bulk_size'], settings['bulk_max_bytes']):
+            slots.acquire()
+            futures = _reap(futures)
+            futures.append(executor.submit(send, body, metas))
+        for f in futures:
+            f.result()
+    return result
+
+
+def _retryable(info):
+    """被拒绝（429）、节点不可用（503）或者连接错误、超时（ES 客户端的 status_code 为 N/A）的文档可以重试"""
+    status = info.get('status')
+    return status in (429, 503) or not isinstance(status, int)
+
+
+def submit_adaptive(es, actions, settings, controller, on_item=None, spool=None):
+    """
+    自适应提交：批大小和在途请求数由 controller 控制，被拒绝的文档带抖动退避后重试，参数和返回值同 submit_bulk
+    :param controller: sync_adaptive.BulkController，一个进程共享一个
+    """
+    result = new_result()
+    lock = threading.Lock()
+    labels = metrics.current_labels()
+    # 本次调用排队中的块数上限，ES 变慢时读取也会跟着慢下来
+    slots = threading.BoundedSemaphore(controller.max_in_flight * 2)
+
+    def send(chunk):
+        try:
+            with metrics.labels(**labels):
+                attempt = 0
+                while True:
+                    with controller.slot():
+                        _start = time.time()
+                        items = send_ndjson(es, b''.join(line for _, line in chunk), [meta for meta, _ in chunk],
+                                            settings['bulk_timeout'])
+                        latency = time.time() - _start
+                    retry = [i for i, (ok, info) in enumerate(items) if not ok and _retryable(info)]
+                    controller.record(latency, len(chunk), len(retry),
+                                      failed=len(retry) == len(chunk) and not isinstance(items[0][1]['status'], int))
+                    if retry and attempt < settings['bulk_max_retries']:
+                        # 重试的文档这次先不计入结果
+                        retry_set = set(retry)
+                        done = [item for i, item in enumerate(items) if i not in retry_set]
+                        done_lines = [line for i, (_, line) in enumerate(chunk) if i not in retry_set]
+                        chunk = [chunk[i] for i in retry]
+                    else:
+                        done = items
+                        done_lines = [line for _, line in chunk]
+                    spooled = spool_failed(spool, done, done_lines) if spool is not None else 0
+                    with lock:
+                        for ok, info in done:
+                            record_item(result, ok, info)
+                        result['spooled'] += spooled
+                    if on_item is not None:
+                        for ok, info in done:
+                            on_item(ok, info)
+                    if done is items:
+                        break
+                    attempt += 1
+                    metrics.inc('sync_bulk_retries_total', len(chunk))
+                    time.sleep(controller.backoff(attempt))
+        finally:
+            slots.release()
+
+    def iter_chunks():
+        chunk, size = [], 0
+        for action in actions:
+            meta, line = _encode(action)
+            # 每个块开始时读取当前的批大小
+            if chunk and (len(chunk) >= controller.batch_size or size + len(line) > settings['bulk_max_bytes']):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append((meta, line))
+            size += len(line)
+        if chunk:
+            yield chunk
+
+    with ThreadPoolExecutor(controller.max_in_flight) as executor:
+        futures = []
+        for chunk in iter_chunks():
+            slots.acquire()
+            futures = _reap(futures)
+            futures.append(executor.submit(send, chunk))
+        for f in futures:
+            f.result()
+    return result
+
+
+class _TimedClient:
+    """给 helpers 用的 ES 客户端代理，记录每个 bulk 请求的耗时"""
+
+    def __init__(self, es):
+        self._es = es
+        self._labels = metrics.current_labels()
+
+    def __getattr__(self, name):
+        return getattr(self._es, name)
+
+    def bulk(self, *args, **kwargs):
+        # parallel_bulk 在自己的线程池里调用，带上创建时调用线程的标签
+        with metrics.labels(**self._labels):
+            _start = time.time()
+            try:
+                return self._es.bulk(*args, **kwargs)
+            finally:
+                metrics.observe('sync_stage_seconds', time.time() - _start, stage='bulk')
+
+
+def submit_bulk(es, actions, settings, on_new_index=None, on_item=None, controller=None, spool=None,
+                expected_status=()):
+    """
+    分块提交 bulk 请求
+    :param es: ES 客户端
+    :param actions: helpers 格式的 action（含 _index、_id、_source）的可迭代对象
+    :param settings: 同步设置，使用 bulk_serializer、bulk_size、bulk_max_bytes、bulk_in_flight、bulk_timeout
+    :param on_new_index: 第一次遇到某个索引时的回调，在包含它的 bulk 请求发出之前调用
+    :param on_item: 每个文档提交结果的回调 (是否成功, 详情)，详情中包含 _index、_id
+    :param controller: sync_adaptive.BulkController，传入时自适应提交，忽略 bulk_serializer、bulk_size、bulk_in_flight
+    :param spool: sync_spool.DeadLetterSpool，传入时失败的文档写入死信目录
+    :param expected_status: 预期之中的失败状态码，比如局部更新时文档不存在的 404，这些文档不算失败
+    :return: dict，success 成功数，failed 失败数，spooled 失败后写入了死信目录的数量，errors 部分失败详情，
+             传入 expected_status 时 expected 为预期之中的失败数
+    """
+    actions = _watch_indices(actions, on_new_index)
+    expected = [0]
+    if expected_status:
+        callback = on_item
+
+        def on_item(ok, info):
+            if not ok and info.get('status') in expected_status:
+                expected[0] += 1
+            if callback is not None:
+                callback(ok, info)
+
+    if controller is not None:
+        result = submit_adaptive(es, actions, settings, controller, on_item, spool)
+    elif settings['bulk_serializer'] == 'ndjson':
+        result = submit_ndjson(es, actions, settings, on_item, spool)
+    else:
+        result = new_result()
+        kwargs = {
+            'chunk_size': settings['bulk_size'],
+            'max_chunk_bytes': settings['bulk_max_bytes'],
+            'raise_on_error': False,
+            'raise_on_exception': False,
+            'request_timeout': settings['bulk_timeout'],
+        }
+        in_flight = settings['bulk_in_flight']
+        sent = collections.deque()
+        if spool is not None:
+            actions = _remember(actions, sent)
+        if in_flight > 1:
+            actions = _labelled(actions, metrics.current_labels())
+            # parallel_bulk 的任务队列是有界的，最多 in_flight 个请求在途、in_flight 个块在排队
+            results = helpers.parallel_bulk(_TimedClient(es), actions, thread_count=in_flight, queue_size=in_flight,
+                                            **kwargs)
+        else:
+            results = helpers.streaming_bulk(_TimedClient(es), actions, **kwargs)
+        for ok, item in results:
+            info = next(iter(item.values()))
+            record_item(result, ok, info)
+            if spool is not None:
+                action = sent.popleft()
+                if not ok:
+                    result['spooled'] += spool_failed(spool, [(ok, info)], [_encode(action)[1]])
+            if on_item is not None:
+                on_item(ok, info)
+
+    if expected_status:
+        result['expected'] = expected[0]
+        result['failed'] -= expected[0]
+        result['errors'] = [e for e in result['errors'] if e['status'] not in expected_status]
+    metrics.inc('sync_docs_indexed_total', result['success'])
+    metrics.inc('sync_docs_failed_total', result['failed'])
+    if result['failed']:
+        logger.warning('bulk 提交有 %s 条失败，部分失败详情：%s' % (result['failed'], result['errors'][:3]))
+    return result
@@ -0,0 +1,131 @@
+"""
+同步进度的检查点
+
+每个（表, 时间段）任务在 bulk 全部成功之后才标记为完成，
+水位（下次同步的开始时间）只有在它之前的任务全部完成后才会前进，
+进程崩溃后重新运行只会重做没完成的任务
+
+keyset 增量模式下，每张表记录一个高水位（已同步的最后一条记录的排序键）
+"""
+import datetime
+import os
+import sqlite3
+import threading
+
+date_fmt = '%Y-%m-%d %H:%M:%S'
+
+
+class CheckpointStore:
+    """
+    基于 SQLite 的检查点存储，可以被多个进程同时使用（每个进程各自打开连接）
+    :param path: SQLite 文件路径
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _db(self):
+        # fork 之后不能复用父进程的连接
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    tbl_index TEXT, start TEXT, end TEXT,
+                    done INTEGER DEFAULT 0, docs INTEGER DEFAULT 0, updated_at TEXT,
+                    PRIMARY KEY (tbl_index, start, end)
+                )""")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS hwm (
+                    tbl_index TEXT PRIMARY KEY, created_time TEXT, subject_id INTEGER, article_detail_id INTEGER,
+                    updated_at TEXT
+                )""")
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            row = self._db().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value):
+        with self._lock:
+            self._db().execute('REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def plan(self, tasks, planned_until):
+        """
+        登记新拆分出来的任务，并把已拆分到的时间一起更新，在同一个事务中完成
+        :param tasks: 任务 list，包含 tbl_index、start、end
+        :param planned_until: 任务已经覆盖到的时间（不含）
+        """
+        with self._lock:
+            db = self._db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.executemany('INSERT OR IGNORE INTO tasks (tbl_index, start, end) VALUES (?, ?, ?)',
+                               [(t['tbl_index'], t['start'], t['end']) for t in tasks])
+                db.execute("REPLACE INTO meta (key, value) VALUES ('planned_until', ?)", (planned_until,))
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    def pending(self):
+        """所有未完成的任务，包括之前崩溃或失败留下来的"""
+        with self._lock:
+            rows = self._db().execute('SELECT tbl_index, start, end FROM tasks WHERE done = 0').fetchall()
+        return [{'tbl_index': r[0], 'start': r[1], 'end': r[2]} for r in rows]
+
+    def mark_done(self, task, docs=0):
+        """任务的数据已经全部写入 ES"""
+        now = datetime.datetime.now().strftime(date_fmt)
+        with self._lock:
+            self._db().execute('UPDATE tasks SET done = 1, docs = ?, updated_at = ? '
+                               'WHERE tbl_index = ? AND start = ? AND end = ?',
+                               (docs, now, task['tbl_index'], task['start'], task['end']))
+
+    def advance(self):
+        """
+        推进水位到最早一个未完成任务的开始时间，没有未完成的任务就推进到已拆分到的时间，
+        并清理水位之前已完成的任务
+        :return: 新的水位，没有登记过任务时返回 None
+        """
+        with self._lock:
+            db = self._db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute('SELECT MIN(start) FROM tasks WHERE done = 0').fetchone()
+                watermark = row[0]
+                if watermark is None:
+                    row = db.execute("SELECT value FROM meta WHERE key = 'planned_until'").fetchone()
+                    watermark = row[0] if row else None
+                if watermark is not None:
+                    db.execute("REPLACE INTO meta (key, value) VALUES ('watermark', ?)", (watermark,))
+                    db.execute('DELETE FROM tasks WHERE done = 1 AND start < ?', (watermark,))
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        return watermark
+
+    def get_hwm(self, tbl_index):
+        """
+        表的高水位，即已经同步的最后一条记录的排序键
+        :return: (created_time, subject_id, article_detail_id)，没有记录时返回 None
+        """
+        with self._lock:
+            row = self._db().execute('SELECT created_time, subject_id, article_detail_id FROM hwm '
+                                     'WHERE tbl_index = ?', (tbl_index,)).fetchone()
+        return tuple(row) if row else None
+
+    def set_hwm(self, tbl_index, key):
+        """一页数据全部写入 ES 之后更新表的高水位"""
+        now = datetime.datetime.now().strftime(date_fmt)
+        with self._lock:
+            self._db().execute('REPLACE INTO hwm (tbl_index, created_time, subject_id, article_detail_id, updated_at) '
+                               'VALUES (?, ?, ?, ?, ?)', (tbl_index, *key, now))
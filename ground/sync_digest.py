@@ -0,0 +1,133 @@
+"""
+文档变化检测
+
+本地 SQLite 中按文档 ID（client_id-subject_id-article_detail_id）保存文档内容的 64 位哈希，
+转换之后、提交 ES 之前去掉内容没有变化的文档。补数据和失败重试时大部分文档都没有变化，
+可以省掉大部分 bulk 流量
+
+哈希只在文档确认写入成功之后才保存，写入失败的文档下次还会重新提交
+"""
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from sync_bulk import json_default
+
+
+def digest(source):
+    """
+    文档内容的 64 位哈希（有符号，SQLite INTEGER 可以直接保存）
+    固定用标准库 json、按键排序后计算，和 bulk 用哪个序列化器、字段的先后顺序无关，
+    切换 bulk_serializer、operation_lookup 不会让没有变化的文档看起来变了
+    """
+    data = json.dumps(source, default=json_default, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+    return int.from_bytes(hashlib.blake2b(data.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+class DigestStore:
+    """
+    文档哈希存储，一个进程内的线程共享一个实例
+    :param path: SQLite 文件路径
+    :param batch_size: 每次查询、写入的文档数
+    """
+
+    def __init__(self, path, batch_size=500):
+        self.path = path
+        self.batch_size = batch_size
+        self.stats = {'digest_hits': 0, 'digest_misses': 0}
+        self._lock = threading.Lock()
+        self._confirmed = []
+        self._conn = None
+        self._pid = None
+
+    def _db(self):
+        # fork 之后不能复用父进程的连接
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS digests '
+                               '(id TEXT PRIMARY KEY, digest INTEGER, updated_at INTEGER)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_digests_updated_at ON digests (updated_at)')
+            self._pid = os.getpid()
+        return self._conn
+
+    def _filter_batch(self, actions, pending):
+        digests = [digest(a['_source']) for a in actions]
+        ids = [a['_id'] for a in actions]
+        with self._lock:
+            rows = self._db().execute('SELECT id, digest FROM digests WHERE id IN (%s)' % ','.join('?' * len(ids)),
+                                      ids).fetchall()
+            known = dict(rows)
+            changed = []
+            for action, _digest in zip(actions, digests):
+                if known.get(action['_id']) == _digest:
+                    self.stats['digest_hits'] += 1
+                    continue
+                self.stats['digest_misses'] += 1
+                pending[action['_id']] = _digest
+                changed.append(action)
+        return changed
+
+    @contextlib.contextmanager
+    def submission(self):
+        """
+        一次 bulk 提交的变化检测
+        :return: 上下文管理器，得到 (filter, confirm)：filter 过滤提交的 actions，confirm 作为每个文档结果的回调。
+                 提交结束（包括出错）时丢掉还没有回报结果的文档的哈希，守护模式下不会越积越多
+        """
+        pending = {}
+        try:
+            yield functools.partial(self.filter, pending=pending), functools.partial(self.confirm, pending=pending)
+        finally:
+            with self._lock:
+                pending.clear()
+
+    def filter(self, actions, pending):
+        """
+        去掉内容没有变化的文档
+        :param actions: helpers 格式的 action 的可迭代对象
+        :param pending: 文档 ID => 哈希，提交之后等待结果的文档，见 submission()
+        :return: 生成器，只返回新的或者有变化的 action
+        """
+        batch = []
+        for action in actions:
+            batch.append(action)
+            if len(batch) >= self.batch_size:
+                yield from self._filter_batch(batch, pending)
+                batch = []
+        if batch:
+            yield from self._filter_batch(batch, pending)
+
+    def confirm(self, ok, info, pending):
+        """bulk 中每个文档的结果回调，写入成功的文档才保存哈希，pending 见 filter()"""
+        with self._lock:
+            _digest = pending.pop(info.get('_id'), None)
+            if ok and _digest is not None:
+                self._confirmed.append((info['_id'], _digest, int(time.time())))
+            if len(self._confirmed) >= self.batch_size:
+                self._flush()
+
+    def _flush(self):
+        if self._confirmed:
+            self._db().executemany('REPLACE INTO digests (id, digest, updated_at) VALUES (?, ?, ?)', self._confirmed)
+            self._confirmed = []
+
+    def flush(self):
+        """保存还在缓冲区里的哈希"""
+        with self._lock:
+            self._flush()
+
+    def evict(self, max_age):
+        """
+        删除超过 max_age 秒没有更新的哈希
+        :return: 删除的条数
+        """
+        with self._lock:
+            cursor = self._db().execute('DELETE FROM digests WHERE updated_at < ?', (int(time.time() - max_age),))
+        return cursor.rowcount
@@ -0,0 +1,238 @@
+"""
+数据库（读取端）限流
+
+同步最多有 进程数 × 线程数 个大查询同时压在生产库上，白天会影响业务。这里对所有进程统一限制：
+
+- 令牌桶：每秒开始的查询数、每秒读取的行数
+- 同时执行的语句数：每个名额一个锁文件，用 flock 占用，进程退出（包括被杀掉）时内核自动释放
+- 负载检查：定期查询 Threads_running 或者从库延迟，超过阈值时暂停开始新的查询，恢复正常后继续
+
+等待只发生在语句开始之前（statement()）。流式读取时语句要到读完结果才结束，读到一半暂停的话，
+服务端的线程一直停在 Sending to client 状态，照样计入 Threads_running 并占着语句名额，
+负载检查看到的负载反而因为暂停降不下来。所以读取过程中只记下读了多少行（rows()），
+超出行数预算的部分由下一条语句开始前等待补上
+
+可以只在 hours 指定的时间段（比如白天）生效，其余时间全速同步
+
+令牌桶和负载检查的状态放在共享内存里，需要在启动子进程之前创建，fork 出来的子进程共用
+"""
+import contextlib
+import fcntl
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from sync_metrics import metrics
+
+logger = logging.getLogger('SyncData2ES')
+
+
+class TokenBucket:
+    """
+    多进程共享的令牌桶
+    :param rate: 每秒补充的令牌数，0 表示不限制
+    :param burst: 桶的容量，默认为 1 秒的令牌数
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        # [剩余令牌数, 上次补充的时间]
+        self._state = multiprocessing.RawArray('d', [self.burst, time.time()])
+        self._lock = multiprocessing.Lock()
+
+    def acquire(self, n=1):
+        """
+        取 n 个令牌，不够时等待；n 超过桶的容量时桶满就放行，欠下的令牌由之后的请求等待补上。
+        n 为 0 时只等到之前欠下的令牌补上
+        :return: 等待的秒数
+        """
+        if self.rate <= 0:
+            return 0.0
+        need = min(n, self.burst)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.time()
+                tokens = min(self.burst, self._state[0] + (now - self._state[1]) * self.rate)
+                self._state[1] = now
+                if tokens >= need:
+                    self._state[0] = tokens - n
+                    return waited
+                self._state[0] = tokens
+                wait = (need - tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def charge(self, n):
+        """扣掉 n 个令牌，不等待，不够时欠下，由之后的 acquire() 等待补上"""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.time()
+            self._state[0] = min(self.burst, self._state[0] + (now - self._state[1]) * self.rate) - n
+            self._state[1] = now
+
+
+class StatementSlots:
+    """
+    多进程共享的语句名额，每个名额对应 directory 下的一个锁文件
+    :param directory: 锁文件所在的目录，不存在时自动创建
+    :param size: 名额数
+    :param poll_interval: 名额用完时重试的间隔（秒）
+    """
+
+    def __init__(self, directory, size, poll_interval=0.05):
+        self.directory = directory
+        self.size = size
+        self.poll_interval = poll_interval
+        os.makedirs(directory, exist_ok=True)
+
+    def acquire(self):
+        """
+        占用一个名额，没有空闲的名额时等待
+        :return: (锁文件的 fd，等待的秒数)，用完调用 release(fd)
+        """
+        _start = time.time()
+        # 各个线程从不同的名额开始找，减少冲突
+        offset = threading.get_ident() % self.size
+        while True:
+            for i in range(self.size):
+                fd = os.open(os.path.join(self.directory, 'slot-%s.lock' % ((offset + i) % self.size)),
+                             os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd, time.time() - _start
+                except OSError:
+                    os.close(fd)
+            time.sleep(self.poll_interval)
+
+    @staticmethod
+    def release(fd):
+        # 关闭文件就释放了锁
+        os.close(fd)
+
+
+def parse_hours(value):
+    """
+    解析生效的时间段
+    :param value: 'H-H'，比如 '8-20' 表示 8:00 到 20:00，'22-6' 跨零点；空表示全天
+    :return: (开始, 结束) 小时，全天时返回 None
+    """
+    if not value:
+        return None
+    start, end = (int(v) for v in str(value).split('-'))
+    if not (0 <= start <= 24 and 0 <= end <= 24):
+        raise ValueError('时间段 %s 不合法' % value)
+    return start, end
+
+
+class LoadGovernor:
+    """
+    数据库读取的限流器，所有进程、线程共享
+    :param queries_per_sec: 每秒最多开始的查询数，0 表示不限制
+    :param rows_per_sec: 每秒最多读取的行数，0 表示不限制
+    :param max_statements: 同时执行的语句数上限，0 表示不限制
+    :param slot_dir: 语句名额的锁文件目录，max_statements 大于 0 时需要
+    :param hours: 生效的时间段，见 parse_hours()，不在时间段内时不做任何限制
+    :param check: 负载检查函数，返回 (是否过载, 说明)，None 表示不检查
+    :param check_interval: 两次负载检查的最小间隔（秒），过载时也按这个间隔重新检查
+    """
+
+    def __init__(self, queries_per_sec=0, rows_per_sec=0, max_statements=0, slot_dir=None, hours=None,
+                 check=None, check_interval=10):
+        self.query_bucket = TokenBucket(queries_per_sec)
+        self.row_bucket = TokenBucket(rows_per_sec)
+        self.slots = StatementSlots(slot_dir, max_statements) if max_statements > 0 else None
+        self.hours = parse_hours(hours)
+        self.check = check
+        self.check_interval = check_interval
+        self.enabled = bool(queries_per_sec > 0 or rows_per_sec > 0 or self.slots or check)
+        self.stats = {'waits': 0, 'wait_time': 0.0, 'pauses': 0, 'pause_time': 0.0}
+        # [上次检查的时间, 是否过载]
+        self._health = multiprocessing.RawArray('d', [0.0, 0.0])
+        self._health_lock = multiprocessing.Lock()
+        self._stats_lock = threading.Lock()
+
+    def active(self):
+        """当前是否需要限流"""
+        if not self.enabled:
+            return False
+        if self.hours is None:
+            return True
+        start, end = self.hours
+        hour = time.localtime().tm_hour
+        return start <= hour < end if start <= end else hour >= start or hour < end
+
+    def _record(self, kind, seconds, reason):
+        """
+        :param kind: wait 等待令牌、名额，pause 负载过高暂停
+        """
+        if seconds <= 0:
+            return
+        with self._stats_lock:
+            self.stats[kind + 's'] += 1
+            self.stats[kind + '_time'] += seconds
+        metrics.inc('sync_db_throttle_seconds_total', seconds, reason=reason)
+
+    @contextlib.contextmanager
+    def statement(self):
+        """
+        执行一条语句（从开始查询到读完结果），开始前等待负载正常、查询令牌、之前读取欠下的行数令牌和语句名额，
+        语句执行过程中不再等待，见模块说明
+        """
+        if not self.active():
+            yield
+            return
+        self.wait_healthy()
+        self._record('wait', self.query_bucket.acquire(), 'queries')
+        self._record('wait', self.row_bucket.acquire(0), 'rows')
+        fd = None
+        if self.slots is not None:
+            fd, waited = self.slots.acquire()
+            self._record('wait', waited, 'statements')
+        try:
+            yield
+        finally:
+            if fd is not None:
+                self.slots.release(fd)
+
+    def rows(self, n):
+        """读取了 n 行，只扣行数令牌不等待，超出预算时由下一条语句开始前等待，见 statement()"""
+        if not n or not self.active():
+            return
+        self.row_bucket.charge(n)
+
+    def _stressed(self):
+        """按需做一次负载检查，同一时间只有一个线程（进程）在检查，其他的用上次的结果"""
+        with self._health_lock:
+            now = time.time()
+            due = now - self._health[0] >= self.check_interval
+            if due:
+                self._health[0] = now
+            stressed = bool(self._health[1])
+        if not due:
+            return stressed
+        stressed, detail = self.check()
+        with self._health_lock:
+            if bool(self._health[1]) != stressed:
+                if stressed:
+                    logger.warning('数据库负载过高（%s），暂停开始新的查询' % detail)
+                else:
+                    logger.info('数据库负载恢复正常（%s），继续读取' % detail)
+            self._health[1] = 1.0 if stressed else 0.0
+        return stressed
+
+    def wait_healthy(self):
+        """数据库负载过高时等待，直到恢复正常或者离开生效的时间段"""
+        if self.check is None:
+            return
+        _start = time.time()
+        paused = False
+        while self._stressed() and self.active():
+            paused = True
+            time.sleep(self.check_interval)
+        if paused:
+            self._record('pause', time.time() - _start, 'stressed')
@@ -0,0 +1,141 @@
+"""
+article_operation 批量查询
+
+100 张 stat_article_subject_N 表每张都 LEFT JOIN 一次 article_operation，同一个 article_detail_id
+又会出现在很多专题和表里。这里只读 sas.* 字段，再用 IN (...) 批量查 article_operation，
+同一个任务内查过的 article_detail_id 放在 LRU 缓存里，减少主库的压力
+
+缓存不跨任务：操作字段随时会变，跨任务缓存的话同步会写入过时的值；而操作字段的增量同步
+（sync_operations）遇到 ES 里还没有的文档会跳过那次变更，由同步带上当时的值，过时的值就再也不会被纠正
+"""
+import collections
+import threading
+
+from sync_metrics import metrics
+from sync_rows import RowBatch
+
+
+class LRUCache:
+    """
+    线程安全的 LRU 缓存
+    :param max_size: 最多缓存的条数
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: (是否命中, 值)
+        """
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return True, self._data[key]
+            return False, None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+
+class OperationLookup:
+    """
+    批量查询并补全记录中 article_operation 的字段，没有操作记录的补 None（和 LEFT JOIN 一致）
+    :param pool: 数据库连接池，见 sync_pool.ConnectionPool
+    :param fields: article_operation 中要补全的字段
+    :param cache_size: 每个任务最多缓存的 article_detail_id 数，见 resolver()
+    :param batch_size: 每次 IN 查询的 ID 数
+    """
+
+    def __init__(self, pool, fields, cache_size=100000, batch_size=1000):
+        self.pool = pool
+        self.fields = fields
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        # 多个线程共用，更新时加锁
+        self.stats = {'queries': 0, 'hits': 0, 'misses': 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, **counts):
+        with self._stats_lock:
+            for k, v in counts.items():
+                self.stats[k] += v
+
+    def resolver(self):
+        """
+        一个任务用的补全函数，缓存只在这个任务内有效，见模块说明
+        :return: 函数，参数和返回值同 attach()
+        """
+        cache = LRUCache(self.cache_size)
+        return lambda rows: self.attach(rows, cache)
+
+    def _query(self, ids):
+        sql = f"""
+            /* Sync data 2 ES (operation lookup) */
+            SELECT article_detail_id, {','.join(self.fields)}
+            FROM article_operation
+            WHERE article_detail_id IN ({','.join(['%s'] * len(ids))})
+            """
+        with self.pool.connection() as db, db.cursor() as cursor, \
+                metrics.timer('sync_stage_seconds', stage='operation_lookup'):
+            cursor.execute(sql, ids)
+            self._count(queries=1)
+            return {r['article_detail_id']: tuple(r[f] for f in self.fields) for r in cursor.fetchall()}
+
+    def _resolve(self, ids, cache):
+        """
+        :param ids: article_detail_id 的可迭代对象
+        :param cache: LRUCache，article_detail_id => 字段值 tuple（没有操作记录时为 None）
+        :return: dict，article_detail_id => 字段值 tuple（没有操作记录时为 None）
+        """
+        found = {}
+        missing = []
+        for detail_id in set(ids):
+            hit, value = cache.get(detail_id)
+            if hit:
+                found[detail_id] = value
+            else:
+                missing.append(detail_id)
+        self._count(hits=len(found), misses=len(missing))
+
+        for i in range(0, len(missing), self.batch_size):
+            ids = missing[i:i + self.batch_size]
+            result = self._query(ids)
+            for detail_id in ids:
+                value = result.get(detail_id)
+                cache.put(detail_id, value)
+                found[detail_id] = value
+        return found
+
+    def attach(self, rows, cache=None):
+        """
+        补全一批记录的操作字段
+        :param rows: 数据库记录（dict）的 list 或者 sync_rows.RowBatch，会被原地修改
+        :param cache: 查询结果的缓存，None 表示只在这一批内有效，见 resolver()
+        :return: rows
+        """
+        if cache is None:
+            cache = LRUCache(self.cache_size)
+        if isinstance(rows, RowBatch):
+            return self._attach_batch(rows, cache)
+        found = self._resolve((r['article_detail_id'] for r in rows), cache)
+        empty = (None,) * len(self.fields)
+        fields = self.fields
+        for r in rows:
+            r.update(zip(fields, found[r['article_detail_id']] or empty))
+        return rows
+
+    def _attach_batch(self, batch, cache):
+        ids = batch.column('article_detail_id')
+        found = self._resolve(ids, cache)
+        empty = (None,) * len(self.fields)
+        values = [found[detail_id] or empty for detail_id in ids]
+        batch.add_columns(self.fields, [list(column) for column in zip(*values)] if values
+                          else [[] for _ in self.fields])
+        return batch
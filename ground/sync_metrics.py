@@ -0,0 +1,202 @@
+"""
+同步的监控指标
+
+每个进程在 metrics 里记录计数器和耗时直方图，带 stage（阶段）、table（表）、process（进程）标签，
+进程结束时把 snapshot() 上报给主进程，主进程合并之后写成 Prometheus textfile（给 node_exporter 的
+textfile collector 采集）和 JSON 报告，可以长期跟踪吞吐和长尾耗时
+
+表名标签由工作线程用 metrics.labels(table=...) 设置，同一个线程内后续记录的指标都会带上
+"""
+import contextlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+# 耗时直方图的桶（秒）
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class MetricsRegistry:
+    """
+    计数器和直方图，线程安全
+    :param buckets: 直方图的桶上界（秒），从小到大
+    """
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counters = {}
+        self._histograms = {}
+
+    def reset(self):
+        """清空已记录的指标，子进程开始工作前调用，不带上父进程的数据"""
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def current_labels(self):
+        """当前线程通过 labels() 设置的标签"""
+        return getattr(self._local, 'labels', {})
+
+    @contextlib.contextmanager
+    def labels(self, **labels):
+        """在当前线程内给之后记录的指标加上标签"""
+        previous = self.current_labels()
+        self._local.labels = {**previous, **labels}
+        try:
+            yield
+        finally:
+            self._local.labels = previous
+
+    def _key(self, name, labels):
+        labels = {**self.current_labels(), **labels, 'process': multiprocessing.current_process().name}
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """计数器加 value"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """直方图记录一个值"""
+        key = self._key(name, labels)
+        with self._lock:
+            # 各个桶（不累计）的个数，最后一个是超出所有桶的个数，再加上总和
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            i = 0
+            while i < len(self.buckets) and value > self.buckets[i]:
+                i += 1
+            hist[i] += 1
+            hist[-1] += value
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """记录代码块的耗时"""
+        _start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - _start, **labels)
+
+    def snapshot(self):
+        """当前的所有指标，可以 pickle，用于跨进程上报"""
+        with self._lock:
+            return {
+                'buckets': self.buckets,
+                'counters': dict(self._counters),
+                'histograms': {key: list(hist) for key, hist in self._histograms.items()},
+            }
+
+
+def merge(snapshots):
+    """合并多个进程的 snapshot()，同名同标签的指标相加"""
+    merged = {'buckets': default_buckets, 'counters': {}, 'histograms': {}}
+    for snapshot in snapshots:
+        merged['buckets'] = snapshot['buckets']
+        for key, value in snapshot['counters'].items():
+            merged['counters'][key] = merged['counters'].get(key, 0) + value
+        for key, hist in snapshot['histograms'].items():
+            total = merged['histograms'].get(key)
+            merged['histograms'][key] = hist if total is None else [a + b for a, b in zip(total, hist)]
+    return merged
+
+
+def quantile(q, buckets, hist):
+    """
+    按直方图估算分位数，桶内线性插值（同 Prometheus 的 histogram_quantile）
+    :return: 秒，没有数据时返回 None
+    """
+    counts = hist[:-1]
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(counts):
+        if seen + count >= rank and count:
+            if i == len(buckets):
+                return buckets[-1]
+            lower = buckets[i - 1] if i else 0
+            return lower + (buckets[i] - lower) * (rank - seen) / count
+        seen += count
+    return buckets[-1]
+
+
+def summarize(snapshot, name, by):
+    """
+    按某个标签汇总一个直方图
+    :param by: 标签名，比如 stage
+    :return: dict，标签值 => {count, sum, p50, p99}
+    """
+    groups = {}
+    for (metric, labels), hist in snapshot['histograms'].items():
+        if metric != name:
+            continue
+        value = dict(labels).get(by)
+        total = groups.get(value)
+        groups[value] = hist if total is None else [a + b for a, b in zip(total, hist)]
+    return {value: {
+        'count': sum(hist[:-1]),
+        'sum': hist[-1],
+        'p50': quantile(0.5, snapshot['buckets'], hist),
+        'p99': quantile(0.99, snapshot['buckets'], hist),
+    } for value, hist in groups.items()}
+
+
+def _format_labels(labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+
+def _write_atomic(path, text):
+    with open(path + '.tmp', 'w') as w:
+        w.write(text)
+    os.replace(path + '.tmp', path)
+
+
+def write_prometheus(path, snapshot):
+    """写成 Prometheus textfile 格式，先写临时文件再替换，采集时不会读到一半的文件"""
+    lines = []
+    for name in sorted({key[0] for key in snapshot['counters']}):
+        lines.append('# TYPE %s counter' % name)
+        for (metric, labels), value in sorted(snapshot['counters'].items()):
+            if metric == name:
+                lines.append('%s{%s} %s' % (name, _format_labels(labels), value))
+    for name in sorted({key[0] for key in snapshot['histograms']}):
+        lines.append('# TYPE %s histogram' % name)
+        for (metric, labels), hist in sorted(snapshot['histograms'].items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(list(snapshot['buckets']) + ['+Inf'], hist[:-1]):
+                cumulative += count
+                lines.append('%s_bucket{%s} %s' % (name, _format_labels(labels + (('le', bound),)), cumulative))
+            lines.append('%s_sum{%s} %s' % (name, _format_labels(labels), hist[-1]))
+            lines.append('%s_count{%s} %s' % (name, _format_labels(labels), cumulative))
+    _write_atomic(path, '\n'.join(lines) + '\n')
+
+
+def write_json(path, snapshot, **extra):
+    """
+    写成 JSON 报告：各阶段的次数、总耗时、p50、p99，以及所有原始指标
+    :param extra: 额外写入报告的字段，比如本次同步的耗时、吞吐
+    """
+    report = {
+        **extra,
+        'stages': summarize(snapshot, 'sync_stage_seconds', 'stage'),
+        'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                     for (name, labels), value in sorted(snapshot['counters'].items())],
+        'histograms': [{'name': name, 'labels': dict(labels), 'buckets': snapshot['buckets'],
+                        'counts': hist[:-1], 'sum': hist[-1]}
+                       for (name, labels), hist in sorted(snapshot['histograms'].items())],
+    }
+    _write_atomic(path, json.dumps(report, ensure_ascii=False, indent=2))
+
+
+# 当前进程的指标
+metrics = MetricsRegistry()
@@ -0,0 +1,191 @@
+"""
+分阶段流水线：读取 -> 转换 -> 写入
+
+每个阶段有自己的线程池，阶段之间用有界队列连接，ES 变慢时写入队列满了，
+转换和读取会自然地阻塞下来（背压）。定时打印每个阶段的队列深度和吞吐，
+可以看出瓶颈在哪个阶段，再分别调整各个阶段的线程数
+"""
+import contextlib
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger('SyncData2ES')
+
+
+class StageStats:
+    """一个阶段处理的记录数和忙碌时间"""
+
+    def __init__(self):
+        self.items = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items, busy):
+        with self._lock:
+            self.items += items
+            self.busy += busy
+
+
+class Pipeline:
+    """
+    流水线
+    :param read: task => 生成器，每次返回一批记录（list）
+    :param transform: 一批记录 => 一批 action（list）
+    :param write: 一批 action => bulk 提交结果（success、failed，可选 spooled）
+    :param on_task_done: 一个任务的所有批次都写完时回调 (task, result, error)
+    :param readers: 读取线程数
+    :param transformers: 转换线程数
+    :param writers: 写入线程数
+    :param queue_size: 阶段之间队列的容量（批）
+    :param log_interval: 打印各阶段状态的间隔（秒），0 表示不打印
+    :param context: task => 上下文管理器，各阶段处理这个任务的批次时进入，比如给监控指标加上表名
+    """
+
+    def __init__(self, read, transform, write, on_task_done,
+                 readers=2, transformers=1, writers=4, queue_size=8, log_interval=10, context=None):
+        self._read = read
+        self._transform = transform
+        self._write = write
+        self._on_task_done = on_task_done
+        self._sizes = {'read': readers, 'transform': transformers, 'write': writers}
+        self._log_interval = log_interval
+        self._context = context or (lambda task: contextlib.nullcontext())
+        self._transform_queue = queue.Queue(queue_size)
+        self._write_queue = queue.Queue(queue_size)
+        self._states = {}
+        self._states_lock = threading.Lock()
+        self.stats = {'read': StageStats(), 'transform': StageStats(), 'write': StageStats()}
+
+    # 任务状态：还没写完的批次数、是否读完、合并的结果
+    def _task_state(self, task):
+        key = id(task)
+        with self._states_lock:
+            if key not in self._states:
+                self._states[key] = {'task': task, 'pending': 0, 'reading': True,
+                                     'result': {'success': 0, 'failed': 0, 'spooled': 0}, 'error': None}
+            return self._states[key]
+
+    def _update_task(self, task, pending=0, reading=None, result=None, error=None):
+        with self._states_lock:
+            state = self._states[id(task)]
+            state['pending'] += pending
+            if reading is not None:
+                state['reading'] = reading
+            if result is not None:
+                for key in state['result']:
+                    state['result'][key] += result.get(key, 0)
+            if error is not None and state['error'] is None:
+                state['error'] = error
+            finished = not state['reading'] and state['pending'] == 0
+            if finished:
+                del self._states[id(task)]
+        if finished:
+            self._on_task_done(state['task'], state['result'], state['error'])
+
+    def _reader(self, next_task):
+        while True:
+            task = next_task()
+            if task is None:
+                break
+            self._task_state(task)
+            try:
+                with self._context(task):
+                    _start = time.time()
+                    for rows in self._read(task):
+                        self.stats['read'].add(len(rows), time.time() - _start)
+                        self._update_task(task, pending=1)
+                        # 队列满了就阻塞，这就是背压
+                        self._transform_queue.put((task, rows))
+                        _start = time.time()
+                self._update_task(task, reading=False)
+            except Exception as e:
+                logger.exception('任务 %s 读取失败：%s' % (task, e))
+                self._update_task(task, reading=False, error=e)
+
+    def _transformer(self):
+        while True:
+            item = self._transform_queue.get()
+            if item is None:
+                break
+            task, rows = item
+            _start = time.time()
+            try:
+                with self._context(task):
+                    actions = self._transform(rows)
+            except Exception as e:
+                logger.exception('任务 %s 转换失败：%s' % (task, e))
+                self._update_task(task, pending=-1, result={'success': 0, 'failed': len(rows)}, error=e)
+                continue
+            self.stats['transform'].add(len(rows), time.time() - _start)
+            self._write_queue.put((task, actions))
+
+    def _writer(self):
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                break
+            task, actions = item
+            _start = time.time()
+            try:
+                with self._context(task):
+                    result = self._write(actions)
+                error = None
+            except Exception as e:
+                logger.exception('任务 %s 写入失败：%s' % (task, e))
+                result = {'success': 0, 'failed': len(actions)}
+                error = e
+            self.stats['write'].add(len(actions), time.time() - _start)
+            self._update_task(task, pending=-1, result=result, error=error)
+
+    def _log_stats(self, elapsed):
+        parts = []
+        for name, label, stage_queue in (('read', '读取', None), ('transform', '转换', self._transform_queue),
+                                         ('write', '写入', self._write_queue)):
+            stats = self.stats[name]
+            part = '%s %s 线程 %.0f 条/s 忙碌 %.0f%%' % (
+                label, self._sizes[name], stats.items / elapsed if elapsed else 0,
+                100 * stats.busy / (elapsed * self._sizes[name]) if elapsed else 0)
+            if stage_queue is not None:
+                part += ' 队列 %s/%s' % (stage_queue.qsize(), stage_queue.maxsize)
+            parts.append(part)
+        logger.info('流水线状态：' + '；'.join(parts))
+
+    def run(self, next_task):
+        """
+        执行任务直到 next_task() 返回 None
+        :param next_task: 获取下一个任务的函数，线程安全
+        """
+        _start = time.time()
+        readers = [threading.Thread(target=self._reader, args=(next_task,), name=f'Reader-{i}')
+                   for i in range(self._sizes['read'])]
+        transformers = [threading.Thread(target=self._transformer, name=f'Transformer-{i}')
+                        for i in range(self._sizes['transform'])]
+        writers = [threading.Thread(target=self._writer, name=f'Writer-{i}')
+                   for i in range(self._sizes['write'])]
+        for t in readers + transformers + writers:
+            t.start()
+
+        stop = threading.Event()
+
+        def monitor():
+            while not stop.wait(self._log_interval):
+                self._log_stats(time.time() - _start)
+
+        if self._log_interval:
+            threading.Thread(target=monitor, name='Monitor', daemon=True).start()
+
+        # 上游全部结束后，给下游每个线程发一个结束标记
+        for t in readers:
+            t.join()
+        for _ in transformers:
+            self._transform_queue.put(None)
+        for t in transformers:
+            t.join()
+        for _ in writers:
+            self._write_queue.put(None)
+        for t in writers:
+            t.join()
+        stop.set()
+        self._log_stats(time.time() - _start)
@@ -0,0 +1,141 @@
+"""
+进程内的数据库连接池和按进程缓存的对象
+
+连接（socket）不能跨进程共享，fork 出来的子进程要重新建立，
+所以这里的缓存都以进程 ID 区分
+"""
+import contextlib
+import functools
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger('SyncData2ES')
+
+
+def per_process(factory):
+    """
+    装饰器：每个进程只调用一次 factory，之后返回缓存的结果，线程安全
+    :param factory: 无参数的工厂函数
+    :return: 包装后的函数，cache_clear() 可以清除当前进程的缓存
+    """
+    cache = {}
+    lock = threading.Lock()
+
+    @functools.wraps(factory)
+    def wrapper():
+        pid = os.getpid()
+        if pid not in cache:
+            with lock:
+                if pid not in cache:
+                    cache.clear()
+                    cache[pid] = factory()
+        return cache[pid]
+
+    wrapper.cache_clear = cache.clear
+    return wrapper
+
+
+class ConnectionPool:
+    """
+    简单的数据库连接池
+    :param connect: 建立新连接的函数，连接会被之后的任务复用，需要是 autocommit 的，见 es_sync_data.connect_db()
+    :param max_size: 最多同时借出的连接数，超过时阻塞等待
+    :param ping_interval: 连接空闲超过这个秒数，借出前先 ping 一下检查是否可用
+    :param governor: 数据库限流，见 sync_governor.LoadGovernor，每次借出连接算一条语句
+    """
+
+    def __init__(self, connect, max_size=5, ping_interval=30, governor=None):
+        self._connect = connect
+        self._governor = governor
+        self._ping_interval = ping_interval
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._closed = False
+        self.stats = {'connects': 0, 'connect_time': 0.0, 'reuses': 0, 'discards': 0}
+
+    def _new_connection(self, connect=None):
+        _start = time.time()
+        conn = (connect or self._connect)()
+        with self._lock:
+            self.stats['connects'] += 1
+            self.stats['connect_time'] += time.time() - _start
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self.stats['discards'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _reuse(self, idle):
+        """从 idle 中取一个可用的空闲连接，没有时返回 None"""
+        while True:
+            try:
+                conn, idle_since = idle.get_nowait()
+            except queue.Empty:
+                return None
+
+            if time.time() - idle_since < self._ping_interval:
+                break
+            # 健康检查，连接已经断开的话丢弃
+            try:
+                conn.ping(reconnect=False)
+                break
+            except Exception:
+                self._discard(conn)
+
+        with self._lock:
+            self.stats['reuses'] += 1
+        return conn
+
+    def _checkout(self):
+        conn = self._reuse(self._idle)
+        return conn if conn is not None else self._new_connection()
+
+    def _checkin(self, conn):
+        self._idle.put((conn, time.time()))
+
+    @contextlib.contextmanager
+    def connection(self):
+        """借出一个连接，用完归还；使用过程中出现异常的连接直接丢弃"""
+        self._slots.acquire()
+        conn = None
+        try:
+            with self._governor.statement() if self._governor else contextlib.nullcontext():
+                conn = self._checkout()
+                yield conn
+        except Exception:
+            if conn is not None:
+                self._discard(conn)
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                if self._closed:
+                    self._discard(conn)
+                else:
+                    self._checkin(conn)
+            self._slots.release()
+
+    def close(self):
+        """关闭所有空闲连接，之后归还的连接也会被关闭"""
+        self._closed = True
+        self._close_idle(self._idle)
+
+    @staticmethod
+    def _close_idle(idle):
+        while True:
+            try:
+                conn, _ = idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.close()
+            except Exception:
+                pass
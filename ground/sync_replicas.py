@@ -0,0 +1,177 @@
+"""
+从库路由
+
+同步只执行只读的分析查询，配置了从库（config.yml 的 REPLICAS）时把查询分到各个从库上：
+
+- 按权重的最少在途查询：选 (在途查询数 + 1) / 权重 最小的从库，在途查询数是所有进程合计的
+- 连接失败、健康检查（连接、复制延迟）不通过的从库标记为不可用，一段时间内不再选择，查询换到其他从库
+- 所有从库都不可用时，按设置改读主库或者报错
+
+路由的状态放在共享内存里，需要在启动子进程之前创建，fork 出来的子进程共用
+"""
+import logging
+import multiprocessing
+import queue
+import random
+import time
+
+from sync_metrics import metrics
+from sync_pool import ConnectionPool
+
+logger = logging.getLogger('SyncData2ES')
+
+
+class ReplicaRouter:
+    """
+    从库的选择和健康状态，所有进程共享
+    :param names: 从库名称 list，用于日志和指标
+    :param weights: 权重 list，和 names 一一对应
+    :param check: 健康检查函数，参数为从库序号，返回 (是否可用, 说明)，None 表示不检查
+    :param check_interval: 每个从库两次健康检查的最小间隔（秒）
+    :param retry_interval: 从库被标记为不可用之后，过这么多秒再重新尝试
+    """
+
+    def __init__(self, names, weights, check=None, check_interval=10, retry_interval=30):
+        self.names = list(names)
+        self.weights = [float(w) for w in weights]
+        if any(w <= 0 for w in self.weights):
+            raise ValueError('从库的权重必须大于 0：%s' % dict(zip(self.names, weights)))
+        self.check = check
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        # 各个从库的在途查询数、不可用的截止时间、上次健康检查的时间
+        self._outstanding = multiprocessing.RawArray('i', len(self.names))
+        self._down_until = multiprocessing.RawArray('d', len(self.names))
+        self._checked = multiprocessing.RawArray('d', len(self.names))
+        self._lock = multiprocessing.Lock()
+
+    def _run_checks(self):
+        """到了检查时间的从库做一次健康检查，每个从库同一时间只有一个线程（进程）在检查"""
+        if self.check is None:
+            return
+        with self._lock:
+            now = time.time()
+            due = [i for i in range(len(self.names)) if now - self._checked[i] >= self.check_interval]
+            for i in due:
+                self._checked[i] = now
+        for i in due:
+            ok, detail = self.check(i)
+            if ok:
+                self.mark_up(i, detail)
+            else:
+                self.mark_down(i, detail)
+
+    def acquire(self, exclude=()):
+        """
+        选一个从库，占用一个在途查询，用完调用 release()
+        :param exclude: 不选的从库序号，比如这次已经连接失败的
+        :return: 从库序号，没有可用的从库时返回 None
+        """
+        self._run_checks()
+        with self._lock:
+            now = time.time()
+            candidates = [i for i in range(len(self.names)) if i not in exclude and self._down_until[i] <= now]
+            if not candidates:
+                return None
+            loads = {i: (self._outstanding[i] + 1) / self.weights[i] for i in candidates}
+            least = min(loads.values())
+            i = random.choice([i for i in candidates if loads[i] == least])
+            self._outstanding[i] += 1
+        return i
+
+    def release(self, i):
+        with self._lock:
+            self._outstanding[i] -= 1
+
+    def mark_down(self, i, reason):
+        """从库不可用，retry_interval 秒之内不再选择"""
+        with self._lock:
+            now = time.time()
+            was_up = self._down_until[i] <= now
+            self._down_until[i] = now + self.retry_interval
+        if was_up:
+            logger.warning('从库 %s 不可用（%s），%s 秒内不再使用' % (self.names[i], reason, self.retry_interval))
+            metrics.inc('sync_replica_failovers_total', replica=self.names[i])
+
+    def mark_up(self, i, detail):
+        """健康检查通过，不可用的从库恢复使用"""
+        with self._lock:
+            was_down = self._down_until[i] > time.time()
+            self._down_until[i] = 0.0
+        if was_down:
+            logger.info('从库 %s 恢复可用（%s）' % (self.names[i], detail))
+
+
+class ReplicaPool(ConnectionPool):
+    """
+    按 ReplicaRouter 把连接分到各个从库的连接池，接口同 ConnectionPool
+    每个从库各自保留空闲连接，借出时先选从库，再取这个从库的空闲连接或者新建连接，
+    连接失败时把从库标记为不可用，换一个从库
+    :param router: ReplicaRouter
+    :param connects: 每个从库建立新连接的函数 list，和 router.names 一一对应
+    :param fallback: 没有可用的从库时连接主库的函数，None 表示报错
+    :param max_size: 最多同时借出的连接数（所有从库合计）
+    其余参数同 ConnectionPool
+    """
+
+    def __init__(self, router, connects, fallback=None, max_size=5, ping_interval=30, governor=None):
+        super().__init__(fallback, max_size, ping_interval, governor)
+        self.router = router
+        self._connects = connects
+        self._replica_idle = [queue.LifoQueue() for _ in connects]
+        # 借出的连接 id => 从库序号，主库的连接不在这里
+        self._owners = {}
+        self._fallback_warned = 0.0
+
+    def _checkout(self):
+        failed = set()
+        while True:
+            i = self.router.acquire(failed)
+            if i is None:
+                break
+            try:
+                conn = self._reuse(self._replica_idle[i])
+                if conn is None:
+                    conn = self._new_connection(self._connects[i])
+            except Exception as e:
+                self.router.release(i)
+                self.router.mark_down(i, e)
+                failed.add(i)
+                continue
+            with self._lock:
+                self._owners[id(conn)] = i
+            metrics.inc('sync_replica_checkouts_total', replica=self.router.names[i])
+            return conn
+
+        if self._connect is None:
+            raise ConnectionError('没有可用的从库：%s' % ', '.join(self.router.names))
+        # 每个进程每 retry_interval 秒最多提示一次
+        if time.time() - self._fallback_warned >= self.router.retry_interval:
+            self._fallback_warned = time.time()
+            logger.warning('没有可用的从库，改读主库')
+        metrics.inc('sync_replica_checkouts_total', replica='primary')
+        return super()._checkout()
+
+    def _release(self, conn):
+        """归还从库的在途查询，返回从库序号，主库的连接返回 None"""
+        with self._lock:
+            i = self._owners.pop(id(conn), None)
+        if i is not None:
+            self.router.release(i)
+        return i
+
+    def _checkin(self, conn):
+        i = self._release(conn)
+        if i is None:
+            super()._checkin(conn)
+        else:
+            self._replica_idle[i].put((conn, time.time()))
+
+    def _discard(self, conn):
+        self._release(conn)
+        super()._discard(conn)
+
+    def close(self):
+        super().close()
+        for idle in self._replica_idle:
+            self._close_idle(idle)
@@ -0,0 +1,74 @@
+"""
+紧凑的记录格式
+
+DictCursor 每条记录都是一个 dict，24 个字段名在每条记录里重复一遍，大时间段的数据主要耗在 dict 上。
+row_format 为 tuple 时用普通游标读出 tuple，一批记录按列存放在 RowBatch 里，
+日期按列格式化，每个文档的 _source dict 在序列化之前才组装，用完就释放
+"""
+
+
+class RowBatch:
+    """
+    按列存放的一批记录
+    :param names: 字段名 list，和 columns 一一对应
+    :param columns: 每个字段一个 list
+    """
+    __slots__ = ('names', 'columns', '_index')
+
+    def __init__(self, names, columns):
+        self.names = list(names)
+        self.columns = columns
+        self._index = {name: i for i, name in enumerate(self.names)}
+
+    @classmethod
+    def from_rows(cls, names, rows):
+        """
+        :param names: 字段名，一般来自游标的 description
+        :param rows: tuple 记录的 list
+        """
+        columns = [list(column) for column in zip(*rows)] if rows else [[] for _ in names]
+        return cls(names, columns)
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, i):
+        """第 i 条记录，组装成 dict，只用于取个别记录"""
+        return {name: column[i] for name, column in zip(self.names, self.columns)}
+
+    def column(self, name):
+        """字段的整列数据，可以原地修改"""
+        return self.columns[self._index[name]]
+
+    def add_columns(self, names, columns):
+        """追加字段，已有的同名字段会被替换"""
+        for name, column in zip(names, columns):
+            if name in self._index:
+                self.columns[self._index[name]] = column
+            else:
+                self._index[name] = len(self.names)
+                self.names.append(name)
+                self.columns.append(column)
+
+    def rows(self):
+        """逐条返回 tuple 记录"""
+        return zip(*self.columns)
+
+
+class LazyActions:
+    """
+    一批 action，迭代时才逐个生成，可以多次迭代
+    :param batch: RowBatch
+    :param make: RowBatch => action 生成器
+    """
+    __slots__ = ('batch', 'make')
+
+    def __init__(self, batch, make):
+        self.batch = batch
+        self.make = make
+
+    def __len__(self):
+        return len(self.batch)
+
+    def __iter__(self):
+        return self.make(self.batch)
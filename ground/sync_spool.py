@@ -0,0 +1,121 @@
+"""
+bulk 失败文档的死信目录
+
+bulk 提交最终失败的文档（映射错误、版本冲突、重试之后仍然被拒绝等）连同失败原因写到本地，
+之后用 --replay 重新提交，不需要从 MySQL 重新读取整个时间段
+
+每个进程写自己的段文件，一行一个 JSON：_index、_id、op、status、error、time、source（原始请求体），
+每次写入压缩成一个独立的 gzip 成员追加到文件末尾，进程崩溃最多丢掉最后一次写入。
+正在写的段文件以 .part 结尾，写满 segment_bytes 或者一轮同步结束时改名为 .ndjson.gz，
+重放只处理改过名的段
+"""
+import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import threading
+import zlib
+
+logger = logging.getLogger('SyncData2ES')
+
+date_fmt = '%Y-%m-%d %H:%M:%S'
+
+
+class DeadLetterSpool:
+    """
+    死信目录，一个进程内的所有线程共用一个实例
+    :param directory: 目录路径，不存在时自动创建
+    :param segment_bytes: 单个段文件（压缩后）的最大字节数
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.stats = {'spooled': 0}
+        self._lock = threading.Lock()
+        self._path = None
+        self._seq = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _new_path(self):
+        self._seq += 1
+        return os.path.join(self.directory, '%s-%s-%06d.ndjson.gz.part' % (
+            datetime.datetime.now().strftime('%Y%m%d%H%M%S'), os.getpid(), self._seq))
+
+    def write(self, records):
+        """
+        写入一批失败的文档，写入并 fsync 之后才返回
+        :param records: [(详情, 操作类型, 请求体 bytes), ...]，详情中包含 _index、_id、status、error
+        :return: 写入的条数
+        """
+        if not records:
+            return 0
+        now = datetime.datetime.now().strftime(date_fmt)
+        data = bytearray()
+        for info, op_type, source in records:
+            header = json.dumps({
+                '_index': info.get('_index'),
+                '_id': info.get('_id'),
+                'op': op_type,
+                'status': info.get('status'),
+                'error': info.get('error'),
+                'time': now,
+            }, ensure_ascii=False, default=str)
+            # 请求体本身就是 JSON，直接拼进去，不再解析、序列化一遍
+            data += header[:-1].encode('utf-8') + b',"source":' + source + b'}\n'
+        member = gzip.compress(bytes(data))
+
+        with self._lock:
+            if self._path is None:
+                self._path = self._new_path()
+            with open(self._path, 'ab') as w:
+                w.write(member)
+                w.flush()
+                os.fsync(w.fileno())
+                size = w.tell()
+            self.stats['spooled'] += len(records)
+            if size >= self.segment_bytes:
+                self._seal()
+        return len(records)
+
+    def _seal(self):
+        if self._path is not None:
+            os.replace(self._path, self._path[:-len('.part')])
+            self._path = None
+
+    def seal(self):
+        """当前的段文件写完了，改名之后可以被重放"""
+        with self._lock:
+            self._seal()
+
+    def segments(self):
+        """
+        可以重放的段文件，写入进程已经不在的 .part 文件（进程崩溃留下的）也一起改名
+        :return: 段文件路径 list，按写入时间排序
+        """
+        for path in glob.glob(os.path.join(self.directory, '*.ndjson.gz.part')):
+            pid = int(os.path.basename(path).split('-')[1])
+            if pid == os.getpid():
+                continue
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                os.replace(path, path[:-len('.part')])
+            except PermissionError:
+                pass
+        return sorted(glob.glob(os.path.join(self.directory, '*.ndjson.gz')))
+
+
+def read_segment(path):
+    """
+    读取一个段文件
+    :return: 生成器，每次返回一条记录（dict）；文件末尾不完整时（写入时进程崩溃）读到哪里算哪里
+    """
+    try:
+        with gzip.open(path, 'rb') as r:
+            for line in r:
+                yield json.loads(line)
+    except (EOFError, ValueError, zlib.error) as e:
+        logger.warning('段文件 %s 不完整，忽略剩余部分：%s' % (path, e))
@@ -0,0 +1,7 @@
+"""
+同步脚本都是 ground 目录下的平铺模块，测试时把 ground 加到 sys.path
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
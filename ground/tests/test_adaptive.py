@@ -0,0 +1,133 @@
+"""
+bulk 自适应控制（BulkController）
+"""
+import threading
+import time
+
+from sync_adaptive import BulkController
+
+
+def new_controller(**overrides):
+    return BulkController(**{'in_flight': 4, 'batch_size': 2000, 'min_in_flight': 1, 'max_in_flight': 8,
+                             'min_batch_size': 200, 'max_batch_size': 3000, 'batch_step': 500,
+                             'target_latency': 1.0, **overrides})
+
+
+def test_initial_values_are_clamped():
+    controller = BulkController(in_flight=20, batch_size=10, max_in_flight=8, min_batch_size=200)
+    assert (controller.in_flight, controller.batch_size) == (8, 200)
+
+
+def test_rejection_halves_in_flight_and_batch_size():
+    controller = new_controller()
+    controller.record(0.1, 100, rejected=10)
+    assert (controller.in_flight, controller.batch_size) == (2, 1000)
+    assert controller.stats['decreases'] == 1 and controller.stats['rejected'] == 10
+
+
+def test_failure_and_slow_response_also_decrease():
+    controller = new_controller()
+    controller.record(0.1, 100, 0, failed=True)
+    assert controller.in_flight == 2
+    controller = new_controller()
+    controller.record(1.5, 100, 0)
+    assert controller.in_flight == 2
+
+
+def test_one_decrease_per_congestion_event():
+    controller = new_controller()
+    for _ in range(3):
+        controller.record(0.1, 100, rejected=1)
+    assert controller.in_flight == 2 and controller.stats['decreases'] == 1
+    # 冷却时间（target_latency）过后再减
+    controller._last_decrease -= 1.0
+    controller.record(0.1, 100, rejected=1)
+    assert controller.in_flight == 1 and controller.stats['decreases'] == 2
+
+
+def test_decrease_stops_at_the_minimum():
+    controller = new_controller(in_flight=1, batch_size=200)
+    controller.record(0.1, 100, rejected=1)
+    assert (controller.in_flight, controller.batch_size) == (1, 200)
+    assert controller.stats['decreases'] == 0
+
+
+def test_success_round_increases_up_to_the_maximum():
+    controller = new_controller(in_flight=2)
+    # 连续成功一轮（当前在途请求数个请求）才加 1
+    controller.record(0.1, 100, 0)
+    assert controller.in_flight == 2
+    controller.record(0.1, 100, 0)
+    assert (controller.in_flight, controller.batch_size) == (3, 2500)
+    for _ in range(100):
+        controller.record(0.1, 100, 0)
+    assert (controller.in_flight, controller.batch_size) == (8, 3000)
+    increases = controller.stats['increases']
+    for _ in range(20):
+        controller.record(0.1, 100, 0)
+    assert controller.stats['increases'] == increases
+
+
+def test_failure_resets_the_success_streak():
+    controller = new_controller(in_flight=2, min_in_flight=2, min_batch_size=2000)
+    controller.record(0.1, 100, 0)
+    controller.record(0.1, 100, rejected=1)
+    controller.record(0.1, 100, 0)
+    assert controller.in_flight == 2
+    controller.record(0.1, 100, 0)
+    assert controller.in_flight == 3
+
+
+def test_slot_blocks_at_the_limit():
+    controller = new_controller(in_flight=2)
+    entered = []
+    release = threading.Event()
+
+    def hold():
+        with controller.slot():
+            entered.append(1)
+            release.wait(5)
+
+    threads = [threading.Thread(target=hold) for _ in range(3)]
+    for t in threads:
+        t.start()
+    time.sleep(0.2)
+    assert len(entered) == 2
+    release.set()
+    for t in threads:
+        t.join(5)
+    assert len(entered) == 3
+
+
+def test_increase_wakes_waiting_slots():
+    controller = new_controller(in_flight=1)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with controller.slot():
+            release.wait(5)
+
+    def wait_for_slot():
+        with controller.slot():
+            entered.set()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    time.sleep(0.05)
+    waiter = threading.Thread(target=wait_for_slot)
+    waiter.start()
+    assert not entered.wait(0.2)
+    controller.record(0.1, 100, 0)
+    assert controller.in_flight == 2
+    assert entered.wait(2)
+    release.set()
+    holder.join(5)
+    waiter.join(5)
+
+
+def test_backoff_is_capped_and_counted():
+    controller = new_controller(backoff=0.5, max_backoff=2.0)
+    assert all(0 <= controller.backoff(1) <= 0.5 for _ in range(50))
+    assert all(0 <= controller.backoff(10) <= 2.0 for _ in range(50))
+    assert controller.stats['retries'] == 100
@@ -0,0 +1,106 @@
+"""
+分块 bulk 提交，对着本地的假 ES（fake_es）测试
+"""
+import pytest
+from elasticsearch import Elasticsearch
+
+import es_sync_data
+import sync_bulk
+from fake_es import FakeES
+from sync_adaptive import BulkController
+from sync_bulk import submit_bulk
+
+
+@pytest.fixture
+def fake_es():
+    server = FakeES().start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_actions(n, index='kwm-list-2020-01-01'):
+    return [{'_index': index, '_id': str(i), '_source': {'n': i, 'text': 'x' * 100}} for i in range(n)]
+
+
+def bulk_settings(**overrides):
+    return {**es_sync_data.default_settings, **overrides}
+
+
+@pytest.mark.parametrize('serializer', ['client', 'ndjson'])
+@pytest.mark.parametrize('in_flight', [1, 3])
+def test_chunks_by_count(fake_es, serializer, in_flight):
+    es = Elasticsearch([fake_es.url])
+    settings = bulk_settings(bulk_serializer=serializer, bulk_size=100, bulk_in_flight=in_flight)
+    result = submit_bulk(es, make_actions(1050), settings)
+
+    assert result['success'] == 1050 and result['failed'] == 0
+    assert fake_es.doc_count() == 1050
+    assert fake_es.stats['bulk'] == 11
+
+
+@pytest.mark.parametrize('serializer', ['client', 'ndjson'])
+def test_chunks_by_bytes(fake_es, serializer):
+    es = Elasticsearch([fake_es.url])
+    # 每个文档两行大约 180 字节，按字节数拆分的块比按条数拆分的小
+    settings = bulk_settings(bulk_serializer=serializer, bulk_size=1000, bulk_max_bytes=2000)
+    result = submit_bulk(es, make_actions(200), settings)
+
+    assert result['success'] == 200
+    assert fake_es.stats['bulk'] >= 200 * 180 // 2000
+    assert fake_es.stats['bulk_bytes'] / fake_es.stats['bulk'] <= 2000
+
+
+@pytest.mark.parametrize('serializer', ['client', 'ndjson'])
+def test_reports_item_failures(fake_es, serializer):
+    es = Elasticsearch([fake_es.url])
+    fake_es.error_ratio = 1.0
+    items = []
+    result = submit_bulk(es, make_actions(30), bulk_settings(bulk_serializer=serializer, bulk_size=10),
+                         on_item=lambda ok, info: items.append((ok, info)))
+
+    assert result['success'] == 0 and result['failed'] == 30
+    assert result['errors'][0]['status'] == 400
+    assert sorted(int(info['_id']) for ok, info in items if not ok) == list(range(30))
+
+
+@pytest.mark.parametrize('serializer', ['client', 'ndjson'])
+def test_expected_status_is_not_a_failure(fake_es, serializer, caplog):
+    es = Elasticsearch([fake_es.url])
+    submit_bulk(es, make_actions(5), bulk_settings())
+    # 局部更新 10 个文档，后 5 个还不存在
+    updates = [{'_op_type': 'update', '_index': 'kwm-list-2020-01-01', '_id': str(i), 'doc': {'n': -1}}
+               for i in range(10)]
+    result = submit_bulk(es, updates, bulk_settings(bulk_serializer=serializer), expected_status=(404,))
+
+    assert result['success'] == 5 and result['failed'] == 0 and result['expected'] == 5
+    assert result['errors'] == []
+    assert 'bulk 提交有' not in caplog.text
+
+
+def test_ndjson_chunks():
+    chunks = list(sync_bulk.iter_ndjson_chunks(make_actions(25), 10, 1 << 20))
+    assert [len(metas) for _, metas in chunks] == [10, 10, 5]
+    # 每个块是各自的 bytes，交出去之后不会被下一个块覆盖
+    assert all(type(body) is bytes for body, _ in chunks)
+    assert chunks[0][0].count(b'\n') == 20 and b'"_id":"0"' in chunks[0][0]
+
+
+@pytest.mark.parametrize('adaptive', [False, True])
+def test_finished_futures_are_released(fake_es, monkeypatch, adaptive):
+    sizes = []
+    reap = sync_bulk._reap
+
+    def record(futures):
+        sizes.append(len(futures))
+        return reap(futures)
+
+    monkeypatch.setattr(sync_bulk, '_reap', record)
+    es = Elasticsearch([fake_es.url])
+    controller = BulkController(in_flight=2, batch_size=10, min_batch_size=10, max_batch_size=10, max_in_flight=2)
+    settings = bulk_settings(bulk_serializer='ndjson', bulk_size=10, bulk_in_flight=2)
+    result = submit_bulk(es, make_actions(1000), settings, controller=controller if adaptive else None)
+
+    assert result['success'] == 1000 and len(sizes) == 100
+    # 手上的 future 只有在途、排队的几个块（刚释放名额、还没标记完成的也算上），和任务里的 100 个块无关
+    assert max(sizes) <= 2 * 2 + 2
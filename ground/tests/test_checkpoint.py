@@ -0,0 +1,75 @@
+"""
+检查点：水位只推进到最早一个未完成任务，崩溃后重做未完成的任务
+"""
+import datetime
+
+import pytest
+
+import es_sync_data
+from sync_checkpoint import CheckpointStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return CheckpointStore(str(tmp_path / 'checkpoint.db'))
+
+
+def hour_tasks(start, hours, tables=('0', '1')):
+    """按小时拆分的任务，同 plan_tasks() 的格式"""
+    base = datetime.datetime.strptime(start, es_sync_data.date_fmt)
+    return [{'tbl_index': tbl,
+             'start': (base + datetime.timedelta(hours=h)).strftime(es_sync_data.date_fmt),
+             'end': (base + datetime.timedelta(hours=h + 1, seconds=-1)).strftime(es_sync_data.date_fmt)}
+            for h in range(hours) for tbl in tables]
+
+
+def test_advance_stops_at_first_unfinished_task(store):
+    tasks = hour_tasks('2020-01-01 00:00:00', 3)
+    store.plan(tasks, '2020-01-01 03:00:00')
+    for t in tasks:
+        # 第二个小时的 1 号表没有完成
+        if not (t['tbl_index'] == '1' and t['start'] == '2020-01-01 01:00:00'):
+            store.mark_done(t, 10)
+
+    assert store.advance() == '2020-01-01 01:00:00'
+    assert store.pending() == [{'tbl_index': '1', 'start': '2020-01-01 01:00:00', 'end': '2020-01-01 01:59:59'}]
+
+    store.mark_done(store.pending()[0])
+    assert store.advance() == '2020-01-01 03:00:00'
+    assert store.pending() == []
+
+
+def test_advance_without_tasks(store):
+    assert store.advance() is None
+
+
+def test_pending_tasks_survive_crash(tmp_path):
+    path = str(tmp_path / 'checkpoint.db')
+    tasks = hour_tasks('2020-01-01 00:00:00', 2)
+    store = CheckpointStore(path)
+    store.plan(tasks, '2020-01-01 02:00:00')
+    store.mark_done(tasks[0])
+    # 进程崩溃：没有 advance，连接也没有关闭，重新打开同一个文件
+    store = CheckpointStore(path)
+
+    assert store.get('planned_until') == '2020-01-01 02:00:00'
+    assert sorted(t['start'] + t['tbl_index'] for t in store.pending()) == sorted(
+        t['start'] + t['tbl_index'] for t in tasks[1:])
+    assert store.advance() == tasks[1]['start']
+
+    # 下一轮从 planned_until 继续拆分，重复登记已有的任务不会把完成的任务变回未完成
+    store.plan(tasks + hour_tasks('2020-01-01 02:00:00', 1), '2020-01-01 03:00:00')
+    assert len(store.pending()) == len(tasks) - 1 + 2
+
+
+def test_planned_until_does_not_go_backwards(store):
+    # sync_once 的做法：结束时间不晚于开始时间（时钟回拨、从库延迟往前退）时不拆分新任务，planned_until 不后退
+    start = '2020-01-01 02:00:00'
+    for end in ('2020-01-01 02:00:00', '2020-01-01 01:59:00'):
+        start_date = datetime.datetime.strptime(start, es_sync_data.date_fmt)
+        end_date = datetime.datetime.strptime(end, es_sync_data.date_fmt)
+        new_tasks = es_sync_data.plan_tasks(start_date, end_date, 3600)
+        assert new_tasks == []
+        store.plan(new_tasks, max(start, end))
+        assert store.get('planned_until') == start
+        assert store.advance() == start
@@ -0,0 +1,161 @@
+"""
+守护模式：常驻的同步进程一轮一轮地执行任务，连接在各轮之间复用
+"""
+import datetime
+import multiprocessing
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import pymysql
+import pytest
+
+import bench_e2e
+import es_sync_data
+from bench_e2e import SQLiteConnection
+from fake_es import FakeES
+
+# 按进程、按 cur_dir 缓存的对象，测试前后都要清掉
+cached = ('get_es', 'get_router', 'get_pool', 'get_governor', 'get_digests', 'get_bulk_controller', 'get_spool',
+          'get_lookup', 'get_checkpoint')
+
+
+class RepeatableReadConnection(SQLiteConnection):
+    """
+    按 InnoDB REPEATABLE READ 的行为模拟的连接：不是 autocommit 时第一条语句开始一个事务，
+    之后一直读这个事务的快照（SQLite WAL 模式下的读事务），直到 commit / rollback
+    """
+
+    def __init__(self, path, autocommit=False):
+        super().__init__(path)
+        self._conn.isolation_level = None
+        self.autocommit = autocommit
+
+    def cursor(self, cursor_class=None):
+        if not self.autocommit and not self._conn.in_transaction:
+            self._conn.execute('BEGIN')
+        return super().cursor(cursor_class)
+
+    def commit(self):
+        if self._conn.in_transaction:
+            self._conn.execute('COMMIT')
+
+    rollback = commit
+
+
+def insert_rows(path, ids, created_time):
+    """往 stat_article_subject_0 插入记录，每个 article_detail_id 一个文档"""
+    sas_fields = [f.split('.')[1] for f in es_sync_data.get_fields() if f.startswith('sas.')]
+    rnd = random.Random(0)
+    rows = []
+    for detail_id in ids:
+        row = {f: rnd.randrange(100) for f in sas_fields}
+        row.update({
+            'article_content_fingerprint': '%032x' % detail_id,
+            'article_record_md5_id': '%032x' % detail_id,
+            'article_title_fingerprint': '%032x' % detail_id,
+            'article_detail_id': detail_id,
+            'article_extracted_time': created_time,
+            'article_pubtime': created_time,
+            'created_time': created_time,
+            'client_id': 1,
+            'subject_id': 1,
+            'domain_code': 'qq.com',
+            'media_type_code': 'N',
+            'source_type': 'news',
+            'website_no': 'S000001',
+        })
+        rows.append([row[f] for f in sas_fields])
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO stat_article_subject_0 VALUES (%s)' % ','.join('?' * len(sas_fields)), rows)
+    conn.commit()
+    conn.close()
+
+
+def sleep_until(when):
+    time.sleep(max(0.0, (when - datetime.datetime.now()).total_seconds()))
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch):
+    path = str(tmp_path / 'daemon.db')
+    bench_e2e.generate(path, rows=0, hours=1, skew=1, op_ratio=0, seed=0)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.close()
+    server = FakeES().start()
+
+    # 子进程 fork 时带着这些替换
+    monkeypatch.setattr(pymysql, 'connect',
+                        lambda **kwargs: RepeatableReadConnection(path, kwargs.get('autocommit', False)))
+    monkeypatch.setattr(es_sync_data, 'cur_dir', str(tmp_path))
+    monkeypatch.setattr(es_sync_data, 'es_hosts', [server.url])
+    monkeypatch.setattr(es_sync_data, 'get_config', lambda: {'DB': {'host': 'db'}, 'SYNC': {'metrics_path': ''}})
+    # information_schema 在 SQLite 里没有
+    monkeypatch.setattr(es_sync_data, 'estimate_table_rows', lambda: {})
+    monkeypatch.setattr(es_sync_data, 'get_parallelism', lambda: (1, 2))
+    for name in cached:
+        getattr(es_sync_data, name).cache_clear()
+    yield path, server
+    for name in cached:
+        getattr(es_sync_data, name).cache_clear()
+    server.shutdown()
+    server.server_close()
+
+
+def test_rows_inserted_between_rounds_are_synced(env):
+    path, server = env
+    now = datetime.datetime.now()
+    es_sync_data.save_last_sync_time((now - datetime.timedelta(minutes=10)).strftime(es_sync_data.date_fmt))
+    insert_rows(path, range(0, 50), now - datetime.timedelta(minutes=5))
+
+    es_sync_data.index_cache.prepare(es_sync_data.get_es())
+    workers = es_sync_data.WorkerPool(es_sync_data.get_settings(), 1, 2).start()
+    try:
+        es_sync_data.sync_once(workers=workers)
+        assert server.doc_count() == 50
+
+        # 第二轮的记录比第一轮的结束时间晚，常驻进程复用的连接要能读到
+        first_end = datetime.datetime.strptime(es_sync_data.get_last_sync_time(), es_sync_data.date_fmt)
+        sleep_until(first_end + datetime.timedelta(seconds=1))
+        insert_rows(path, range(50, 80), datetime.datetime.now().replace(microsecond=0))
+        sleep_until(first_end + datetime.timedelta(seconds=2))
+        es_sync_data.sync_once(workers=workers)
+        assert server.doc_count() == 80
+        assert es_sync_data.get_checkpoint().pending() == []
+    finally:
+        workers.close()
+
+
+class DyingWorkerPool(es_sync_data.WorkerPool):
+    """第一个启动的同步进程取出一个任务后、上报开始之前就退出"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.died = multiprocessing.Value('i', 0)
+
+    def _sync_process(self, control_queue, parent_pid):
+        with self.died.get_lock():
+            die = not self.died.value
+            self.died.value = 1
+        if die:
+            self._task_queue.get()
+            os._exit(1)
+        super()._sync_process(control_queue, parent_pid)
+
+
+def test_task_taken_by_dead_process_does_not_hang_the_round(env, monkeypatch):
+    monkeypatch.setattr(es_sync_data, 'sync_task', lambda task, settings: {'success': 1, 'failed': 0})
+    workers = DyingWorkerPool(es_sync_data.get_settings(), 2, 1).start()
+    tasks = [{'tbl_index': str(i), 'start': '2020-01-01 00:00:00', 'end': '2020-01-01 00:59:59'} for i in range(10)]
+    reports = []
+    try:
+        runner = threading.Thread(target=lambda: reports.extend(workers.run(tasks)), daemon=True)
+        runner.start()
+        runner.join(30)
+        assert not runner.is_alive()
+        assert sum(r['docs'] for r in reports) == 9
+    finally:
+        workers.close()
@@ -0,0 +1,56 @@
+"""
+文档变化检测（DigestStore）
+"""
+import datetime
+
+import pytest
+
+from sync_digest import DigestStore, digest
+
+
+def make_actions(n, text='x'):
+    return [{'_index': 'kwm-list-2020-01-01', '_id': str(i), '_source': {'n': i, 'text': text}} for i in range(n)]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return DigestStore(str(tmp_path / 'digests.db'), batch_size=3)
+
+
+def test_digest_ignores_key_order():
+    a = {'n': 1, 'time': datetime.datetime(2020, 1, 1), 'ops': {'x': 1, 'y': None}}
+    b = {'ops': {'y': None, 'x': 1}, 'time': datetime.datetime(2020, 1, 1), 'n': 1}
+    assert digest(a) == digest(b)
+    assert digest(a) != digest({**a, 'n': 2})
+
+
+def test_confirmed_documents_are_skipped_next_time(store):
+    with store.submission() as (changed, confirm):
+        actions = list(changed(make_actions(5)))
+        assert len(actions) == 5
+        for a in actions[:4]:
+            confirm(True, {'_id': a['_id']})
+        confirm(False, {'_id': '4'})
+    store.flush()
+
+    with store.submission() as (changed, confirm):
+        # 写入失败的 4 号和内容变了的文档要重新提交
+        actions = make_actions(5)
+        actions[0]['_source']['text'] = 'y'
+        assert [a['_id'] for a in changed(actions)] == ['0', '4']
+    assert store.stats == {'digest_hits': 3, 'digest_misses': 7}
+
+
+def test_pending_is_dropped_when_submit_fails(store):
+    with pytest.raises(RuntimeError):
+        with store.submission() as (changed, confirm):
+            pending = confirm.keywords['pending']
+            list(changed(make_actions(5)))
+            assert len(pending) == 5
+            raise RuntimeError('bulk failed')
+    assert pending == {}
+    # 提交结束之后迟到的回调不会保存哈希
+    confirm(True, {'_id': '0'})
+    store.flush()
+    with store.submission() as (changed, _):
+        assert len(list(changed(make_actions(5)))) == 5
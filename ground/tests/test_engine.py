@@ -0,0 +1,18 @@
+"""
+引擎和设置组合的检查（resolve_engine）
+"""
+import importlib.util
+
+import es_sync_data
+
+
+def test_asyncio_falls_back_without_aiomysql(monkeypatch, caplog):
+    find_spec = importlib.util.find_spec
+    monkeypatch.setattr(importlib.util, 'find_spec', lambda name: None if name == 'aiomysql' else find_spec(name))
+    assert es_sync_data.resolve_engine('asyncio', es_sync_data.default_settings) == 'process'
+    assert '缺少 aiomysql' in caplog.text
+
+
+def test_pipeline_with_keyset_falls_back():
+    settings = {**es_sync_data.default_settings, 'extract_mode': 'keyset'}
+    assert es_sync_data.resolve_engine('pipeline', settings) == 'process'
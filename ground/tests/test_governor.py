@@ -0,0 +1,45 @@
+"""
+数据库限流（LoadGovernor）：等待只发生在语句开始之前，读取过程中不暂停
+"""
+import time
+
+from sync_governor import LoadGovernor, TokenBucket
+
+
+def test_charge_runs_into_debt_without_waiting():
+    bucket = TokenBucket(100)
+    _start = time.time()
+    bucket.charge(150)
+    assert time.time() - _start < 0.05
+    # 欠下 50 个令牌，要等大约 0.5 秒才补上
+    waited = bucket.acquire(0)
+    assert 0.4 < waited < 0.7
+
+
+def test_rows_are_paid_before_the_next_statement():
+    governor = LoadGovernor(rows_per_sec=1000)
+    with governor.statement():
+        _start = time.time()
+        governor.rows(1500)
+        assert time.time() - _start < 0.05
+    _start = time.time()
+    with governor.statement():
+        pass
+    assert 0.4 < time.time() - _start < 0.7
+    assert governor.stats['waits'] == 1
+
+
+def test_stressed_database_does_not_pause_an_open_statement():
+    calls = []
+
+    def check():
+        calls.append(1)
+        return len(calls) > 1, 'n=%s' % len(calls)
+
+    governor = LoadGovernor(check=check, check_interval=0.2)
+    with governor.statement():
+        time.sleep(0.25)
+        _start = time.time()
+        governor.rows(100)
+        assert time.time() - _start < 0.05
+    assert len(calls) == 1
@@ -0,0 +1,107 @@
+"""
+keyset 分页的查找条件（get_keyset_sql / get_keyset_args），对着 SQLite 替身数据库测试
+"""
+import sqlite3
+
+import pytest
+
+import bench_e2e
+import es_sync_data
+from bench_e2e import SQLiteConnection
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / 'keyset.db')
+    bench_e2e.generate(path, rows=0, hours=1, skew=1, op_ratio=0, seed=0)
+    conn = sqlite3.connect(path)
+    # created_time 和 subject_id 都有大量相同的值，只有三个字段合起来才唯一
+    rows = [(created, subject_id, detail_id)
+            for created in ('2020-01-01 00:00:00', '2020-01-01 00:00:01', '2020-01-01 00:00:02')
+            for subject_id in (1, 2, 3)
+            for detail_id in (10, 20, 30, 40)]
+    conn.executemany('INSERT INTO stat_article_subject_0 (created_time, subject_id, article_detail_id) VALUES (?, ?, ?)',
+                     rows)
+    conn.commit()
+    conn.close()
+    db = SQLiteConnection(path)
+    yield db, rows
+    db.close()
+
+
+def read_pages(db, key, end, page_size):
+    """按高水位一页一页读到最后，返回每一页的 (created_time, subject_id, article_detail_id) list"""
+    sql = es_sync_data.get_keyset_sql('stat_article_subject_0', join=False)
+    pages = []
+    while True:
+        with db.cursor() as cursor:
+            cursor.execute(sql, es_sync_data.get_keyset_args(key, end, page_size))
+            page = [(r['created_time'].strftime(es_sync_data.date_fmt), r['subject_id'], r['article_detail_id'])
+                    for r in cursor.fetchall()]
+        if not page:
+            return pages
+        pages.append(page)
+        key = page[-1]
+        if len(page) < page_size:
+            return pages
+
+
+@pytest.mark.parametrize('page_size', [1, 5, 7, 36, 100])
+def test_pages_cover_every_row_once_in_order(db, page_size):
+    db, rows = db
+    pages = read_pages(db, ('2020-01-01 00:00:00', -1, -1), '2020-01-01 01:00:00', page_size)
+    assert [r for page in pages for r in page] == sorted(rows)
+    assert all(len(page) <= page_size for page in pages)
+
+
+def test_resume_inside_ties(db):
+    db, rows = db
+    # 高水位停在 created_time、subject_id 都相同的一组记录中间
+    key = ('2020-01-01 00:00:01', 2, 20)
+    pages = read_pages(db, key, '2020-01-01 01:00:00', 4)
+    assert [r for page in pages for r in page] == [r for r in sorted(rows) if r > key]
+
+
+def test_end_is_exclusive(db):
+    db, rows = db
+    pages = read_pages(db, ('2020-01-01 00:00:00', -1, -1), '2020-01-01 00:00:02', 10)
+    assert [r for page in pages for r in page] == [r for r in sorted(rows) if r[0] < '2020-01-01 00:00:02']
+
+
+class StatisticsConnection:
+    """只返回 information_schema.STATISTICS 查询结果的连接"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, args=None):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def test_check_keyset_indexes_reports_missing_tables(monkeypatch, caplog):
+    rows = [{'TABLE_NAME': 'stat_article_subject_%s' % i, 'INDEX_NAME': 'idx_keyset',
+             'index_columns': 'created_time,subject_id,article_detail_id'} for i in range(0, 98)]
+    # 99 号表只有 created_time 索引
+    rows.append({'TABLE_NAME': 'stat_article_subject_99', 'INDEX_NAME': 'idx_created_time',
+                 'index_columns': 'created_time'})
+    monkeypatch.setattr(es_sync_data, 'get_conn', lambda: StatisticsConnection(rows))
+    es_sync_data.check_keyset_indexes.cache_clear()
+    es_sync_data.check_keyset_indexes()
+    es_sync_data.check_keyset_indexes.cache_clear()
+    assert '2 张表没有' in caplog.text
+    assert 'stat_article_subject_98, stat_article_subject_99' in caplog.text
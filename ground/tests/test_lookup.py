@@ -0,0 +1,70 @@
+"""
+article_operation 批量查询（OperationLookup），对着 SQLite 替身数据库测试
+"""
+import sqlite3
+import threading
+
+import pytest
+
+from bench_e2e import SQLiteConnection
+from sync_lookup import OperationLookup
+from sync_pool import ConnectionPool
+from sync_rows import RowBatch
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / 'lookup.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE article_operation (article_detail_id INTEGER PRIMARY KEY, status TEXT, score INTEGER)')
+    conn.executemany('INSERT INTO article_operation VALUES (?, ?, ?)', [(1, 'done', 10), (2, 'todo', 20)])
+    conn.commit()
+    pool = ConnectionPool(lambda: SQLiteConnection(path))
+    yield conn, OperationLookup(pool, ['status', 'score'], batch_size=2)
+    pool.close()
+    conn.close()
+
+
+def test_attach_fills_missing_operations_with_none(db):
+    _, lookup = db
+    rows = lookup.attach([{'article_detail_id': 1}, {'article_detail_id': 3}, {'article_detail_id': 1}])
+    assert rows == [{'article_detail_id': 1, 'status': 'done', 'score': 10},
+                    {'article_detail_id': 3, 'status': None, 'score': None},
+                    {'article_detail_id': 1, 'status': 'done', 'score': 10}]
+    assert lookup.stats == {'queries': 1, 'hits': 0, 'misses': 2}
+
+
+def test_attach_row_batch(db):
+    _, lookup = db
+    batch = lookup.attach(RowBatch.from_rows(['article_detail_id'], [(2,), (1,)]))
+    assert batch.column('status') == ['todo', 'done']
+    assert batch.column('score') == [20, 10]
+
+
+def test_cache_is_scoped_to_one_task(db):
+    conn, lookup = db
+    resolve = lookup.resolver()
+    assert resolve([{'article_detail_id': 1}])[0]['status'] == 'done'
+    conn.execute("UPDATE article_operation SET status = 'undone' WHERE article_detail_id = 1")
+    conn.commit()
+    # 同一个任务内用缓存
+    assert resolve([{'article_detail_id': 1}])[0]['status'] == 'done'
+    assert lookup.stats == {'queries': 1, 'hits': 1, 'misses': 1}
+    # 下一个任务读到最新的值
+    assert lookup.resolver()([{'article_detail_id': 1}])[0]['status'] == 'undone'
+
+
+def test_stats_from_many_threads(db):
+    _, lookup = db
+
+    def work():
+        resolve = lookup.resolver()
+        for _ in range(50):
+            resolve([{'article_detail_id': 1}, {'article_detail_id': 2}])
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert lookup.stats == {'queries': 8, 'hits': 8 * 49 * 2, 'misses': 8 * 2}
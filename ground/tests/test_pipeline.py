@@ -0,0 +1,148 @@
+"""
+分阶段流水线（Pipeline）
+"""
+import threading
+import time
+
+import pytest
+
+from sync_pipeline import Pipeline
+
+
+def task_source(tasks):
+    """线程安全的 next_task，任务取完返回 None"""
+    lock = threading.Lock()
+    tasks = list(tasks)
+
+    def next_task():
+        with lock:
+            return tasks.pop(0) if tasks else None
+
+    return next_task
+
+
+def read_batches(task):
+    """每个任务 batches 批，每批 size 条"""
+    for b in range(task['batches']):
+        yield [(task['name'], b, i) for i in range(task['size'])]
+
+
+def transform(rows):
+    return [{'_id': '%s-%s-%s' % row} for row in rows]
+
+
+class Recorder:
+    """记录写入的文档和任务完成的回调"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.written = []
+        self.done = {}
+        self.written_at_done = {}
+
+    def write(self, actions):
+        with self.lock:
+            self.written += [a['_id'] for a in actions]
+        return {'success': len(actions), 'failed': 0}
+
+    def on_task_done(self, task, result, error):
+        with self.lock:
+            # 回调时这个任务已经写入的文档数
+            self.written_at_done.setdefault(task['name'], []).append(
+                sum(i.startswith(task['name'] + '-') for i in self.written))
+            self.done[task['name']] = (result, error)
+
+
+@pytest.mark.parametrize('threads', [(1, 1, 1), (3, 2, 4)])
+def test_every_task_is_reported_once_with_merged_results(threads):
+    readers, transformers, writers = threads
+    recorder = Recorder()
+    tasks = [{'name': 't%s' % i, 'batches': i % 4, 'size': 5} for i in range(20)]
+    pipeline = Pipeline(read_batches, transform, recorder.write, recorder.on_task_done, readers=readers,
+                        transformers=transformers, writers=writers, queue_size=2, log_interval=0)
+    pipeline.run(task_source(tasks))
+
+    assert len(recorder.written) == len(set(recorder.written)) == sum(t['batches'] * 5 for t in tasks)
+    # 没有数据的任务也会完成
+    assert recorder.done == {t['name']: ({'success': t['batches'] * 5, 'failed': 0, 'spooled': 0}, None)
+                             for t in tasks}
+    # 每个任务只回调一次，回调时它的所有批次都已经写完
+    assert recorder.written_at_done == {t['name']: [t['batches'] * 5] for t in tasks}
+    assert pipeline.stats['read'].items == pipeline.stats['write'].items == len(recorder.written)
+
+
+def test_transform_error_fails_only_that_batch():
+    recorder = Recorder()
+
+    def bad_transform(rows):
+        if rows[0][1] == 1:
+            raise ValueError('bad row')
+        return transform(rows)
+
+    pipeline = Pipeline(read_batches, bad_transform, recorder.write, recorder.on_task_done, log_interval=0)
+    pipeline.run(task_source([{'name': 'a', 'batches': 3, 'size': 5}]))
+    result, error = recorder.done['a']
+    assert result == {'success': 10, 'failed': 5, 'spooled': 0}
+    assert isinstance(error, ValueError)
+
+
+def test_read_error_finishes_the_task_after_its_pending_batches():
+    recorder = Recorder()
+
+    def broken_read(task):
+        yield from read_batches(task)
+        raise ConnectionError('Lost connection to MySQL server during query')
+
+    pipeline = Pipeline(broken_read, transform, recorder.write, recorder.on_task_done, log_interval=0)
+    pipeline.run(task_source([{'name': 'a', 'batches': 2, 'size': 5}, {'name': 'b', 'batches': 1, 'size': 5}]))
+    assert recorder.done['a'][0]['success'] == 10 and isinstance(recorder.done['a'][1], ConnectionError)
+    assert recorder.done['b'][0]['success'] == 5
+    assert len(recorder.written) == 15
+
+
+def test_slow_writes_block_reading():
+    release = threading.Event()
+    read = []
+
+    def counting_read(task):
+        for rows in read_batches(task):
+            read.append(1)
+            yield rows
+
+    def slow_write(actions):
+        release.wait(5)
+        return {'success': len(actions), 'failed': 0}
+
+    pipeline = Pipeline(counting_read, transform, slow_write, lambda *args: None, readers=1, transformers=1,
+                        writers=1, queue_size=2, log_interval=0)
+    runner = threading.Thread(target=pipeline.run, args=(task_source([{'name': 'a', 'batches': 100, 'size': 1}]),))
+    runner.start()
+    time.sleep(0.3)
+    # 写入卡住时，读取最多再多读出两个队列加上各阶段手上的几批
+    assert len(read) <= 2 + 2 + 3
+    release.set()
+    runner.join(5)
+    assert len(read) == 100 and pipeline.stats['write'].items == 100
+
+
+def test_context_wraps_every_stage():
+    entered = []
+    lock = threading.Lock()
+
+    class Context:
+        def __init__(self, task):
+            self.task = task
+
+        def __enter__(self):
+            with lock:
+                entered.append((threading.current_thread().name.split('-')[0], self.task['name']))
+
+        def __exit__(self, *exc_info):
+            pass
+
+    recorder = Recorder()
+    pipeline = Pipeline(read_batches, transform, recorder.write, recorder.on_task_done, log_interval=0,
+                        context=Context)
+    pipeline.run(task_source([{'name': 'a', 'batches': 2, 'size': 1}]))
+    assert sorted(entered) == [('Reader', 'a'), ('Transformer', 'a'), ('Transformer', 'a'), ('Writer', 'a'),
+                               ('Writer', 'a')]
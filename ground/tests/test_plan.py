@@ -0,0 +1,96 @@
+"""
+按行数拆分任务（plan_windows / plan_adaptive_tasks），行数统计用内存里的记录代替数据库
+"""
+import datetime
+
+import pytest
+
+import es_sync_data
+
+start = datetime.datetime(2020, 1, 1)
+
+
+@pytest.fixture
+def rows(monkeypatch):
+    """每张表的记录的 created_time，count_rows 按它们统计"""
+    tables = {}
+
+    def count_rows(tbl_name, start_date, end_date, bucket):
+        counts = {}
+        for t in tables.get(tbl_name, []):
+            if start_date <= t < end_date:
+                i = int((t - start_date).total_seconds()) // bucket
+                counts[i] = counts.get(i, 0) + 1
+        return counts
+
+    monkeypatch.setattr(es_sync_data, 'count_rows', count_rows)
+    return tables
+
+
+def at(hours=0, minutes=0, seconds=0):
+    return start + datetime.timedelta(hours=hours, minutes=minutes, seconds=seconds)
+
+
+def assert_covers(windows, start_date, end_date):
+    assert windows[0][0] == start_date and windows[-1][1] == end_date
+    assert all(a[1] == b[0] for a, b in zip(windows, windows[1:]))
+    assert all(w_start < w_end for w_start, w_end, _ in windows)
+
+
+def test_quiet_hours_are_merged(rows):
+    # 6 个小时，每小时 10 行
+    rows['t'] = [at(h, 30) for h in range(6) for _ in range(10)]
+    windows = es_sync_data.plan_windows('t', at(0), at(6), target_rows=25)
+    assert_covers(windows, at(0), at(6))
+    assert [(w_start, n) for w_start, _, n in windows] == [(at(0), 20), (at(2), 20), (at(4), 20)]
+
+
+def test_empty_range_is_one_window(rows):
+    assert es_sync_data.plan_windows('t', at(0), at(24), target_rows=100) == [(at(0), at(24), 0)]
+
+
+def test_heavy_hour_is_split_by_minute(rows):
+    # 第 2 个小时里每分钟 10 行，其他小时各 5 行
+    rows['t'] = [at(h, 0) for h in (0, 1, 3) for _ in range(5)] + [at(2, m) for m in range(60) for _ in range(10)]
+    windows = es_sync_data.plan_windows('t', at(0), at(4), target_rows=100)
+    assert_covers(windows, at(0), at(4))
+    assert windows[0] == (at(0), at(2), 10)
+    heavy = [w for w in windows if at(2) <= w[0] < at(3)]
+    # 一个小时 600 行按分钟拆成每段 10 分钟、100 行
+    assert [n for _, _, n in heavy] == [100] * 6
+    assert heavy[-1][1] == at(3) and windows[-1] == (at(3), at(4), 5)
+    assert sum(n for _, _, n in windows) == 615
+
+
+def test_bucket_over_target_at_the_smallest_size_is_kept_whole(rows):
+    rows['t'] = [at(0, 5, s) for s in range(50)]
+    windows = es_sync_data.plan_windows('t', at(0), at(1), target_rows=10)
+    assert_covers(windows, at(0), at(1))
+    assert (at(0, 5), at(0, 6), 50) in windows
+
+
+def test_partial_last_bucket(rows):
+    rows['t'] = [at(1, 10)] * 3
+    windows = es_sync_data.plan_windows('t', at(0, 30), at(1, 15), target_rows=100)
+    assert windows == [(at(0, 30), at(1, 15), 3)]
+
+
+def test_adaptive_tasks_cover_every_table(rows):
+    rows['stat_article_subject_7'] = [at(0, m) for m in range(60) for _ in range(10)]
+    tasks = es_sync_data.plan_adaptive_tasks(at(0), at(1), target_rows=200, thread_count=4)
+    by_table = {}
+    for t in tasks:
+        by_table.setdefault(t['tbl_index'], []).append(t)
+    assert sorted(by_table, key=int) == [str(i) for i in range(100)]
+    # 没有数据的表一个任务，任务的结束时间包含在内
+    assert by_table['0'] == [{'tbl_index': '0', 'start': '2020-01-01 00:00:00', 'end': '2020-01-01 00:59:59',
+                              'planned_rows': 0, 'estimate': 0}]
+    heavy = by_table['7']
+    assert [t['planned_rows'] for t in heavy] == [200, 200, 200]
+    assert [(t['start'], t['end']) for t in heavy] == [('2020-01-01 00:00:00', '2020-01-01 00:19:59'),
+                                                       ('2020-01-01 00:20:00', '2020-01-01 00:39:59'),
+                                                       ('2020-01-01 00:40:00', '2020-01-01 00:59:59')]
+
+
+def test_adaptive_tasks_for_an_empty_range(rows):
+    assert es_sync_data.plan_adaptive_tasks(at(1), at(1), target_rows=200, thread_count=4) == []
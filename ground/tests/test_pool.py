@@ -0,0 +1,210 @@
+"""
+数据库连接池（ConnectionPool）和按进程缓存（per_process）
+"""
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+import es_sync_data
+from sync_pool import ConnectionPool, per_process
+
+
+class SessionCursor:
+    """只记录执行的语句"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, args=None):
+        self.conn.session.append((sql, args))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class SnapshotConnection:
+    """
+    按 InnoDB REPEATABLE READ 的行为模拟的连接：不是 autocommit 时，事务中第一条 SELECT 建立快照，
+    之后都读这个快照，直到 commit / rollback
+    :param table: 共享的“表”，list
+    """
+
+    def __init__(self, table, autocommit=False):
+        self.table = table
+        self.autocommit = autocommit
+        self.snapshot = None
+        self.closed = False
+        # 执行过的 SET SESSION 语句
+        self.session = []
+
+    def cursor(self, cursor_class=None):
+        return SessionCursor(self)
+
+    def select(self):
+        if self.autocommit:
+            return list(self.table)
+        if self.snapshot is None:
+            self.snapshot = list(self.table)
+        return self.snapshot
+
+    def rollback(self):
+        self.snapshot = None
+
+    commit = rollback
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_reused_connection_sees_rows_committed_later(monkeypatch):
+    table = [1, 2]
+    monkeypatch.setattr(es_sync_data.pymysql, 'connect',
+                        lambda **kwargs: SnapshotConnection(table, kwargs.get('autocommit', False)))
+    pool = ConnectionPool(lambda: es_sync_data.connect_db({'host': 'db'}))
+    with pool.connection() as conn:
+        assert conn.select() == [1, 2]
+    table.append(3)
+    with pool.connection() as conn:
+        assert conn.select() == [1, 2, 3]
+    assert pool.stats['connects'] == 1 and pool.stats['reuses'] == 1
+
+
+def test_connect_sets_net_write_timeout(monkeypatch):
+    monkeypatch.setattr(es_sync_data.pymysql, 'connect', lambda **kwargs: SnapshotConnection([], kwargs['autocommit']))
+    monkeypatch.setattr(es_sync_data, 'get_config', lambda: {'SYNC': {'db_net_write_timeout': 300}})
+    conn = es_sync_data.connect_db({'host': 'db'})
+    assert conn.session == [('SET SESSION net_write_timeout = %s', [300])]
+    monkeypatch.setattr(es_sync_data, 'get_config', lambda: {'SYNC': {'db_net_write_timeout': 0}})
+    assert es_sync_data.connect_db({'host': 'db'}).session == []
+
+
+class DummyConnection:
+    """记录 ping 次数的连接，dead 为 True 时 ping 报错"""
+
+    def __init__(self, n):
+        self.n = n
+        self.dead = False
+        self.closed = False
+        self.pings = 0
+
+    def ping(self, reconnect=False):
+        self.pings += 1
+        if self.dead:
+            raise ConnectionError('MySQL server has gone away')
+
+    def close(self):
+        self.closed = True
+
+
+def dummy_pool(**kwargs):
+    created = []
+
+    def connect():
+        created.append(DummyConnection(len(created)))
+        return created[-1]
+
+    return ConnectionPool(connect, **kwargs), created
+
+
+def test_idle_connections_are_reused_last_in_first_out():
+    pool, created = dummy_pool()
+    with pool.connection() as a:
+        with pool.connection() as b:
+            assert (a.n, b.n) == (0, 1)
+    # 最近归还的 a 先借出，空闲久了的留在后面
+    with pool.connection() as conn:
+        assert conn is a
+        # 空闲不到 ping_interval 不 ping
+        assert conn.pings == 0
+    assert pool.stats['connects'] == 2 and pool.stats['reuses'] == 1
+
+
+def test_connection_idle_past_ping_interval_is_checked():
+    pool, created = dummy_pool(ping_interval=0)
+    with pool.connection():
+        pass
+    with pool.connection() as conn:
+        assert conn is created[0] and conn.pings == 1
+
+    # ping 失败的连接丢弃，换一个新的
+    created[0].dead = True
+    with pool.connection() as conn:
+        assert conn is created[1]
+    assert created[0].closed
+    assert (pool.stats['connects'], pool.stats['reuses'], pool.stats['discards']) == (2, 1, 1)
+
+
+def test_connection_is_discarded_on_error():
+    pool, created = dummy_pool()
+    with pytest.raises(ValueError):
+        with pool.connection():
+            raise ValueError('bad row')
+    assert created[0].closed and pool.stats['discards'] == 1
+    with pool.connection() as conn:
+        assert conn is created[1]
+
+
+def test_checkout_blocks_at_max_size():
+    pool, created = dummy_pool(max_size=1)
+    entered = threading.Event()
+
+    def borrow():
+        with pool.connection():
+            entered.set()
+
+    with pool.connection():
+        t = threading.Thread(target=borrow)
+        t.start()
+        assert not entered.wait(0.2)
+    assert entered.wait(2)
+    t.join(2)
+    assert len(created) == 1
+
+
+def test_close_closes_idle_and_returned_connections():
+    pool, created = dummy_pool()
+    with pool.connection():
+        with pool.connection() as conn:
+            pass
+        assert not conn.closed
+        pool.close()
+        assert conn.closed and not created[0].closed
+    assert created[0].closed
+
+
+def test_per_process_creates_one_object_per_process():
+    calls = []
+
+    @per_process
+    def get_object():
+        calls.append(os.getpid())
+        return object()
+
+    first = get_object()
+    assert get_object() is first and len(calls) == 1
+
+    # fork 出来的子进程重新创建一次，之后复用子进程自己的
+    def child(conn):
+        get_object()
+        get_object()
+        conn.send(calls)
+
+    ctx = multiprocessing.get_context('fork')
+    reader, writer = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=child, args=(writer,))
+    p.start()
+    child_calls = reader.recv()
+    p.join(5)
+    assert child_calls == [os.getpid(), p.pid]
+    assert get_object() is first and len(calls) == 1
+
+    get_object.cache_clear()
+    assert get_object() is not first and len(calls) == 2
@@ -0,0 +1,78 @@
+"""
+从库路由和切换（ReplicaRouter / ReplicaPool），用几个 SQLite 替身数据库代替主库、从库
+"""
+import time
+
+import pymysql
+import pytest
+
+from bench_e2e import SQLiteConnection
+from sync_replicas import ReplicaPool, ReplicaRouter
+
+
+def replica(name, dead=False):
+    """建立替身连接的函数，dead 为 True 时和连不上的 MySQL 一样报错"""
+
+    def connect():
+        if dead:
+            raise pymysql.err.OperationalError(2003, "Can't connect to MySQL server on '%s'" % name)
+        conn = SQLiteConnection(':memory:')
+        conn.host = name
+        return conn
+
+    return connect
+
+
+def test_weighted_least_outstanding():
+    router = ReplicaRouter(['a', 'b'], [1, 3])
+    picks = [router.acquire() for _ in range(8)]
+    assert picks.count(0) == 2 and picks.count(1) == 6
+    for i in picks:
+        router.release(i)
+    assert list(router._outstanding) == [0, 0]
+
+
+def test_invalid_weight():
+    with pytest.raises(ValueError):
+        ReplicaRouter(['a', 'b'], [1, 0])
+
+
+def test_failed_replica_is_marked_down_and_skipped():
+    router = ReplicaRouter(['a', 'b'], [100, 1], retry_interval=30)
+    pool = ReplicaPool(router, [replica('a', dead=True), replica('b')])
+    with pool.connection() as conn:
+        assert conn.host == 'b'
+        assert list(router._outstanding) == [0, 1]
+    assert router._down_until[0] > time.time()
+    assert list(router._outstanding) == [0, 0]
+    # 不可用期间不再尝试 a，归还的连接按从库复用
+    with pool.connection() as conn:
+        assert conn.host == 'b'
+    assert pool.stats['connects'] == 1 and pool.stats['reuses'] == 1
+    pool.close()
+
+
+def test_replica_recovers_after_health_check():
+    healthy = {0: False}
+    router = ReplicaRouter(['a'], [1], check=lambda i: (healthy[i], 'check'), check_interval=0)
+    assert router.acquire() is None
+    healthy[0] = True
+    assert router.acquire() == 0
+
+
+def test_fallback_to_primary():
+    router = ReplicaRouter(['a', 'b'], [1, 1])
+    pool = ReplicaPool(router, [replica('a', dead=True), replica('b', dead=True)], fallback=replica('primary'))
+    with pool.connection() as conn:
+        assert conn.host == 'primary'
+    assert list(router._outstanding) == [0, 0]
+    pool.close()
+
+
+def test_no_replica_without_fallback():
+    router = ReplicaRouter(['a', 'b'], [1, 1])
+    pool = ReplicaPool(router, [replica('a', dead=True), replica('b', dead=True)])
+    with pytest.raises(ConnectionError):
+        with pool.connection():
+            pass
+    assert list(router._outstanding) == [0, 0]
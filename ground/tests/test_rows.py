@@ -0,0 +1,72 @@
+"""
+按列存放的记录（RowBatch / LazyActions），tuple 记录和 dict 记录转换出同样的 action
+"""
+import datetime
+
+import es_sync_data
+from sync_rows import LazyActions, RowBatch
+
+names = ('client_id', 'subject_id', 'article_detail_id', 'article_extracted_time', 'article_pubtime',
+         'created_time', 'user_last_process_time', 'title')
+
+
+def make_rows(n):
+    day = datetime.datetime(2020, 1, 1, 23, 59, 0)
+    return [(1, 2, i, day + datetime.timedelta(seconds=30 * i), day, day, None, 'title %s' % i) for i in range(n)]
+
+
+def test_from_rows_stores_columns():
+    batch = RowBatch.from_rows(['a', 'b'], [(1, 'x'), (2, 'y'), (3, 'z')])
+    assert len(batch) == 3
+    assert batch.columns == [[1, 2, 3], ['x', 'y', 'z']]
+    assert batch[1] == {'a': 2, 'b': 'y'}
+    assert list(batch.rows()) == [(1, 'x'), (2, 'y'), (3, 'z')]
+
+
+def test_empty_batch_keeps_its_columns():
+    batch = RowBatch.from_rows(['a', 'b'], [])
+    assert len(batch) == 0 and batch.column('b') == [] and list(batch.rows()) == []
+
+
+def test_column_is_modified_in_place():
+    batch = RowBatch.from_rows(['a', 'b'], [(1, 'x'), (2, 'y')])
+    column = batch.column('a')
+    column[:] = [n * 10 for n in column]
+    assert list(batch.rows()) == [(10, 'x'), (20, 'y')]
+
+
+def test_add_columns_appends_and_replaces():
+    batch = RowBatch.from_rows(['a', 'b'], [(1, 'x'), (2, 'y')])
+    batch.add_columns(['c', 'b'], [[True, False], ['X', 'Y']])
+    assert batch.names == ['a', 'b', 'c']
+    assert list(batch.rows()) == [(1, 'X', True), (2, 'Y', False)]
+    assert batch.column('c') == [True, False]
+
+
+def test_lazy_actions_can_be_iterated_again():
+    batch = RowBatch.from_rows(['a'], [(1,), (2,)])
+    made = []
+
+    def make(b):
+        made.append(1)
+        return ({'_id': a} for a, in b.rows())
+
+    actions = LazyActions(batch, make)
+    # 构造时不生成 action
+    assert len(actions) == 2 and made == []
+    assert list(actions) == list(actions) == [{'_id': 1}, {'_id': 2}]
+    assert len(made) == 2
+
+
+def test_row_batch_and_dict_rows_give_the_same_actions():
+    rows = make_rows(5)
+    batch = RowBatch.from_rows(names, rows)
+    actions = es_sync_data.transform_rows(batch)
+    assert isinstance(actions, LazyActions) and len(actions) == 5
+
+    expected = es_sync_data.transform_rows([dict(zip(names, row)) for row in rows])
+    assert list(actions) == expected
+    assert expected[0]['_index'] == 'kwm-list-2020-01-01' and expected[4]['_index'] == 'kwm-list-2020-01-02'
+    assert expected[0]['_id'] == '1-2-0'
+    assert expected[0]['_source']['created_time'] == '2020-01-01 23:59:00'
+    assert expected[0]['_source']['user_last_process_time'] is None
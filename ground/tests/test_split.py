@@ -0,0 +1,55 @@
+"""
+按 article_detail_id 拆分大任务（split_task），对着 SQLite 替身数据库测试
+"""
+import sqlite3
+
+import pytest
+
+import es_sync_data
+from bench_e2e import SQLiteConnection
+from sync_pool import ConnectionPool
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    path = str(tmp_path / 'split.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE stat_article_subject_0 (article_detail_id INTEGER, created_time DATETIME)')
+    conn.executemany('INSERT INTO stat_article_subject_0 VALUES (?, ?)',
+                     [(i, '2020-01-01 00:%02d:00' % (i % 60)) for i in range(100)])
+    conn.commit()
+    conn.close()
+    pool = ConnectionPool(lambda: SQLiteConnection(path))
+    monkeypatch.setattr(es_sync_data, 'get_pool', lambda: pool)
+    yield pool
+    pool.close()
+
+
+def split_settings(**overrides):
+    return {**es_sync_data.default_settings, 'range_split_rows': 50, 'range_split_parts': 4, **overrides}
+
+
+def make_task(**extra):
+    return {'tbl_index': '0', 'start': '2020-01-01 00:00:00', 'end': '2020-01-01 00:59:59', **extra}
+
+
+def test_splits_into_ranges_covering_the_task(pool):
+    parts = es_sync_data.split_task(make_task(), split_settings())
+    assert [p['id_range'] for p in parts] == [(None, 25), (25, 50), (50, 75), (75, None)]
+
+
+def test_ranking_estimate_does_not_skip_count(pool):
+    # fixed 模式下表统计缺失时 estimate 为 0，只是排序用的，不能因此跳过拆分
+    parts = es_sync_data.split_task(make_task(estimate=0), split_settings())
+    assert parts is not None and len(parts) == 4
+    assert pool.stats['connects'] == 1
+
+
+def test_small_planned_rows_skips_count(pool):
+    assert es_sync_data.split_task(make_task(planned_rows=10, estimate=10), split_settings()) is None
+    assert pool.stats['connects'] == 0
+
+
+def test_count_below_threshold_is_not_split(pool):
+    assert es_sync_data.split_task(make_task(), split_settings(range_split_rows=1000)) is None
+    assert pool.stats['connects'] == 1
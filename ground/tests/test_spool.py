@@ -0,0 +1,141 @@
+"""
+死信目录（DeadLetterSpool）和重放（replay）
+"""
+import glob
+import gzip
+import os
+import subprocess
+import sys
+
+import pytest
+
+import es_sync_data
+from fake_es import FakeES
+from sync_spool import DeadLetterSpool, read_segment
+
+index = 'kwm-list-2020-01-01'
+
+
+def failed(doc_id, n, op='index'):
+    """一条失败的文档：(详情, 操作类型, 请求体)"""
+    info = {'_index': index, '_id': doc_id, 'status': 400, 'error': {'type': 'mapper_parsing_exception'}}
+    source = b'{"doc":{"n":%d}}' % n if op == 'update' else b'{"n":%d}' % n
+    return info, op, source
+
+
+def dead_pid():
+    """一个已经退出的进程 ID"""
+    p = subprocess.Popen([sys.executable, '-c', 'pass'])
+    p.wait()
+    return p.pid
+
+
+def test_writes_append_gzip_members_and_seal(tmp_path):
+    spool = DeadLetterSpool(str(tmp_path))
+    spool.write([failed('1', 1), failed('2', 2)])
+    spool.write([failed('1', 3)])
+    parts = glob.glob(str(tmp_path / '*.ndjson.gz.part'))
+    assert len(parts) == 1
+    # 每次写入追加一个 gzip 成员，读的时候按一个 gzip 流连续读出所有记录
+    with open(parts[0], 'rb') as r:
+        assert r.read().count(b'\x1f\x8b\x08') == 2
+    assert spool.segments() == []
+
+    spool.seal()
+    paths = spool.segments()
+    assert len(paths) == 1 and not glob.glob(str(tmp_path / '*.part'))
+    records = list(read_segment(paths[0]))
+    assert [(r['_id'], r['op'], r['source']) for r in records] == [('1', 'index', {'n': 1}), ('2', 'index', {'n': 2}),
+                                                                  ('1', 'index', {'n': 3})]
+    assert records[0]['status'] == 400 and records[0]['error'] == {'type': 'mapper_parsing_exception'}
+    assert spool.stats['spooled'] == 3
+
+
+def test_full_segment_is_sealed(tmp_path):
+    spool = DeadLetterSpool(str(tmp_path), segment_bytes=1)
+    spool.write([failed('1', 1)])
+    spool.write([failed('2', 2)])
+    assert len(spool.segments()) == 2
+    assert not glob.glob(str(tmp_path / '*.part'))
+
+
+def test_crashed_writer_part_is_picked_up(tmp_path):
+    crashed = str(tmp_path / ('20200101000000-%s-000001.ndjson.gz.part' % dead_pid()))
+    alive = str(tmp_path / ('20200101000000-%s-000001.ndjson.gz.part' % os.getppid()))
+    for path in (crashed, alive):
+        with open(path, 'wb') as w:
+            w.write(gzip.compress(b'{"_index":"%s","_id":"1","op":"index","source":{"n":1}}\n' % index.encode()))
+    spool = DeadLetterSpool(str(tmp_path))
+    spool.write([failed('2', 2)])
+
+    # 写入进程已经不在的 .part 改名后重放，还在写的（其他进程的、自己的）不动
+    assert spool.segments() == [crashed[:-len('.part')]]
+    assert os.path.exists(alive)
+    assert len(glob.glob(str(tmp_path / '*.part'))) == 2
+
+
+def test_truncated_segment_reads_complete_records(tmp_path, caplog):
+    path = str(tmp_path / 'truncated.ndjson.gz')
+    with open(path, 'wb') as w:
+        w.write(gzip.compress(b'{"_id":"1"}\n'))
+        # 写到一半崩溃的成员
+        member = gzip.compress(b'{"_id":"2"}\n' * 100)
+        w.write(member[:len(member) // 2])
+    assert [r['_id'] for r in read_segment(path)] == ['1']
+    assert '不完整' in caplog.text
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch):
+    server = FakeES().start()
+    monkeypatch.setattr(es_sync_data, 'cur_dir', str(tmp_path))
+    monkeypatch.setattr(es_sync_data, 'es_hosts', [server.url])
+    monkeypatch.setattr(es_sync_data, 'get_config', lambda: {'DB': {}, 'SYNC': {'dead_letter': True}})
+    es_sync_data.get_spool.cache_clear()
+    es_sync_data.get_es.cache_clear()
+    yield server
+    es_sync_data.get_spool.cache_clear()
+    es_sync_data.get_es.cache_clear()
+    server.shutdown()
+    server.server_close()
+
+
+def test_replay_submits_latest_and_removes_segments(env):
+    server = env
+    server.indices[index] = {'3': {'n': 0}}
+    spool = es_sync_data.get_spool()
+    spool.write([failed('1', 1), failed('2', 2)])
+    spool.seal()
+    spool.write([failed('1', 10), failed('3', 30, op='update')])
+    spool.seal()
+
+    es_sync_data.replay()
+    # 同一个文档只提交最后一次的内容，update 按原来的请求体提交
+    assert server.indices[index] == {'1': {'n': 10}, '2': {'n': 2}, '3': {'n': 30}}
+    assert spool.segments() == []
+    bulks = server.stats['bulk']
+
+    # 再次重放什么也不做
+    es_sync_data.replay()
+    assert server.stats['bulk'] == bulks
+    assert server.indices[index] == {'1': {'n': 10}, '2': {'n': 2}, '3': {'n': 30}}
+
+
+def test_replay_failures_are_spooled_again(env):
+    server = env
+    spool = es_sync_data.get_spool()
+    spool.write([failed('1', 1), failed('2', 2)])
+    spool.seal()
+    first = spool.segments()
+
+    server.error_ratio = 1.0
+    es_sync_data.replay()
+    # 再次失败的写入新的段文件，原来的段文件删除
+    paths = spool.segments()
+    assert len(paths) == 1 and paths != first
+    assert sorted(r['_id'] for r in read_segment(paths[0])) == ['1', '2']
+
+    server.error_ratio = 0.0
+    es_sync_data.replay()
+    assert server.indices[index] == {'1': {'n': 1}, '2': {'n': 2}}
+    assert spool.segments() == []